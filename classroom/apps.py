@@ -3,3 +3,13 @@ from django.apps import AppConfig
 
 class ClassroomConfig(AppConfig):
     name = 'classroom'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        # 居眠り検知を担当するプロセスでは、最初のフレームを待たせないよう
+        # 起動時に顔検出器とランドマークのモデルを読み込んでおく
+        from django.conf import settings
+        if getattr(settings, 'DROWSINESS_PRELOAD', False):
+            from .drowsiness import loader
+            loader.preload()
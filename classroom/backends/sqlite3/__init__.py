@@ -0,0 +1,6 @@
+"""
+接続ごとに PRAGMA を設定し、書き込むトランザクションを BEGIN IMMEDIATE で始める SQLite のバックエンド
+
+``DATABASES`` の ``ENGINE`` に ``'classroom.backends.sqlite3'`` を指定し、
+``OPTIONS`` の ``pragmas``・``wal``・``transaction_mode`` で設定する(どれも sqlite3.connect には渡さない)。
+"""
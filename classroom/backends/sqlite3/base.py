@@ -0,0 +1,52 @@
+from django.db.backends.sqlite3 import base
+
+
+# 接続ごとの設定。データベースファイルには残らない
+DEFAULT_PRAGMAS = {
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# 同時に受験している生徒の回答が書き込みのロックで待たされないようにする設定(OPTIONS の wal)。
+# WAL なら読み込みは書き込みを待たず、synchronous=NORMAL は WAL では
+# コミットごとの fsync を省く(電源断で最後のトランザクションを失うことはあるが壊れはしない)。
+# journal_mode=WAL はデータベースファイルに記録され、-wal / -shm ファイルもできるので、
+# 運用するデータベースで明示的に有効にしたときだけ設定する
+WAL_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+}
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    pragmas = DEFAULT_PRAGMAS
+    transaction_mode = None
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = kwargs.pop('pragmas', DEFAULT_PRAGMAS)
+        if kwargs.pop('wal', False):
+            self.pragmas = {**WAL_PRAGMAS, **self.pragmas}
+        transaction_mode = kwargs.pop('transaction_mode', None)
+        if transaction_mode is not None and transaction_mode.upper() not in TRANSACTION_MODES:
+            raise ValueError(f'transaction_mode は {TRANSACTION_MODES} のいずれか: {transaction_mode}')
+        self.transaction_mode = transaction_mode and transaction_mode.upper()
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        # BEGIN(DEFERRED)で始めると、読んだ後に書き込もうとしたときに他の書き込みと
+        # ぶつかり、待たずに "database is locked" になる。最初から書き込みのロックを取れば
+        # busy timeout の間、順番を待つ
+        if self.transaction_mode:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')
+        else:
+            super()._start_transaction_under_autocommit()
@@ -0,0 +1,6 @@
+"""
+居眠り検知
+
+カメラや動画の各フレームから顔と目のランドマークを求め、
+目の縦横比(EAR)の変化からまばたきと居眠りを判定する。
+"""
@@ -0,0 +1,180 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+from .recorder import get_recorder
+from .scoring import BLINK, DROWSY, DrowsinessScorer, Frame
+from .worker import analyze_jpeg, init_analyzer
+
+
+class RateLimiter:
+    """
+    生徒ごとのトークンバケット。1秒あたり ``rate`` フレームまで受け付け、
+    まとめて送られた場合も ``burst`` フレームまでは一度に受け付ける。
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, count=1, now=None):
+        """ 受け付けられるフレーム数(0〜count)を返す """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            accepted = min(count, int(tokens))
+            self._buckets[key] = (tokens - accepted, now)
+        return accepted
+
+
+class _Stream:
+    """ 1人の生徒の1つのクイズについての判定の状態 """
+
+    def __init__(self, on_drowsy, on_blink):
+        self.scorer = DrowsinessScorer()
+        self.on_drowsy = on_drowsy
+        self.on_blink = on_blink
+        self.lock = threading.Lock()
+        self.last_timestamp = None
+        self.seen = time.monotonic()
+
+
+class FrameAnalyzer:
+    """
+    ブラウザから届いたフレームを、クラス全体で共有するプロセスプールで解析する。
+
+    同時に解析するフレーム数は ``max_pending`` までで、あふれたフレームは捨てる
+    (リクエストを待たせない)。EARによる判定は生徒ごとの状態を持つので
+    このプロセスで行い、まばたき・居眠りは ``EventRecorder`` でまとめて保存する。
+    """
+
+    # この秒数フレームが届かなかった生徒の状態は破棄する
+    STREAM_TIMEOUT = 300
+
+    def __init__(self, workers=2, max_pending=32, fps=5, predictor_path=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.predictor_path = predictor_path or settings.DROWSINESS_PREDICTOR_PATH
+        self.limiter = RateLimiter(fps)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        self.workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                        initializer=init_analyzer,
+                        initargs=(self.predictor_path,))
+        return self._pool
+
+    def _stream(self, student, quiz):
+        key = (student.pk, quiz.pk if quiz is not None else None)
+        now = time.monotonic()
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                self._expire(now)
+        if stream is None:
+            stream = _Stream(*get_recorder().callbacks(student, quiz))
+            with self._lock:
+                stream = self._streams.setdefault(key, stream)
+        stream.seen = now
+        return stream
+
+    def _expire(self, now):
+        for key, stream in list(self._streams.items()):
+            if now - stream.seen > self.STREAM_TIMEOUT:
+                del self._streams[key]
+
+    def submit(self, student, quiz, frames):
+        """
+        フレーム(JPEGのバイト列と撮影時刻の組)の解析を予約する。
+        戻り値は (受け付けた数, 捨てた数)。
+        """
+        allowed = self.limiter.take(student.pk, len(frames))
+        stream = self._stream(student, quiz)
+        pool = self._get_pool()
+        accepted = 0
+        for data, timestamp in frames[:allowed]:
+            if not self._slots.acquire(blocking=False):
+                break
+            try:
+                future = pool.submit(analyze_jpeg, data, self.predictor_path)
+            except BrokenProcessPool:
+                # ワーカーが異常終了したプールは捨て、次のリクエストで作り直す
+                self._slots.release()
+                self._reset_pool(pool)
+                break
+            except Exception:
+                self._slots.release()
+                raise
+            future.add_done_callback(
+                lambda f, timestamp=timestamp: self._done(pool, stream, timestamp, f))
+            accepted += 1
+        return accepted, len(frames) - accepted
+
+    def _reset_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, pool, stream, timestamp, future):
+        self._slots.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            if isinstance(error, BrokenProcessPool):
+                self._reset_pool(pool)
+            return
+        ears = future.result()
+        if not ears:
+            return
+        with stream.lock:
+            # ワーカーの終わる順は前後するので、古いフレームの結果は判定に使わない
+            if stream.last_timestamp is not None and timestamp < stream.last_timestamp:
+                return
+            stream.last_timestamp = timestamp
+            # 画像はワーカー側にしかないので、コールバックには時刻だけを渡す
+            frame = Frame(0, timestamp, None, time.perf_counter())
+            for ear in ears:
+                event = stream.scorer.update(ear, timestamp)
+                if event == DROWSY:
+                    stream.on_drowsy(frame, ear)
+                elif event == BLINK:
+                    stream.on_blink(frame, ear)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+_analyzer = None
+_analyzer_lock = threading.Lock()
+
+
+def get_analyzer():
+    """ プロセス内で共有する解析器を返す """
+    global _analyzer
+    if _analyzer is None:
+        with _analyzer_lock:
+            if _analyzer is None:
+                _analyzer = FrameAnalyzer(
+                    workers=getattr(settings, 'DROWSINESS_INGEST_WORKERS', 2),
+                    max_pending=getattr(settings, 'DROWSINESS_INGEST_MAX_PENDING', 32),
+                    fps=getattr(settings, 'DROWSINESS_INGEST_FPS', 5))
+    return _analyzer
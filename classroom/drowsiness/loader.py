@@ -0,0 +1,49 @@
+"""
+顔検出器とランドマークのモデルの読み込み
+
+dlib や OpenCV はこのパッケージの関数を最初に使ったときに読み込まれる。
+居眠り検知を使わないプロセス(通常のクイズの画面など)はこれらを読み込まないので、
+起動が速く、モデルの分のメモリも使わない。
+"""
+import threading
+
+from django.conf import settings
+
+
+_lock = threading.Lock()
+_predictors = {}
+_local = threading.local()
+
+
+def get_predictor(path=None):
+    """
+    ランドマークのモデルを返す。モデルは大きいので、パスごとにプロセスで1つだけ読み込む。
+    推定は読み取りだけなので、複数のスレッドから同時に使ってよい。
+    """
+    path = path or settings.DROWSINESS_PREDICTOR_PATH
+    predictor = _predictors.get(path)
+    if predictor is None:
+        with _lock:
+            predictor = _predictors.get(path)
+            if predictor is None:
+                import dlib
+                predictor = _predictors[path] = dlib.shape_predictor(path)
+    return predictor
+
+
+def get_detector():
+    """
+    顔検出器を返す。検出器は同時に使えないので、スレッドごとに1つ作る
+    (ランドマークのモデルと違い、作るのにかかる時間もメモリもわずか)。
+    """
+    detector = getattr(_local, 'detector', None)
+    if detector is None:
+        import dlib
+        detector = _local.detector = dlib.get_frontal_face_detector()
+    return detector
+
+
+def preload(predictor_path=None):
+    """ 最初のフレームを待たせないよう、検出器とモデルを先に読み込む """
+    get_detector()
+    get_predictor(predictor_path)
@@ -0,0 +1,334 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import dlib
+
+from .loader import get_detector, get_predictor
+from .scoring import BLINK, DROWSY, DrowsinessScorer, Frame, face_ears
+
+
+# 各段の終わりを下流に伝える目印
+_STOP = object()
+
+# キューの受け渡しで、停止の指示を確認する間隔(秒)
+_POLL_SECONDS = 0.1
+
+
+# ---- 顔検出のワーカープロセス ----
+
+def _init_worker():
+    """ ワーカープロセスごとに1回だけ顔検出器を作る """
+    get_detector()
+
+
+def _init_worker_ready(_):
+    return True
+
+
+def _detect(gray):
+    """ 顔の矩形 (left, top, right, bottom) のリストと、検出にかかった秒数を返す """
+    started = time.perf_counter()
+    faces = get_detector()(gray)
+    rects = [(f.left(), f.top(), f.right(), f.bottom()) for f in faces]
+    return rects, time.perf_counter() - started
+
+
+class StageStats:
+    """ 段ごとの処理時間を記録する """
+
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+
+    def add(self, seconds):
+        self.durations.append(seconds)
+
+    def percentile(self, p):
+        if not self.durations:
+            return None
+        values = sorted(self.durations)
+        return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+    def summary(self):
+        return {
+            'count': len(self.durations),
+            'p50_ms': _ms(self.percentile(50)),
+            'p95_ms': _ms(self.percentile(95)),
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class PipelineStats:
+    """ パイプライン全体のスループット・遅延・捨てたフレーム数 """
+
+    def __init__(self):
+        self.started = None
+        self.finished = None
+        self.captured = 0
+        self.dropped = 0
+        self.processed = 0
+        # 顔検出器で全体を走査したフレーム数
+        self.detections = 0
+        self.drowsy_events = 0
+        self.stages = {name: StageStats(name)
+                       for name in ('capture', 'detect', 'landmarks', 'score')}
+        self.latency = StageStats('end_to_end')
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def fps(self):
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return {
+            'frames_captured': self.captured,
+            'frames_dropped': self.dropped,
+            'frames_processed': self.processed,
+            'detections': self.detections,
+            'drowsy_events': self.drowsy_events,
+            'seconds': round(self.elapsed, 3),
+            'fps': round(self.fps, 1),
+            'latency': self.latency.summary(),
+            'stages': {name: stage.summary() for name, stage in self.stages.items()},
+        }
+
+
+def _open(source):
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise OSError(f'映像を開けません: {source!r}')
+    return cap
+
+
+def _timestamp(cap, is_file):
+    if is_file:
+        return cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+    return time.time()
+
+
+def _apply_scores(scorer, frame, ears, stats, on_drowsy=None, on_blink=None):
+    """ フレーム内の顔のEARで判定を進め、まばたき・居眠りのコールバックを呼ぶ """
+    for ear in ears:
+        event = scorer.update(ear, frame.timestamp)
+        if event == DROWSY:
+            stats.drowsy_events += 1
+            if on_drowsy is not None:
+                on_drowsy(frame, ear)
+        elif event == BLINK and on_blink is not None:
+            on_blink(frame, ear)
+
+
+class DrowsinessPipeline:
+    """
+    キャプチャ → 顔検出 → ランドマーク → EAR判定 を段ごとのスレッドに分け、
+    上限付きのキューでつなぐ。
+
+    最も重い顔検出はプロセスプールで並列に実行し、GILの影響を受けない。
+    検出結果はフレームの順番どおりに受け取るので、判定の順序は変わらない。
+    ``drop_frames`` が真の場合、処理が追いつかないときは古いフレームを捨てて
+    最新のフレームを優先する(カメラ向け)。動画のベンチマークで全フレームを
+    処理したい場合は偽にする。
+    """
+
+    def __init__(self, source=0, workers=2, queue_size=4, predictor_path=None,
+                 on_drowsy=None, on_blink=None, drop_frames=True, scorer=None):
+        self.source = source
+        self.workers = workers
+        self.queue_size = queue_size
+        self.predictor_path = predictor_path
+        self.on_drowsy = on_drowsy
+        self.on_blink = on_blink
+        self.drop_frames = drop_frames
+        self.scorer = scorer or DrowsinessScorer()
+        self.stats = PipelineStats()
+        self._stopping = threading.Event()
+        self._errors = []
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self, max_frames=None):
+        """ 映像の終わり(または ``max_frames``)まで処理して統計を返す """
+        predictor = get_predictor(self.predictor_path)
+        frames = queue.Queue(maxsize=self.queue_size)
+        detections = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.queue_size)
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.workers, mp_context=context,
+                                 initializer=_init_worker) as pool:
+            # ワーカーの起動を待ってから計測を始める
+            list(pool.map(_init_worker_ready, range(self.workers)))
+            self.stats.started = time.perf_counter()
+            threads = [
+                threading.Thread(target=self._stage, args=(self._capture, max_frames, frames)),
+                threading.Thread(target=self._stage, args=(self._submit, pool, frames, detections)),
+                threading.Thread(target=self._stage, args=(self._landmarks, predictor, detections, results)),
+                threading.Thread(target=self._stage, args=(self._score, results)),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.stats.finished = time.perf_counter()
+
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
+
+    def _stage(self, target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stopping.set()
+
+    def _put(self, q, item):
+        """ 下流が詰まっている間は待つ。停止の指示があれば諦める """
+        while not self._stopping.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stopping.is_set():
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def _put_latest(self, q, item):
+        """ キューが満杯なら最も古いフレームを捨てて入れる """
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    self.stats.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _capture(self, max_frames, frames):
+        is_file = isinstance(self.source, str)
+        cap = _open(self.source)
+        stage = self.stats.stages['capture']
+        try:
+            index = 0
+            while not self._stopping.is_set():
+                if max_frames is not None and index >= max_frames:
+                    break
+                started = time.perf_counter()
+                ret, image = cap.read()
+                if not ret:
+                    break
+                # グレースケール変換(解析効率化のため)
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                frame = Frame(index, _timestamp(cap, is_file), gray, started)
+                stage.add(time.perf_counter() - started)
+                self.stats.captured += 1
+                index += 1
+                if self.drop_frames:
+                    self._put_latest(frames, frame)
+                elif not self._put(frames, frame):
+                    break
+        finally:
+            cap.release()
+            self._put(frames, _STOP)
+
+    def _submit(self, pool, frames, detections):
+        try:
+            while (frame := self._get(frames)) is not _STOP:
+                # detections の上限が、ワーカーに渡している途中のフレーム数の上限になる
+                if not self._put(detections, (frame, pool.submit(_detect, frame.gray))):
+                    break
+        finally:
+            self._put(detections, _STOP)
+
+    def _landmarks(self, predictor, detections, results):
+        detect_stage = self.stats.stages['detect']
+        stage = self.stats.stages['landmarks']
+        try:
+            while (item := self._get(detections)) is not _STOP:
+                frame, future = item
+                rects, detect_seconds = future.result()
+                detect_stage.add(detect_seconds)
+                self.stats.detections += 1
+                started = time.perf_counter()
+                ears = face_ears(predictor, frame.gray,
+                                 [dlib.rectangle(*rect) for rect in rects])
+                stage.add(time.perf_counter() - started)
+                if not self._put(results, (frame, ears)):
+                    break
+        finally:
+            self._put(results, _STOP)
+
+    def _score(self, results):
+        stage = self.stats.stages['score']
+        while (item := self._get(results)) is not _STOP:
+            frame, ears = item
+            started = time.perf_counter()
+            _apply_scores(self.scorer, frame, ears, self.stats,
+                          self.on_drowsy, self.on_blink)
+            now = time.perf_counter()
+            stage.add(now - started)
+            self.stats.latency.add(now - frame.captured_at)
+            self.stats.processed += 1
+
+
+def run_serial(source, predictor_path=None, on_drowsy=None, on_blink=None,
+               scorer=None, max_frames=None):
+    """ 比較用に、すべての段を1つのスレッドで順に実行する """
+    detector = get_detector()
+    predictor = get_predictor(predictor_path)
+    scorer = scorer or DrowsinessScorer()
+    stats = PipelineStats()
+    is_file = isinstance(source, str)
+    cap = _open(source)
+    stats.started = time.perf_counter()
+    try:
+        while max_frames is None or stats.captured < max_frames:
+            started = time.perf_counter()
+            ret, image = cap.read()
+            if not ret:
+                break
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            frame = Frame(stats.captured, _timestamp(cap, is_file), gray, started)
+            stats.captured += 1
+            detected = time.perf_counter()
+            stats.stages['capture'].add(detected - started)
+
+            faces = detector(gray)
+            stats.detections += 1
+            landmarked = time.perf_counter()
+            stats.stages['detect'].add(landmarked - detected)
+
+            ears = face_ears(predictor, gray, faces)
+            scored = time.perf_counter()
+            stats.stages['landmarks'].add(scored - landmarked)
+
+            _apply_scores(scorer, frame, ears, stats, on_drowsy, on_blink)
+            now = time.perf_counter()
+            stats.stages['score'].add(now - scored)
+            stats.latency.add(now - started)
+            stats.processed += 1
+    finally:
+        cap.release()
+        stats.finished = time.perf_counter()
+    return stats
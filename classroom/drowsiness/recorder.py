@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from ..events import publish, quiz_channel
+from ..models import DrowsinessEvent, TakenTime, User
+
+
+logger = logging.getLogger(__name__)
+
+
+def summarize(events):
+    """ 生徒・クイズ・種類ごとに、件数と最小のEAR・最後の時刻にまとめる """
+    groups = {}
+    for event in events:
+        key = (event.student_id, event.quiz_id, event.kind)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'student_id': event.student_id,
+                'quiz': event.quiz_id,
+                'kind': event.kind,
+                'count': 0,
+                'min_ear': event.ear,
+                'last': event.occurred_at,
+            }
+        group['count'] += 1
+        group['min_ear'] = min(group['min_ear'], event.ear)
+        group['last'] = max(group['last'], event.occurred_at)
+    return list(groups.values())
+
+
+class EventRecorder:
+    """
+    まばたき・居眠りのイベントをためて、まとめて保存・配信する。
+
+    カメラごと・フレームごとにトランザクションを作らないよう、
+    ``batch_size`` 件たまるか、最初のイベントから ``flush_seconds`` 秒たった時点で
+    1回の ``bulk_create`` で保存する。保存がコミットされた後に、
+    まとめた内容を各クイズのチャンネルに送る(クイズの持ち主の先生だけが購読できる)。
+
+    ``add`` はためるだけで、保存と配信はレコーダーが持つ1つのスレッドで行う。
+    解析の完了を受け取るスレッド(プロセスプールのコールバックなど)で
+    データベースに接続したり、遅い書き込みで待たされたりしない。
+    """
+
+    def __init__(self, batch_size=200, flush_seconds=1.0):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._pending = []
+        self._thread = None
+
+    def add(self, student_id, kind, ear, quiz_id=None, taken_time_id=None,
+            occurred_at=None):
+        event = DrowsinessEvent(
+            student_id=student_id,
+            quiz_id=quiz_id,
+            taken_time_id=taken_time_id,
+            kind=kind,
+            ear=ear,
+            occurred_at=occurred_at or timezone.now())
+        with self._lock:
+            self._pending.append(event)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='drowsiness-recorder', daemon=True)
+                self._thread.start()
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._ready.notify()
+
+    def callbacks(self, student, quiz=None):
+        """ パイプラインに渡す (on_drowsy, on_blink) を返す """
+        quiz_id = quiz.pk if quiz is not None else None
+        taken_time_id = None
+        if quiz is not None:
+            taken_time_id = TakenTime.objects \
+                .filter(student=student, quiz=quiz) \
+                .values_list('pk', flat=True) \
+                .first()
+
+        def record(kind):
+            def callback(frame, ear):
+                self.add(student.pk, kind, ear, quiz_id=quiz_id,
+                         taken_time_id=taken_time_id)
+            return callback
+
+        return record(DrowsinessEvent.DROWSY), record(DrowsinessEvent.BLINK)
+
+    def flush(self):
+        """ たまっているイベントを、呼び出したスレッドですぐに保存する """
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._write(batch)
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._ready.wait()
+                # 最初のイベントから flush_seconds 秒か、batch_size 件たまるまで待つ
+                deadline = time.monotonic() + self.flush_seconds
+                while len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                batch = self._take()
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception('居眠り検知のイベントを保存できませんでした')
+            finally:
+                # 待っている間に接続が切れないよう、書き込みごとに閉じる
+                connection.close()
+
+    def _write(self, batch):
+        with transaction.atomic():
+            DrowsinessEvent.objects.bulk_create(batch)
+            transaction.on_commit(lambda: self._publish(batch))
+
+    def _publish(self, batch):
+        # 生徒の名前が載るので、全体のチャンネルには送らない。
+        # クイズのないイベントは保存だけする
+        groups = [group for group in summarize(batch) if group['quiz'] is not None]
+        if not groups:
+            return
+        usernames = dict(User.objects
+                         .filter(pk__in={g['student_id'] for g in groups})
+                         .values_list('pk', 'username'))
+        by_quiz = {}
+        for group in groups:
+            group['student'] = usernames.get(group['student_id'])
+            by_quiz.setdefault(group['quiz'], []).append(group)
+
+        for quiz_id, alerts in by_quiz.items():
+            publish(quiz_channel(quiz_id), 'drowsiness', {'alerts': alerts})
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    """ プロセス内で共有するレコーダーを返す。すべてのカメラの書き込みをまとめる """
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = EventRecorder(
+                    batch_size=getattr(settings, 'DROWSINESS_EVENT_BATCH_SIZE', 200),
+                    flush_seconds=getattr(settings, 'DROWSINESS_EVENT_FLUSH_SECONDS', 1.0))
+    return _recorder
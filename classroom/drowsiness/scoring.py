@@ -0,0 +1,121 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+# 68点ランドマークのうち、左目・右目の番号
+LEFT_EYE = range(36, 42)
+RIGHT_EYE = range(42, 48)
+
+# DrowsinessScorer.update が返す判定
+BLINK = 'blink'
+DROWSY = 'drowsy'
+
+# 両目の12点の番号。EARにはこの12点しか使わない
+EYE_POINTS = [*LEFT_EYE, *RIGHT_EYE]
+
+
+@dataclass
+class Frame:
+    index: int
+    # 判定に使う時刻(カメラは現在時刻、動画ファイルは再生位置)
+    timestamp: float
+    gray: object
+    # 遅延の計測用(time.perf_counter)
+    captured_at: float
+
+
+def eye_aspect_ratio(eye):
+    from scipy.spatial import distance
+
+    A = distance.euclidean(eye[1], eye[5])
+    B = distance.euclidean(eye[2], eye[4])
+    C = distance.euclidean(eye[0], eye[3])
+    ear = (A + B) / (2.0 * C)
+    return ear
+
+
+def landmarks_to_array(landmarks, points=range(68)):
+    """ dlibのランドマークを (点の数, 2) の配列にする """
+    return np.array(
+        [(landmarks.part(i).x, landmarks.part(i).y) for i in points], dtype=np.float64)
+
+
+def eye_aspect_ratios(points):
+    """
+    ランドマークの配列から両目の平均のEARをまとめて求める。
+
+    ``points`` は68点すべての (..., 68, 2) でも、``EYE_POINTS`` の順に
+    両目だけを取り出した (..., 12, 2) でもよい。複数の顔やフレームを重ねて渡すと、
+    先頭の次元をそのまま残した形でEARを返す。
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.shape[-2] != len(EYE_POINTS):
+        points = points[..., EYE_POINTS, :]
+    eyes = points.reshape(points.shape[:-2] + (2, 6, 2))
+    a = np.linalg.norm(eyes[..., 1, :] - eyes[..., 5, :], axis=-1)
+    b = np.linalg.norm(eyes[..., 2, :] - eyes[..., 4, :], axis=-1)
+    c = np.linalg.norm(eyes[..., 0, :] - eyes[..., 3, :], axis=-1)
+    return ((a + b) / (2.0 * c)).mean(axis=-1)
+
+
+def face_ears(predictor, gray, faces):
+    """ フレーム内のすべての顔のEARを、ランドマークを1つの配列にまとめて求める """
+    if not faces:
+        return []
+    points = np.stack([
+        landmarks_to_array(predictor(gray, face), EYE_POINTS) for face in faces])
+    return eye_aspect_ratios(points).tolist()
+
+
+def landmarks_ear(landmarks):
+    """ ランドマークから両目の平均のEARを求める """
+    return float(eye_aspect_ratios(landmarks_to_array(landmarks, EYE_POINTS)))
+
+
+class DrowsinessScorer:
+    """
+    EARの時系列からまばたきと居眠りを判定する。
+
+    目を閉じている状態が ``blink_seconds`` 続くとまばたき1回と数え、
+    まばたきが ``blink_count_threshold`` 回以上あった後に
+    目を開けたフレームが ``drowsy_threshold`` 回を超えると居眠りと判定する。
+    時刻は引数で受け取るので、動画ファイルでも再生時刻で同じ判定になる。
+
+    居眠りは状態に入ったときに1回だけ返す(フレームごとに保存・通知しない)。
+    次のまばたきで状態を抜けたものとし、続いている間は ``drowsy_cooldown`` 秒ごとに返す。
+    """
+
+    def __init__(self, eye_ar_threshold=0.2, blink_seconds=0.5,
+                 blink_count_threshold=5, drowsy_threshold=5, drowsy_cooldown=60.0):
+        self.eye_ar_threshold = eye_ar_threshold
+        self.blink_seconds = blink_seconds
+        self.blink_count_threshold = blink_count_threshold
+        self.drowsy_threshold = drowsy_threshold
+        self.drowsy_cooldown = drowsy_cooldown
+        self.blink_start_time = None
+        self.blink_count = 0
+        self.time_since_last_blink = 0
+        self.drowsy_reported_at = None
+
+    def update(self, ear, timestamp):
+        """ 1つの顔のEARを反映し、まばたきなら ``BLINK``、居眠りなら ``DROWSY`` を返す """
+        if ear < self.eye_ar_threshold:
+            if self.blink_start_time is None:
+                self.blink_start_time = timestamp
+            elif timestamp - self.blink_start_time > self.blink_seconds:
+                self.blink_count += 1
+                self.time_since_last_blink = 0
+                self.blink_start_time = None
+                self.drowsy_reported_at = None
+                return BLINK
+            return None
+
+        self.time_since_last_blink += 1
+        if (self.blink_count >= self.blink_count_threshold
+                and self.time_since_last_blink > self.drowsy_threshold):
+            if (self.drowsy_reported_at is None
+                    or timestamp - self.drowsy_reported_at >= self.drowsy_cooldown):
+                self.drowsy_reported_at = timestamp
+                return DROWSY
+        return None
@@ -0,0 +1,209 @@
+import time
+
+import cv2
+import dlib
+import numpy as np
+
+from .loader import get_detector, get_predictor
+from .pipeline import PipelineStats, _apply_scores, _open, _timestamp
+from .scoring import (
+    EYE_POINTS, DrowsinessScorer, Frame, eye_aspect_ratios, landmarks_to_array,
+)
+
+
+# 相関トラッカーの品質(PSR)がこれを下回ったら見失ったとみなして検出し直す
+MIN_TRACKING_QUALITY = 7.0
+
+# ランドマークを求めるときに顔の周りに残す余白(顔の幅に対する割合)
+ROI_MARGIN = 0.2
+
+
+def _rectangle(position):
+    return dlib.rectangle(
+        int(round(position.left())), int(round(position.top())),
+        int(round(position.right())), int(round(position.bottom())))
+
+
+class FaceTracker:
+    """
+    顔検出を ``detect_every`` フレームごと(または見失ったとき)だけ行い、
+    その間は相関トラッカーで顔の位置を追う。
+
+    生徒の顔はフレーム間でほとんど動かないので、全体を検出器で走査するより
+    前のフレームの顔の周辺だけを追う方がずっと軽い。
+    ``detect_every=1`` にすると毎フレーム検出する(従来の動作)。
+    """
+
+    def __init__(self, detect_every=10, min_quality=MIN_TRACKING_QUALITY,
+                 detector=None):
+        self.detect_every = detect_every
+        self.min_quality = min_quality
+        self.detector = detector or get_detector()
+        self._trackers = []
+        self._since_detection = 0
+        # 検出器を実行した回数
+        self.detections = 0
+
+    def faces(self, gray):
+        """ フレーム内の顔の矩形のリストを返す """
+        if self._trackers and self._since_detection < self.detect_every:
+            faces = self._track(gray)
+            if faces is not None:
+                self._since_detection += 1
+                return faces
+        return self._detect(gray)
+
+    def _detect(self, gray):
+        faces = self.detector(gray)
+        self.detections += 1
+        self._since_detection = 1
+        self._trackers = []
+        if self.detect_every > 1:
+            for face in faces:
+                tracker = dlib.correlation_tracker()
+                tracker.start_track(gray, face)
+                self._trackers.append(tracker)
+        return list(faces)
+
+    def _track(self, gray):
+        """ 追跡した矩形を返す。1つでも見失った場合は None """
+        height, width = gray.shape[:2]
+        faces = []
+        for tracker in self._trackers:
+            if tracker.update(gray) < self.min_quality:
+                return None
+            face = _rectangle(tracker.get_position())
+            if face.right() <= 0 or face.bottom() <= 0 \
+                    or face.left() >= width or face.top() >= height:
+                return None
+            faces.append(face)
+        return faces
+
+
+def roi_eye_points(predictor, gray, face, width=None, margin=ROI_MARGIN):
+    """
+    顔の周辺だけを切り出し、幅が ``width`` 画素になるよう縮小してから
+    目のランドマークを求める。戻り値は元のフレームの座標の (12, 2) の配列。
+    ``width`` を省略した場合はフレームをそのまま使う。
+    """
+    if width is None:
+        return landmarks_to_array(predictor(gray, face), EYE_POINTS)
+
+    height, frame_width = gray.shape[:2]
+    pad = int(face.width() * margin)
+    left, top = max(face.left() - pad, 0), max(face.top() - pad, 0)
+    right = min(face.right() + pad, frame_width)
+    bottom = min(face.bottom() + pad, height)
+    roi = gray[top:bottom, left:right]
+    if roi.size == 0:
+        return landmarks_to_array(predictor(gray, face), EYE_POINTS)
+
+    scale = min(width / roi.shape[1], 1.0)
+    if scale < 1.0:
+        roi = cv2.resize(roi, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        roi = np.ascontiguousarray(roi)
+    box = dlib.rectangle(
+        int((face.left() - left) * scale), int((face.top() - top) * scale),
+        int((face.right() - left) * scale), int((face.bottom() - top) * scale))
+    points = landmarks_to_array(predictor(roi, box), EYE_POINTS)
+    return points / scale + (left, top)
+
+
+def run_tracking(source, detect_every=10, landmark_width=None,
+                 predictor_path=None, on_drowsy=None, on_blink=None, scorer=None,
+                 max_frames=None, record=None):
+    """
+    追跡モードで映像を処理して統計を返す。
+
+    ``record`` にリストを渡すと、フレームごとに (顔の矩形のリスト, EARのリスト) を追加する。
+    ``detect_every=1`` かつ ``landmark_width=None`` が全フレーム検出の基準になる。
+    """
+    tracker = FaceTracker(detect_every)
+    predictor = get_predictor(predictor_path)
+    scorer = scorer or DrowsinessScorer()
+    stats = PipelineStats()
+    is_file = isinstance(source, str)
+    cap = _open(source)
+    stats.started = time.perf_counter()
+    try:
+        while max_frames is None or stats.captured < max_frames:
+            started = time.perf_counter()
+            ret, image = cap.read()
+            if not ret:
+                break
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            frame = Frame(stats.captured, _timestamp(cap, is_file), gray, started)
+            stats.captured += 1
+            detected = time.perf_counter()
+            stats.stages['capture'].add(detected - started)
+
+            faces = tracker.faces(gray)
+            landmarked = time.perf_counter()
+            stats.stages['detect'].add(landmarked - detected)
+
+            ears = []
+            if faces:
+                ears = eye_aspect_ratios(np.stack([
+                    roi_eye_points(predictor, gray, face, landmark_width)
+                    for face in faces])).tolist()
+            scored = time.perf_counter()
+            stats.stages['landmarks'].add(scored - landmarked)
+
+            _apply_scores(scorer, frame, ears, stats, on_drowsy, on_blink)
+            now = time.perf_counter()
+            stats.stages['score'].add(now - scored)
+            stats.latency.add(now - started)
+            stats.processed += 1
+            if record is not None:
+                record.append((
+                    [(f.left(), f.top(), f.right(), f.bottom()) for f in faces], ears))
+    finally:
+        cap.release()
+        stats.finished = time.perf_counter()
+        stats.detections = tracker.detections
+    return stats
+
+
+def _iou(a, b):
+    left, top = max(a[0], b[0]), max(a[1], b[1])
+    right, bottom = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(right - left, 0) * max(bottom - top, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def compare_with_detection(source, detect_every=10, landmark_width=None,
+                           predictor_path=None, max_frames=None):
+    """
+    同じ映像を全フレーム検出と追跡モードで処理し、速度と精度を比べる。
+
+    精度は全フレーム検出の結果を正解として、顔の有無の一致率、
+    顔の矩形のIoU、EARの平均絶対誤差、居眠り判定の回数で表す。
+    """
+    baseline_frames, tracked_frames = [], []
+    baseline = run_tracking(
+        source, detect_every=1, predictor_path=predictor_path,
+        max_frames=max_frames, record=baseline_frames)
+    tracked = run_tracking(
+        source, detect_every=detect_every, landmark_width=landmark_width,
+        predictor_path=predictor_path, max_frames=max_frames, record=tracked_frames)
+
+    agree, ious, errors = 0, [], []
+    for (base_faces, base_ears), (faces, ears) in zip(baseline_frames, tracked_frames):
+        agree += bool(base_faces) == bool(faces)
+        if base_faces and faces:
+            ious.append(_iou(base_faces[0], faces[0]))
+            errors.append(abs(base_ears[0] - ears[0]))
+
+    frames = min(len(baseline_frames), len(tracked_frames))
+    return {
+        'baseline': baseline.summary(),
+        'tracking': tracked.summary(),
+        'speedup': round(tracked.fps / baseline.fps, 2) if baseline.fps else None,
+        'face_agreement': round(agree / frames, 4) if frames else None,
+        'mean_iou': round(float(np.mean(ious)), 4) if ious else None,
+        'ear_mae': round(float(np.mean(errors)), 4) if errors else None,
+        'drowsy_events': {
+            'baseline': baseline.drowsy_events, 'tracking': tracked.drowsy_events},
+    }
@@ -0,0 +1,35 @@
+"""
+フレームの解析のワーカープロセスで動かす関数
+
+spawn で起動したワーカーは、このモジュールを読み込むだけで Django の初期化
+(``django.setup``)は行わない。モデルを読み込むモジュール(``recorder`` など)を
+ここから import すると、ワーカーが起動できなくなる。
+"""
+import numpy as np
+
+from .loader import get_detector, get_predictor, preload
+from .scoring import face_ears
+
+
+def init_analyzer(predictor_path):
+    """ ワーカープロセスごとに1回だけ検出器とランドマークのモデルを読み込む """
+    preload(predictor_path)
+
+
+def decode_jpeg(data):
+    """
+    JPEGのバイト列をグレースケールの画像にする。
+    受け取ったバイト列をコピーせずにNumPyの配列として参照し、そのまま展開する。
+    """
+    import cv2
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    return cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+
+
+def analyze_jpeg(data, predictor_path=None):
+    """ 1フレーム分のJPEGから、写っている顔ごとのEARのリストを返す """
+    gray = decode_jpeg(data)
+    if gray is None:
+        return None
+    return face_ears(get_predictor(predictor_path), gray, get_detector()(gray))
@@ -0,0 +1,261 @@
+import asyncio
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils.module_loading import import_string
+
+
+HEARTBEAT_SECONDS = 15
+
+# クライアントが再接続するまでの待ち時間(ミリ秒)
+RETRY_MILLISECONDS = 3000
+
+# 1つの接続を続ける上限(秒)。切断を検知できなくても、購読はこの時間で終わる
+STREAM_SECONDS = 300
+
+
+@dataclass(frozen=True)
+class Event:
+    id: int
+    channel: str
+    name: str
+    data: str
+
+    def encode(self):
+        lines = [f'id: {self.id}', f'event: {self.name}']
+        lines += [f'data: {line}' for line in self.data.splitlines() or ['']]
+        return '\n'.join(lines) + '\n\n'
+
+
+class InProcessBroadcaster:
+    """
+    プロセス内のpub/sub。
+
+    購読者ごとに上限付きのキューを持ち、あふれた場合は古いイベントから捨てる。
+    チャンネルごとに直近のイベントを残しておき、``Last-Event-ID`` からの再開に使う。
+    複数プロセスで共有する場合は、同じインターフェースのバックエンドを
+    ``CLASSROOM_EVENT_BACKEND`` に指定する。
+    """
+
+    def __init__(self, history_size=100, queue_size=100):
+        self.history_size = history_size
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._history = {}
+        self._subscribers = {}
+
+    def publish(self, channel, name, data):
+        """ イベントを配信する。どのスレッドからでも呼び出せる """
+        if not isinstance(data, str):
+            data = json.dumps(data, ensure_ascii=False, default=str)
+        with self._lock:
+            event = Event(next(self._ids), channel, name, data)
+            self._history.setdefault(
+                channel, deque(maxlen=self.history_size)).append(event)
+            subscribers = list(self._subscribers.get(channel, ()))
+        for deliver in subscribers:
+            deliver(event)
+        return event
+
+    def _replay(self, channel, last_event_id):
+        if last_event_id is None:
+            return []
+        return [e for e in self._history.get(channel, ()) if e.id > last_event_id]
+
+    def _register(self, channel, deliver, last_event_id):
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(deliver)
+            return self._replay(channel, last_event_id)
+
+    def _unregister(self, channel, deliver):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(deliver)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    @asynccontextmanager
+    async def subscribe(self, channel, last_event_id=None):
+        """ イベントループ上で購読する。``await subscription.get()`` で受け取る """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize=self.queue_size)
+
+        def put(event):
+            if events.full():
+                events.get_nowait()
+            events.put_nowait(event)
+
+        def deliver(event):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(put, event)
+
+        for event in self._register(channel, deliver, last_event_id):
+            put(event)
+        try:
+            yield events
+        finally:
+            self._unregister(channel, deliver)
+
+    @contextmanager
+    def subscribe_sync(self, channel, last_event_id=None):
+        """ WSGIのスレッドから購読する。``subscription.get(timeout=...)`` で受け取る """
+        events = queue.Queue(maxsize=self.queue_size)
+
+        def deliver(event):
+            while True:
+                try:
+                    events.put_nowait(event)
+                    return
+                except queue.Full:
+                    try:
+                        events.get_nowait()
+                    except queue.Empty:
+                        pass
+
+        for event in self._register(channel, deliver, last_event_id):
+            deliver(event)
+        try:
+            yield events
+        finally:
+            self._unregister(channel, deliver)
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster():
+    global _broadcaster
+    if _broadcaster is None:
+        with _broadcaster_lock:
+            if _broadcaster is None:
+                backend = getattr(
+                    settings, 'CLASSROOM_EVENT_BACKEND',
+                    'classroom.events.InProcessBroadcaster')
+                _broadcaster = import_string(backend)()
+    return _broadcaster
+
+
+def publish(channel, name, data):
+    return get_broadcaster().publish(channel, name, data)
+
+
+class Coalescer:
+    """
+    短時間に集中したイベントを ``window`` 秒ごとに1つの ``batch`` イベントにまとめる。
+    500人が一斉に回答しても、チャンネルへの配信は1秒に1回程度に抑えられる。
+    """
+
+    def __init__(self, window=1.0):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, channel, name, data):
+        with self._lock:
+            pending = self._pending.get(channel)
+            if pending is None:
+                pending = self._pending[channel] = []
+                timer = threading.Timer(self.window, self.flush, [channel])
+                timer.daemon = True
+                timer.start()
+            pending.append({'event': name, 'data': data})
+
+    def flush(self, channel):
+        with self._lock:
+            pending = self._pending.pop(channel, None)
+        if pending:
+            counts = {}
+            for item in pending:
+                counts[item['event']] = counts.get(item['event'], 0) + 1
+            publish(channel, 'batch', {'counts': counts, 'events': pending})
+
+
+_coalescer = Coalescer(getattr(settings, 'CLASSROOM_EVENT_COALESCE_SECONDS', 1.0))
+
+
+def quiz_channel(quiz_pk):
+    return f'quiz-{quiz_pk}'
+
+
+def publish_quiz_event(quiz_pk, name, data):
+    """
+    クイズのチャンネルにイベントを送る。
+    トランザクションのコミット後にまとめて配信するので、取り消された回答は届かない。
+    """
+    transaction.on_commit(
+        lambda: _coalescer.add(quiz_channel(quiz_pk), name, data))
+
+
+def _lifetime():
+    return getattr(settings, 'CLASSROOM_EVENT_STREAM_SECONDS', STREAM_SECONDS)
+
+
+async def stream(channel, last_event_id=None, heartbeat=HEARTBEAT_SECONDS, lifetime=None):
+    """
+    SSEの本文を返す非同期ジェネレーター。待機中はスレッドを使わない。
+    Django 4.2 の ASGI ではクライアントが切断してもジェネレーターが止まらないので、
+    ``lifetime`` 秒で終わらせて、ブラウザに ``Last-Event-ID`` 付きで再接続させる。
+    """
+    deadline = time.monotonic() + (_lifetime() if lifetime is None else lifetime)
+    async with get_broadcaster().subscribe(channel, last_event_id) as events:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                event = await asyncio.wait_for(events.get(), min(heartbeat, remaining))
+            except asyncio.TimeoutError:
+                yield ': heartbeat\n\n'
+                continue
+            yield event.encode()
+
+
+def stream_sync(channel, last_event_id=None, heartbeat=HEARTBEAT_SECONDS, lifetime=None):
+    """ WSGIで動かす場合の同期版。接続ごとにスレッドを1つ使う """
+    deadline = time.monotonic() + (_lifetime() if lifetime is None else lifetime)
+    with get_broadcaster().subscribe_sync(channel, last_event_id) as events:
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                event = events.get(timeout=min(heartbeat, remaining))
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield event.encode()
+
+
+def last_event_id(request):
+    value = request.headers.get('Last-Event-ID') or request.GET.get('lastEventId')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def sse_response(request, channel):
+    """
+    チャンネルを購読するSSEのレスポンスを返す。
+    ASGIでは非同期ジェネレーターを返すので、接続中の待機はコルーチンだけで済む。
+    """
+    resume_from = last_event_id(request)
+    if isinstance(request, ASGIRequest):
+        content = stream(channel, resume_from)
+    else:
+        content = stream_sync(channel, resume_from)
+    response = StreamingHttpResponse(
+        streaming_content=content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx などのプロキシにバッファさせない
+    response['X-Accel-Buffering'] = 'no'
+    return response
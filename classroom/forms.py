@@ -1,3 +1,6 @@
+import random
+from operator import attrgetter
+
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.db import transaction
@@ -108,21 +111,36 @@ class BaseAnswerInlineFormSet(forms.BaseInlineFormSet):
 
 
 class TakeQuizForm(forms.ModelForm):
-    answer = forms.ModelChoiceField(
-        queryset=Answer.objects.none(),
+    """
+    問題のスナップショット(``QuestionSnapshot``)から選択肢を組み立てるので、
+    表示と検証のどちらでもデータベースを参照しない。
+    """
+    answer = forms.TypedChoiceField(
+        coerce=int,
         widget=forms.RadioSelect(),
-        required=True,
-        empty_label=None)
+        required=True)
 
     class Meta:
         model = StudentAnswer
-        fields = ('answer', )
+        fields = ()
 
     def __init__(self, *args, **kwargs):
         question = kwargs.pop('question')
         order = kwargs.pop('order', 'text')
         super().__init__(*args, **kwargs)
-        self.fields['answer'].queryset = question.answers.order_by(order)
+        answers = list(question.answers)
+        if order == '?':
+            random.shuffle(answers)
+        else:
+            answers.sort(key=attrgetter(order))
+        self._answers = {answer.pk: answer for answer in answers}
+        self.fields['answer'].choices = [
+            (answer.pk, answer.text) for answer in answers]
+
+    def clean_answer(self):
+        answer = self._answers[self.cleaned_data['answer']]
+        self.instance.answer_id = answer.pk
+        return answer
 
 
 class ExplanationForm(forms.ModelForm):
@@ -138,3 +156,15 @@ class ExplanationForm(forms.ModelForm):
         widgets = {
             'text': forms.Textarea(attrs={'placeholder': '解説文をここに入力'}),
         }
+
+
+class QuizImportForm(forms.Form):
+    file = forms.FileField(label='ファイル')
+    format = forms.ChoiceField(
+        label='形式',
+        choices=[('', 'ファイル名から判定'), ('json', 'JSON'),
+                 ('jsonl', 'JSON Lines'), ('csv', 'CSV')],
+        required=False)
+    replace = forms.BooleanField(
+        label='既存の問題を削除してから読み込む', required=False,
+        help_text='削除した問題への生徒の回答と、このクイズの受験結果もすべて削除されます')
@@ -0,0 +1,69 @@
+"""
+一覧ページのテンプレート断片キャッシュの版
+
+一覧の表は ``{% cache fragment_timeout 名前 fragment_key %}`` で丸ごとキャッシュし、
+キーには表示する内容の版(スタンプ)を含める。データが変わったら版を消すだけで、
+次の表示では新しい版が作られ、古い断片は読まれないまま期限で消える。
+
+版は次の単位で持つ。
+
+* ``student:<pk>`` 生徒の受験結果・回答・レベル
+* ``teacher:<pk>`` 先生のクイズの受験者数
+* ``catalogue``    クイズ・問題・解説・教科(全員の一覧に出る)
+
+断片と版は ``{% cache %}`` と同じく ``template_fragments`` のキャッシュに置く。
+すべてのプロセスで共有するキャッシュでなければ版を消しても他のプロセスに伝わらないので、
+``FRAGMENT_CACHE_ENABLED`` が偽(``template_fragments`` が無い)なら断片はキャッシュしない。
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import new_content_version
+
+
+FRAGMENT_TIMEOUT = 60 * 60
+
+STAMP_KEY = 'classroom:fragments:{scope}'
+
+CATALOGUE = 'catalogue'
+
+
+def student(pk):
+    return f'student:{pk}'
+
+
+def teacher(pk):
+    return f'teacher:{pk}'
+
+
+def enabled():
+    return getattr(settings, 'FRAGMENT_CACHE_ENABLED', False)
+
+
+def _cache():
+    return caches['template_fragments']
+
+
+def stamps(*scopes):
+    """
+    版をまとめて読み、断片のキーに使う文字列にする。無い版は新しく作る。
+    データを読む前に呼ぶこと(版を消した後のデータで断片を作るため)。
+    """
+    if not enabled():
+        return ''
+    cache = _cache()
+    keys = [STAMP_KEY.format(scope=scope) for scope in scopes]
+    found = cache.get_many(keys)
+    missing = {key: new_content_version() for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        found.update(missing)
+    return '.'.join(found[key] for key in keys)
+
+
+def bump(*scopes):
+    """ コミット後に版を消す(ロールバックされた変更では消さない) """
+    keys = [STAMP_KEY.format(scope=scope) for scope in scopes if scope is not None]
+    if keys and enabled():
+        transaction.on_commit(lambda: _cache().delete_many(keys))
@@ -0,0 +1,243 @@
+"""
+アップロードされた画像の縮小・再圧縮
+
+解説(``Explanation.image``)などの画像は、アップロードされたままだと数MBになる。
+保存がコミットされた後に別スレッドで幅ごとに縮小した WebP とプログレッシブ JPEG を作り、
+内容のハッシュをファイル名にして保存する。ファイル名が内容で決まるので、
+配信時には長期間キャッシュさせてよい(``classroom.views.media``)。
+"""
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+
+
+logger = logging.getLogger(__name__)
+
+# 作る幅(画素)。元の画像より大きくはしない
+VARIANT_WIDTHS = (480, 960)
+
+# 形式 → (Pillowの形式名, MIMEタイプ, 拡張子, 保存のオプション)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'image/webp', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg',
+             {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# 縮小した画像の保存先。この下のファイル名は内容のハッシュ
+VARIANT_DIR = 'variants'
+
+# img の sizes 属性。画面の幅いっぱい、最大で一番大きい幅まで
+VARIANT_SIZES = f'(max-width: {VARIANT_WIDTHS[-1]}px) 100vw, {VARIANT_WIDTHS[-1]}px'
+
+
+def _widths(width):
+    widths = [w for w in VARIANT_WIDTHS if w < width]
+    widths.append(min(width, VARIANT_WIDTHS[-1]))
+    return sorted(set(widths))
+
+
+def _save(data, extension):
+    """ 内容のハッシュを名前にして保存する。同じ内容のファイルは1つだけ """
+    digest = hashlib.sha256(data).hexdigest()
+    name = f'{VARIANT_DIR}/{digest[:2]}/{digest[2:26]}.{extension}'
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(data))
+    return name
+
+
+def build_variants(field_file):
+    """
+    画像を幅ごとに縮小・再圧縮して保存し、次の形の辞書を返す
+    (モデルの ``image_variants`` にそのまま入れる)::
+
+        {'source': 元のファイル名, 'width': 幅, 'height': 高さ,
+         'files': {'webp': [[幅, ファイル名, バイト数], ...], 'jpeg': [...]}}
+    """
+    from PIL import Image, ImageOps
+
+    with field_file.open('rb') as f:
+        image = Image.open(f)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    has_alpha = image.mode in ('RGBA', 'LA') or \
+        (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    if has_alpha:
+        # JPEG は透過できないので白地に合成する
+        opaque = Image.new('RGB', image.size, (255, 255, 255))
+        opaque.paste(image, mask=image.getchannel('A'))
+    else:
+        opaque = image
+
+    width, height = image.size
+    files = {key: [] for key in VARIANT_FORMATS}
+    for target in _widths(width):
+        size = (target, max(round(height * target / width), 1))
+        for key, (format, _, extension, options) in VARIANT_FORMATS.items():
+            source = image if format == 'WEBP' else opaque
+            resized = source.resize(size, Image.LANCZOS) if size != source.size else source
+            buffer = io.BytesIO()
+            resized.save(buffer, format, **options)
+            data = buffer.getvalue()
+            files[key].append([target, _save(data, extension), len(data)])
+
+    return {
+        'source': field_file.name,
+        'width': width,
+        'height': height,
+        'files': files,
+    }
+
+
+def current_variants(instance):
+    """ 今の画像から作った縮小画像の情報。まだ作られていなければ None """
+    variants = instance.image_variants or {}
+    if instance.image and variants.get('source') == instance.image.name:
+        return variants
+    return None
+
+
+def srcset(variants, key):
+    """ ``<img srcset>`` の値 """
+    return ', '.join(
+        f'{default_storage.url(name)} {width}w'
+        for width, name, _ in variants['files'].get(key, ()))
+
+
+def fallback_url(variants):
+    """ srcset に対応していないブラウザ向けの、一番大きい JPEG の URL """
+    return default_storage.url(variants['files']['jpeg'][-1][1])
+
+
+def update_variants(model, pk, name=None, force=False):
+    """
+    インスタンスの画像の縮小画像を作り、``image_variants`` に書き込む。
+
+    ``name`` を渡すと、その画像がまだ使われている場合だけ作る
+    (変換中に別の画像に差し替えられた場合は、そちらの保存で予約された変換に任せる)。
+    """
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not instance.image:
+        return None
+    if name is not None and instance.image.name != name:
+        return None
+    if not force and current_variants(instance) is not None:
+        return instance.image_variants
+
+    variants = build_variants(instance.image)
+    # シグナルが飛ばないよう update で書き込む(post_save の変換の予約を繰り返さない)
+    updated = model.objects.filter(pk=pk, image=instance.image.name) \
+        .update(image_variants=variants)
+    if updated:
+        _invalidate(instance)
+    return variants
+
+
+def _invalidate(instance):
+    # 解説の画像はクイズのスナップショットに含まれる
+    from .models import Explanation
+    from .snapshots import invalidate_quiz
+
+    if isinstance(instance, Explanation):
+        invalidate_quiz(instance.question.quiz_id)
+
+
+def _build_in_background(model, pk, name):
+    try:
+        update_variants(model, pk, name)
+    except Exception:
+        logger.exception('縮小画像を作れませんでした: %s %s', model.__name__, pk)
+    finally:
+        # ワーカースレッドで開いた接続を残さない
+        connection.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """ 画像の変換に使うスレッドプールを返す """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'IMAGE_VARIANT_WORKERS', 1),
+                    thread_name_prefix='image-variants')
+    return _executor
+
+
+def schedule_variants(instance):
+    """
+    コミット後に縮小画像を作るよう予約する。リクエストは変換を待たない。
+    ``IMAGE_VARIANTS_ASYNC`` が偽なら、コミット直後にその場で作る。
+    """
+    model, pk, name = type(instance), instance.pk, instance.image.name
+
+    def run():
+        if getattr(settings, 'IMAGE_VARIANTS_ASYNC', True):
+            get_executor().submit(_build_in_background, model, pk, name)
+        else:
+            update_variants(model, pk, name)
+
+    transaction.on_commit(run)
+
+
+def _referenced(name):
+    """ ファイルをまだ使っている画像があるか。縮小画像は内容が同じなら共有している """
+    from .models import Explanation, Post
+
+    return any(
+        model.objects.filter(image=name).exists()
+        or model.objects.filter(image_variants__icontains=name).exists()
+        for model in (Explanation, Post))
+
+
+def delete_files(images):
+    """
+    削除した行の画像と縮小画像のファイルを消す。
+    ``images`` は (画像のファイル名, ``image_variants``) の組のリスト。
+    """
+    for name, variants in images:
+        names = [name] + [
+            file_name for files in ((variants or {}).get('files') or {}).values()
+            for _, file_name, _ in files]
+        for file_name in names:
+            if file_name and not _referenced(file_name):
+                default_storage.delete(file_name)
+
+
+def _delete_in_background(images):
+    try:
+        delete_files(images)
+    except Exception:
+        logger.exception('画像のファイルを削除できませんでした')
+    finally:
+        connection.close()
+
+
+def schedule_delete(images):
+    """
+    コミット後に画像のファイルを消すよう予約する(ロールバックされた削除では消さない)。
+    ``IMAGE_VARIANTS_ASYNC`` が偽なら、コミット直後にその場で消す。
+    """
+    images = [(name, variants) for name, variants in images if name]
+    if not images:
+        return
+
+    def run():
+        if getattr(settings, 'IMAGE_VARIANTS_ASYNC', True):
+            get_executor().submit(_delete_in_background, images)
+        else:
+            delete_files(images)
+
+    transaction.on_commit(run)
@@ -0,0 +1,203 @@
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import AnswerStat, QuestionStat, StudentAnswer, TakenQuiz
+
+
+def _increment(model, lookup, **amounts):
+    """ lookup に一致する行に amounts を加算する。行がなければ作る """
+    updates = {name: F(name) + value for name, value in amounts.items()}
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **amounts)
+    except IntegrityError:
+        # 同時に作られた場合は、作られた行に加算する
+        model.objects.filter(**lookup).update(**updates)
+
+
+def _increment_rows(model, key, challenge_num, amounts, updates):
+    """
+    ``key`` が ``amounts`` のキーに一致する行に ``updates`` を1回の UPDATE で加算する。
+    行がないものは ``amounts`` の値でまとめて作る
+    """
+    rows = model.objects.filter(**{f'{key}__in': list(amounts)}, challenge_num=challenge_num)
+    existing = set(rows.values_list(key, flat=True))
+    if existing:
+        rows.filter(**{f'{key}__in': list(existing)}).update(**updates)
+    missing = [pk for pk in amounts if pk not in existing]
+    if not missing:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create([
+                model(**{key: pk}, challenge_num=challenge_num, **amounts[pk])
+                for pk in missing])
+    except IntegrityError:
+        # 同時に作られた場合は、1行ずつ加算する
+        for pk in missing:
+            _increment(model, {key: pk, 'challenge_num': challenge_num}, **amounts[pk])
+
+
+def record_attempt(taken_quiz):
+    """
+    受験終了時に、その回の回答を選択肢と問題の集計へまとめて加算する。
+
+    回答のたびに加算すると、同じクイズを受けている生徒全員が同じ集計の行の更新で
+    待ち合わせるので、受験1回につき集計の表ごとに1回の UPDATE にしている。
+    そのため終了していない受験の回答は数えない(``rebuild`` も同じ)。
+    """
+    answered = list(StudentAnswer.objects.filter(
+        student_id=taken_quiz.student_id,
+        challenge_num=taken_quiz.challenge_num,
+        answer__question__quiz_id=taken_quiz.quiz_id)
+        .values_list('answer_id', 'answer__question_id', 'answer__is_correct'))
+    if not answered:
+        return
+
+    challenge_num = taken_quiz.challenge_num
+    _increment_rows(
+        AnswerStat, 'answer_id', challenge_num,
+        {answer_id: {'picks': 1} for answer_id, _, _ in answered},
+        {'picks': F('picks') + 1})
+
+    score = float(taken_quiz.score)
+    correct_ids = [question_id for _, question_id, is_correct in answered if is_correct]
+    _increment_rows(
+        QuestionStat, 'question_id', challenge_num,
+        {question_id: {
+            'responses': 1,
+            'correct': 1 if is_correct else 0,
+            'scored_responses': 1,
+            'scored_correct': 1 if is_correct else 0,
+            'score_sum': score,
+            'score_sq_sum': score * score,
+            'correct_score_sum': score if is_correct else 0.0,
+        } for _, question_id, is_correct in answered},
+        {
+            'responses': F('responses') + 1,
+            'correct': F('correct') + Case(
+                When(question_id__in=correct_ids, then=Value(1)), default=Value(0)),
+            'scored_responses': F('scored_responses') + 1,
+            'scored_correct': F('scored_correct') + Case(
+                When(question_id__in=correct_ids, then=Value(1)), default=Value(0)),
+            'score_sum': F('score_sum') + score,
+            'score_sq_sum': F('score_sq_sum') + score * score,
+            'correct_score_sum': F('correct_score_sum') + Case(
+                When(question_id__in=correct_ids, then=Value(score)),
+                default=Value(0.0)),
+        })
+
+
+def analyse_quiz(snapshot, challenge_num=1):
+    """ ダッシュボード用に、問題ごとの集計と選択肢ごとの選択率を並べる """
+    question_stats = {
+        stat.question_id: stat for stat in QuestionStat.objects.filter(
+            question__quiz_id=snapshot.pk, challenge_num=challenge_num)}
+    picks = dict(AnswerStat.objects.filter(
+        answer__question__quiz_id=snapshot.pk, challenge_num=challenge_num)
+        .values_list('answer_id', 'picks'))
+
+    rows = []
+    for question in snapshot.questions:
+        total = sum(picks.get(answer.pk, 0) for answer in question.answers)
+        rows.append({
+            'question': question,
+            'stat': question_stats.get(question.pk),
+            'answers': [{
+                'answer': answer,
+                'picks': picks.get(answer.pk, 0),
+                'rate': picks.get(answer.pk, 0) / total if total else None,
+            } for answer in question.answers],
+        })
+    return rows
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def rebuild(quiz_ids=None, batch_size=1000):
+    """
+    回答履歴から集計を作り直す。集計は1つのトランザクションで入れ替える。
+    ``record_attempt`` と同じく、受験結果(``TakenQuiz``)のある回の回答だけを数える。
+    作り直している間に終わった受験は二重に数えられるので、利用の少ない時間に実行すること。
+    戻り値は作成した (QuestionStat, AnswerStat) の件数。
+    """
+    attempts = TakenQuiz.objects.filter(
+        student_id=OuterRef('student_id'),
+        quiz_id=OuterRef('answer__question__quiz_id'),
+        challenge_num=OuterRef('challenge_num'))
+    answers = StudentAnswer.objects.filter(Exists(attempts))
+    question_stats = QuestionStat.objects.all()
+    answer_stats = AnswerStat.objects.all()
+    if quiz_ids is not None:
+        answers = answers.filter(answer__question__quiz_id__in=quiz_ids)
+        question_stats = question_stats.filter(question__quiz_id__in=quiz_ids)
+        answer_stats = answer_stats.filter(answer__question__quiz_id__in=quiz_ids)
+
+    with transaction.atomic():
+        question_stats.delete()
+        answer_stats.delete()
+
+        pick_rows = answers.order_by() \
+            .values('answer_id', 'challenge_num') \
+            .annotate(picks=Count('pk')) \
+            .values_list('answer_id', 'challenge_num', 'picks') \
+            .iterator(chunk_size=batch_size)
+        answer_count = 0
+        for batch in _batched(pick_rows, batch_size):
+            AnswerStat.objects.bulk_create([
+                AnswerStat(answer_id=answer_id, challenge_num=challenge_num, picks=picks)
+                for answer_id, challenge_num, picks in batch])
+            answer_count += len(batch)
+
+        # 回答ごとにその回の点数を相関サブクエリで引き、問題ごと・挑戦回ごとの集計まで
+        # データベースで行う(受験の点数をメモリに読み込まない)
+        score = Subquery(attempts.values('score')[:1])
+        correct = Case(When(answer__is_correct=True, then=Value(1)), default=Value(0))
+        totals = answers.order_by() \
+            .annotate(attempt_score=score) \
+            .values('answer__question_id', 'challenge_num') \
+            .annotate(
+                responses=Count('pk'),
+                correct=Sum(correct),
+                scored_responses=Count('attempt_score'),
+                scored_correct=Sum(Case(
+                    When(attempt_score__isnull=False, answer__is_correct=True, then=Value(1)),
+                    default=Value(0))),
+                score_sum=Coalesce(Sum('attempt_score'), 0.0),
+                score_sq_sum=Coalesce(Sum(F('attempt_score') * F('attempt_score')), 0.0),
+                correct_score_sum=Coalesce(Sum(Case(
+                    When(answer__is_correct=True, then=F('attempt_score')),
+                    default=Value(0.0))), 0.0)) \
+            .values_list(
+                'answer__question_id', 'challenge_num', 'responses', 'correct',
+                'scored_responses', 'scored_correct', 'score_sum', 'score_sq_sum',
+                'correct_score_sum') \
+            .iterator(chunk_size=batch_size)
+
+        question_count = 0
+        for batch in _batched(totals, batch_size):
+            QuestionStat.objects.bulk_create([
+                QuestionStat(
+                    question_id=question_id,
+                    challenge_num=challenge_num,
+                    responses=responses,
+                    correct=correct,
+                    scored_responses=scored_responses,
+                    scored_correct=scored_correct,
+                    score_sum=score_sum,
+                    score_sq_sum=score_sq_sum,
+                    correct_score_sum=correct_score_sum)
+                for (question_id, challenge_num, responses, correct, scored_responses,
+                     scored_correct, score_sum, score_sq_sum, correct_score_sum) in batch])
+            question_count += len(batch)
+
+    return question_count, answer_count
@@ -0,0 +1,389 @@
+"""
+生徒の受験の流れの負荷試験
+
+テストクライアントで、アカウント作成(``classroom.home``)→ クイズ一覧 → クイズを最後まで解く
+→ 受験済み一覧 → 間違えた問題の再挑戦、の順にビューを呼び、リクエストごとの
+時間とクエリ数(``classroom.profiling``)を記録する。データは ``classroom.synthetic`` で作る。
+
+テストクライアントはサーバーを通さずに同じスレッドでビューを呼ぶので、ここでの時間は
+ネットワークとWSGIサーバーを除いた、Django の処理時間になる。
+"""
+import http.client
+import random
+import re
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.test import Client
+from django.urls import reverse
+
+from .models import AttemptSummary, TakenQuiz, User
+from .profiling import profile_queries
+
+
+SIGNUP_PASSWORD = 'Kx7#signup-bench'
+
+_ANSWER = re.compile(r'name="answer" value="(\d+)"')
+_CSRF = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+
+class LoadTestError(RuntimeError):
+    """ ビューが想定外の応答を返した。または一度も実行できなかったシナリオがある """
+
+
+# 実行したシナリオの数を数える集計の名前
+FLOWS = ('signup', 'take_quiz:flow', 'retry_quiz:flow')
+
+
+class RequestStats:
+    """ 1種類のリクエストの時間とクエリ数 """
+
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+        self.queries = []
+
+    def record(self, seconds, queries):
+        self.durations.append(seconds)
+        self.queries.append(queries)
+
+    def percentile(self, p):
+        if not self.durations:
+            return None
+        values = sorted(self.durations)
+        return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+    def summary(self):
+        total = sum(self.durations)
+        count = len(self.durations)
+        return {
+            'count': count,
+            'p50_ms': _ms(self.percentile(50)),
+            'p95_ms': _ms(self.percentile(95)),
+            'max_ms': _ms(max(self.durations, default=None)),
+            'queries_mean': round(sum(self.queries) / count, 2) if count else None,
+            'queries_max': max(self.queries, default=None),
+            'throughput_rps': round(count / total, 1) if total else None,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class QuizFlowBenchmark:
+    """
+    合成データの生徒で受験の流れをたどる。
+
+    ``catalogue`` と ``students`` は ``classroom.synthetic`` の ``create_catalogue`` /
+    ``create_students`` の戻り値。選ぶ生徒と選択肢は ``seed`` で決まる。
+    """
+
+    def __init__(self, catalogue, students, host='localhost', seed=0, accuracy=0.6):
+        self.catalogue = {quiz_id: items for quiz_id, _, _, items in catalogue}
+        self.subjects = {quiz_id: subject_id for quiz_id, subject_id, _, _ in catalogue}
+        self.correct = {correct for items in self.catalogue.values()
+                        for _, _, correct, _ in items}
+        self.students = students
+        self.host = host
+        self.rng = random.Random(seed)
+        self.accuracy = accuracy
+        self.stats = {}
+        # アカウント作成のシナリオで作った生徒(受験のシナリオで生徒が足りないときに使う)
+        self.signed_up = []
+        self.started = None
+        self.finished = None
+
+    def client(self, student_id=None):
+        client = Client(HTTP_HOST=self.host)
+        if student_id is not None:
+            client.force_login(User.objects.get(pk=student_id))
+        return client
+
+    def request(self, client, name, method, path, data=None, expect=(200, 302)):
+        with profile_queries() as profile:
+            response = getattr(client, method)(path, data or {})
+        if response.status_code not in expect:
+            raise LoadTestError(f'{method.upper()} {path}: {response.status_code}')
+        self.stats.setdefault(name, RequestStats(name)).record(
+            profile.seconds, profile.count)
+        return response
+
+    def run(self, iterations):
+        """
+        各シナリオを ``iterations`` 回ずつ実行し、集計を返す。
+        受けられるクイズや再挑戦できる問題がない生徒は飛ばして次の生徒で数を満たし、
+        生徒が尽きても一度も実行できなかったシナリオがあれば ``LoadTestError``。
+        """
+        self.started = time.perf_counter()
+        for i in range(iterations):
+            self.signup(i)
+        self._repeat(
+            self.take_quiz,
+            self.rng.sample(self.students, len(self.students)) + self.signed_up, iterations)
+        # 受験のシナリオで間違えた生徒を含め、再挑戦できる生徒から選ぶ
+        retryable = set(AttemptSummary.objects.filter(wrong_count__gt=0)
+                        .values_list('student_id', flat=True))
+        candidates = [student for student in self.students + self.signed_up
+                      if student[0] in retryable]
+        self._repeat(self.retry_quiz, self.rng.sample(candidates, len(candidates)), iterations)
+        self.finished = time.perf_counter()
+
+        missing = [name for name, count in self.flow_counts().items() if count == 0]
+        if missing:
+            raise LoadTestError(f'一度も実行できなかったシナリオがあります: {", ".join(missing)}')
+        return self.summary()
+
+    def _repeat(self, flow, students, iterations):
+        done = 0
+        for student in students:
+            if done >= iterations:
+                break
+            if flow(student):
+                done += 1
+
+    def flow_counts(self):
+        """ シナリオごとの実行した回数 """
+        return {name: len(self.stats[name].durations) if name in self.stats else 0
+                for name in FLOWS}
+
+    def summary(self):
+        seconds = (self.finished or time.perf_counter()) - self.started
+        requests = sum(
+            len(stats.durations) for name, stats in self.stats.items()
+            if not name.endswith(':flow'))
+        return {
+            'seconds': round(seconds, 2),
+            'requests': requests,
+            'throughput_rps': round(requests / seconds, 1) if seconds else None,
+            'flows': self.flow_counts(),
+            'views': {name: stats.summary() for name, stats in self.stats.items()},
+        }
+
+    def signup(self, i):
+        """ トップページからアカウントを作り、クイズ一覧に移るまで """
+        client = self.client()
+        self.request(client, 'home', 'get', reverse('home'))
+        subject_ids = sorted(set(self.subjects.values()))
+        username = f'loadtest-signup-{i:05d}-{self.rng.getrandbits(32):08x}'
+        levels = tuple(self.rng.sample(subject_ids, min(2, len(subject_ids))))
+        response = self.request(client, 'signup', 'post', reverse('home'), {
+            'signup': '',
+            'username': username,
+            'password1': SIGNUP_PASSWORD,
+            'password2': SIGNUP_PASSWORD,
+            'lebel': levels,
+        }, expect=(302,))
+        self.request(client, 'quiz_list', 'get', response.url)
+        self.signed_up.append((User.objects.get(username=username).pk, None, levels))
+
+    def take_quiz(self, student):
+        """
+        クイズ一覧からまだ受けていないクイズを選び、最後の問題まで答える。
+        受けられるクイズがなければ False を返す。
+        """
+        student_id, _, levels = student
+        client = self.client(student_id)
+        self.request(client, 'quiz_list', 'get', reverse('students:quiz_list'))
+
+        taken = set(TakenQuiz.objects.filter(student_id=student_id)
+                    .values_list('quiz_id', flat=True))
+        untaken = [quiz_id for quiz_id, subject_id in self.subjects.items()
+                   if subject_id in levels and quiz_id not in taken]
+        if not untaken:
+            return False
+        quiz_id = self.rng.choice(untaken)
+        url = reverse('students:take_quiz', args=[quiz_id])
+        # 再挑戦のシナリオで解き直せるよう、最初の問題は必ず間違える
+        flow = self._answer_all(client, 'take_quiz', url, reverse('students:quiz_list'),
+                                len(self.catalogue[quiz_id]), wrong_first=True)
+        self.stats.setdefault('take_quiz:flow', RequestStats('take_quiz:flow')).record(*flow)
+        self.request(client, 'taken_quiz_list', 'get', reverse('students:taken_quiz_list'))
+        return True
+
+    def retry_quiz(self, student):
+        """
+        再挑戦一覧から、最後の挑戦で間違えた問題を解き直す。
+        間違えた問題がなければ False を返す。
+        """
+        student_id = student[0]
+        client = self.client(student_id)
+        done_url = reverse('students:retry_quiz_list')
+        self.request(client, 'retry_quiz_list', 'get', done_url)
+
+        summary = AttemptSummary.objects.filter(
+            student_id=student_id, wrong_count__gt=0).order_by('quiz__name').first()
+        if summary is None:
+            return False
+        url = reverse('students:retry_quiz',
+                      args=[summary.quiz_id, summary.latest_challenge_num])
+        flow = self._answer_all(client, 'retry_quiz', url, done_url, summary.wrong_count)
+        self.stats.setdefault('retry_quiz:flow', RequestStats('retry_quiz:flow')).record(*flow)
+        return True
+
+    def _answer_all(self, client, name, url, done_url, questions, wrong_first=False):
+        """ 問題を表示して答えることを、``done_url`` に戻されるまで繰り返す """
+        seconds = 0.0
+        queries = 0
+        for i in range(questions + 1):
+            response = self.request(client, f'{name}:get', 'get', url, expect=(200,))
+            answers = [int(pk) for pk in _ANSWER.findall(response.content.decode())]
+            if not answers:
+                raise LoadTestError(f'{url}: 選択肢が見つかりません')
+            response = self.request(client, f'{name}:post', 'post', url, {
+                'answer': self._choose(answers, wrong=wrong_first and i == 0)},
+                expect=(302,))
+            for stats in (self.stats[f'{name}:get'], self.stats[f'{name}:post']):
+                seconds += stats.durations[-1]
+                queries += stats.queries[-1]
+            if response.url == done_url:
+                return seconds, queries
+        raise LoadTestError(f'{url}: {questions} 問を答えても終わりません')
+
+    def _choose(self, answers, wrong=False):
+        correct = [pk for pk in answers if pk in self.correct]
+        if correct and not wrong and self.rng.random() < self.accuracy:
+            return correct[0]
+        wrong = [pk for pk in answers if pk not in self.correct]
+        return self.rng.choice(wrong or answers)
+
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    # gunicorn などと同じく Nagle を止める(ヘッダーと本文を別に送ると、
+    # 遅延ACKと重なって1往復ごとに数十ミリ秒待たされる)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def live_server(host='127.0.0.1'):
+    """
+    別スレッドでHTTPサーバーを動かし、(ホスト, ポート) を返す。
+    runserver と同じく、接続(keep-alive)ごとにスレッドとデータベースの接続を持つ。
+    """
+    server = ThreadedWSGIServer((host, 0), _QuietRequestHandler, allow_reuse_address=False)
+    server.set_app(WSGIHandler())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_address[:2]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class AnswerSubmissionBenchmark:
+    """
+    生徒ごとに1つのHTTP接続で ``take_quiz`` の表示と回答の送信を繰り返し、
+    同時に受験する人数ごとの回答の送信(POST)の数と時間を記録する。
+
+    テストクライアントと違い、実際のサーバーを通すので、リクエストの終わりに
+    接続を閉じるかどうか(``CONN_MAX_AGE``)や書き込みのロックの待ちも計測に含まれる。
+    """
+
+    def __init__(self, address, catalogue, host='localhost', seed=0):
+        self.address = address
+        self.quiz_ids = [quiz_id for quiz_id, _, _, items in catalogue if items]
+        self.correct = {correct for _, _, _, items in catalogue
+                        for _, _, correct, _ in items}
+        self.host = host
+        self.seed = seed
+
+    def run(self, student_ids, seconds):
+        """ ``student_ids`` の生徒が同時に ``seconds`` 秒受験し、集計を返す """
+        stats = RequestStats('answer')
+        errors = Counter()
+        sessions = {student_id: _session_cookie(student_id) for student_id in student_ids}
+        deadline = time.perf_counter() + seconds
+        threads = [
+            threading.Thread(target=self._student, args=(
+                sessions[student_id], random.Random(f'{self.seed}:{student_id}'),
+                deadline, stats, errors))
+            for student_id in student_ids]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        summary = stats.summary()
+        return {
+            'concurrency': len(student_ids),
+            'answers': summary['count'],
+            'errors': dict(errors),
+            'answers_per_second': round(summary['count'] / elapsed, 1),
+            'p50_ms': summary['p50_ms'],
+            'p95_ms': summary['p95_ms'],
+            'max_ms': summary['max_ms'],
+        }
+
+    def _student(self, session, rng, deadline, stats, errors):
+        conn = http.client.HTTPConnection(*self.address, timeout=60)
+        conn.connect()
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        cookies = {settings.SESSION_COOKIE_NAME: session}
+        try:
+            for quiz_id in rng.sample(self.quiz_ids, len(self.quiz_ids)):
+                url = reverse('students:take_quiz', args=[quiz_id])
+                while time.perf_counter() < deadline:
+                    status, location, body = self._request(conn, cookies, 'GET', url)
+                    if status != 200:
+                        # 受験済みのクイズは一覧に戻される
+                        break
+                    answers = [int(pk) for pk in _ANSWER.findall(body)]
+                    token = _CSRF.search(body)
+                    if not answers or token is None:
+                        errors['no_form'] += 1
+                        break
+                    correct = [pk for pk in answers if pk in self.correct]
+                    answer = correct[0] if correct and rng.random() < 0.6 else rng.choice(answers)
+                    started = time.perf_counter()
+                    status, location, _ = self._request(conn, cookies, 'POST', url, {
+                        'csrfmiddlewaretoken': token.group(1), 'answer': answer})
+                    if status != 302:
+                        errors[str(status)] += 1
+                        break
+                    stats.record(time.perf_counter() - started, 0)
+                    if location != url:
+                        break
+                if time.perf_counter() >= deadline:
+                    return
+        except (OSError, http.client.HTTPException) as e:
+            errors[type(e).__name__] += 1
+        finally:
+            conn.close()
+
+    def _request(self, conn, cookies, method, url, data=None):
+        headers = {
+            'Host': self.host,
+            'Cookie': '; '.join(f'{name}={value}' for name, value in cookies.items()),
+        }
+        body = None
+        if data is not None:
+            body = urlencode(data).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(method, url, body=body, headers=headers)
+        response = conn.getresponse()
+        content = response.read().decode('utf-8', 'replace')
+        for header in response.headers.get_all('Set-Cookie') or ():
+            for name, morsel in SimpleCookie(header).items():
+                cookies[name] = morsel.value
+        return response.status, response.headers.get('Location'), content
+
+
+def _session_cookie(student_id):
+    """ ログイン済みのセッションを作り、そのクッキーの値を返す """
+    client = Client()
+    client.force_login(User.objects.get(pk=student_id))
+    return client.cookies[settings.SESSION_COOKIE_NAME].value
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from classroom import synthetic
+from classroom.loadtest import AnswerSubmissionBenchmark, live_server
+
+
+class Command(BaseCommand):
+    help = ('テスト用のデータベースとHTTPサーバーを立て、同時に受験する生徒の人数ごとに'
+            '回答の送信のスループットと p50/p95 を表示する。'
+            'データベースの設定(DATABASE_PROFILE など)を変えて実行し、結果を比べる')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8, 16],
+                            help='同時に受験する生徒の人数(複数指定可)')
+        parser.add_argument('--seconds', type=float, default=5.0,
+                            help='人数ごとに受験を続ける秒数')
+        parser.add_argument('--quizzes', type=int, default=20)
+        parser.add_argument('--questions', type=int, default=10)
+        parser.add_argument('--background-students', type=int, default=200,
+                            help='受験履歴だけを持つ生徒の人数(テーブルを空にしないため)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+
+    def handle(self, *args, **options):
+        levels = options['concurrency']
+        spec = synthetic.Spec(
+            students=options['background_students'] + sum(levels),
+            quizzes=options['quizzes'], questions=options['questions'],
+            seed=options['seed'])
+
+        # SQLite のテスト用データベースは既定でメモリー上になり、スレッド間の
+        # ロックの振る舞いが変わるので、一時ファイルにする
+        test_file = None
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            fd, test_file = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(fd)
+            connection.settings_dict['TEST']['NAME'] = test_file
+
+        quiet = {name: logging.getLogger(name) for name in (
+            'classroom.profiling', 'django.request', 'django.server')}
+        levels_before = {name: logger.level for name, logger in quiet.items()}
+        for logger in quiet.values():
+            logger.setLevel(logging.CRITICAL)
+
+        databases = setup_databases(verbosity=0, interactive=False)
+        try:
+            catalogue = synthetic.create_catalogue(spec)
+            students = synthetic.create_students(spec)
+            # 計測に使う生徒は履歴なし(どのクイズもこれから受験する)
+            with synthetic.HistoryWriter() as writer:
+                for student in students[:options['background_students']]:
+                    writer.add(student[0], synthetic.student_history(spec, catalogue, student))
+            result = {'database': self.describe(), 'levels': []}
+            with live_server() as address:
+                benchmark = AnswerSubmissionBenchmark(
+                    address, catalogue, host=options['host'], seed=options['seed'])
+                start = options['background_students']
+                for level in levels:
+                    student_ids = [student[0] for student in students[start:start + level]]
+                    start += level
+                    result['levels'].append(benchmark.run(student_ids, options['seconds']))
+        finally:
+            connection.close()
+            teardown_databases(databases, verbosity=0)
+            for name, logger in quiet.items():
+                logger.setLevel(levels_before[name])
+            if test_file:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(test_file + suffix):
+                        os.remove(test_file + suffix)
+
+        if options['json']:
+            self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
+            return
+        database = result['database']
+        self.stdout.write(
+            f"{database['vendor']}  " + '  '.join(
+                f'{name}={value}' for name, value in database.items() if name != 'vendor'))
+        for row in result['levels']:
+            errors = ', '.join(f'{name} {count}' for name, count in row['errors'].items())
+            self.stdout.write(
+                f"  同時 {row['concurrency']:>3} 人  {row['answers_per_second']:>7} 回答/秒"
+                f"  p50={row['p50_ms']}ms  p95={row['p95_ms']}ms"
+                f"  (回答 {row['answers']} 件{'  エラー ' + errors if errors else ''})")
+
+    def describe(self):
+        """ 計測したデータベースの設定 """
+        info = {
+            'vendor': connection.vendor,
+            'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+        }
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                for pragma in ('journal_mode', 'synchronous', 'mmap_size', 'busy_timeout'):
+                    cursor.execute(f'PRAGMA {pragma}')
+                    info[pragma] = cursor.fetchone()[0]
+            info['transaction_mode'] = getattr(connection, 'transaction_mode', None) or 'DEFERRED'
+        elif 'pool' in connection.settings_dict['OPTIONS']:
+            info['pool'] = connection.settings_dict['OPTIONS']['pool']
+        return info
@@ -0,0 +1,89 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from classroom.drowsiness.pipeline import DrowsinessPipeline, run_serial
+from classroom.drowsiness.tracking import compare_with_detection, run_tracking
+
+
+class Command(BaseCommand):
+    help = '動画ファイルで居眠り検知のパイプラインを実行し、FPSと段ごとの遅延を表示する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('video', help='入力する動画ファイル')
+        parser.add_argument('--workers', type=int, default=2,
+                            help='顔検出のワーカープロセス数')
+        parser.add_argument('--queue-size', type=int, default=4)
+        parser.add_argument('--max-frames', type=int)
+        parser.add_argument('--predictor', help='ランドマークのモデル。省略時は設定の値')
+        parser.add_argument('--no-drop', action='store_true',
+                            help='処理が追いつかなくてもフレームを捨てない')
+        parser.add_argument('--serial', action='store_true',
+                            help='比較用に、すべての段を1つのスレッドで実行する')
+        parser.add_argument('--detect-every', type=int,
+                            help='追跡モード。顔検出を行う間隔(フレーム数)')
+        parser.add_argument('--landmark-width', type=int,
+                            help='追跡モードで、ランドマークを求める前に顔の周辺を縮小する幅(画素)')
+        parser.add_argument('--compare', action='store_true',
+                            help='追跡モードと全フレーム検出を比べ、速度と精度を表示する')
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+
+    def handle(self, *args, **options):
+        if options['compare']:
+            return self.compare(options)
+
+        if options['detect_every']:
+            stats = run_tracking(
+                options['video'], detect_every=options['detect_every'],
+                landmark_width=options['landmark_width'],
+                predictor_path=options['predictor'],
+                max_frames=options['max_frames'])
+        elif options['serial']:
+            stats = run_serial(
+                options['video'], predictor_path=options['predictor'],
+                max_frames=options['max_frames'])
+        else:
+            pipeline = DrowsinessPipeline(
+                options['video'],
+                workers=options['workers'],
+                queue_size=options['queue_size'],
+                predictor_path=options['predictor'],
+                drop_frames=not options['no_drop'])
+            stats = pipeline.run(max_frames=options['max_frames'])
+
+        summary = stats.summary()
+        if options['json']:
+            self.stdout.write(json.dumps(summary, ensure_ascii=False))
+            return
+        self.write_summary(summary)
+
+    def compare(self, options):
+        result = compare_with_detection(
+            options['video'], detect_every=options['detect_every'] or 10,
+            landmark_width=options['landmark_width'],
+            predictor_path=options['predictor'],
+            max_frames=options['max_frames'])
+        if options['json']:
+            self.stdout.write(json.dumps(result, ensure_ascii=False))
+            return
+
+        for label, key in (('全フレーム検出', 'baseline'), ('追跡モード', 'tracking')):
+            self.stdout.write(f'{label} (検出 {result[key]["detections"]} 回)')
+            self.write_summary(result[key])
+        self.stdout.write(
+            f"速度 x{result['speedup']}  顔の有無の一致率 {result['face_agreement']}"
+            f"  IoU {result['mean_iou']}  EARの平均絶対誤差 {result['ear_mae']}"
+            f"  居眠り判定 {result['drowsy_events']['baseline']}"
+            f" → {result['drowsy_events']['tracking']} 回")
+
+    def write_summary(self, summary):
+        self.stdout.write(
+            f"{summary['frames_processed']}/{summary['frames_captured']} フレーム"
+            f" (捨てたフレーム {summary['frames_dropped']})"
+            f"  {summary['seconds']}秒  {summary['fps']} FPS"
+            f"  居眠り判定 {summary['drowsy_events']} 回")
+        rows = [('end_to_end', summary['latency'])] + list(summary['stages'].items())
+        for name, stage in rows:
+            self.stdout.write(
+                f"  {name:<10} n={stage['count']:<6}"
+                f" p50={stage['p50_ms']}ms  p95={stage['p95_ms']}ms")
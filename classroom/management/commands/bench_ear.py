@@ -0,0 +1,57 @@
+import timeit
+
+import dlib
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from classroom.drowsiness.scoring import (
+    EYE_POINTS, LEFT_EYE, RIGHT_EYE, eye_aspect_ratio, eye_aspect_ratios,
+    landmarks_ear, landmarks_to_array,
+)
+
+
+def _loop_ear(landmarks):
+    """ 比較用。点ごとのリスト内包とscipyで1つずつ求める従来の方法 """
+    left_eye = [(landmarks.part(i).x, landmarks.part(i).y) for i in LEFT_EYE]
+    right_eye = [(landmarks.part(i).x, landmarks.part(i).y) for i in RIGHT_EYE]
+    return (eye_aspect_ratio(left_eye) + eye_aspect_ratio(right_eye)) / 2.0
+
+
+class Command(BaseCommand):
+    help = 'EARの計算を、従来の方法とNumPyでまとめて求める方法とで比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--faces', type=int, default=1000,
+                            help='1回にまとめて計算する顔(フレーム)の数')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        points = rng.integers(100, 400, size=(options['faces'], 68, 2))
+        shapes = [
+            dlib.full_object_detection(
+                dlib.rectangle(0, 0, 640, 480),
+                [dlib.point(int(x), int(y)) for x, y in face])
+            for face in points]
+
+        expected = np.array([_loop_ear(shape) for shape in shapes])
+        cases = [
+            ('loop (scipy)', lambda: [_loop_ear(shape) for shape in shapes]),
+            ('numpy / face', lambda: [landmarks_ear(shape) for shape in shapes]),
+            ('numpy batch (68点)', lambda: eye_aspect_ratios(
+                np.stack([landmarks_to_array(shape) for shape in shapes]))),
+            ('numpy batch (目12点)', lambda: eye_aspect_ratios(np.stack([
+                landmarks_to_array(shape, EYE_POINTS) for shape in shapes]))),
+            ('numpy batch (配列のみ)', lambda: eye_aspect_ratios(points)),
+        ]
+
+        error = np.abs(eye_aspect_ratios(points) - expected).max()
+        self.stdout.write(f'{len(shapes)} 顔  最大誤差 {error:.2e}')
+        baseline = None
+        for name, func in cases:
+            seconds = min(timeit.repeat(func, number=1, repeat=options['repeat']))
+            per_face = seconds / len(shapes) * 1e6
+            baseline = baseline or per_face
+            self.stdout.write(
+                f'  {name:<20} {per_face:8.2f} µs/顔  x{baseline / per_face:.1f}')
@@ -0,0 +1,129 @@
+import json
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from classroom.storage import ENCODINGS
+
+
+# base.html を継承した、ログインしなくても開けるページ
+DEFAULT_PAGES = ('/', '/accounts/login/', '/accounts/signup/')
+
+_ASSET = re.compile(r'(?:href|src)="([^"]+)"')
+_CSS_URL = re.compile(r'url\(\s*[\'"]?([^\'")]+)[\'"]?\s*\)')
+
+# CSSの @font-face にある古い形式のフォント(woff2 に対応したブラウザは取りに行かない)
+_LEGACY_FONTS = ('.eot', '.woff', '.ttf', '.svg')
+
+
+def _strip(url):
+    return url.split('#', 1)[0].split('?', 1)[0]
+
+
+class Command(BaseCommand):
+    help = ('ページの表示に必要な静的ファイルの転送量を、元のファイルのまま配信した場合と'
+            'ハッシュ付きの名前・圧縮版で配信した場合とで比べる(collectstatic の後に実行する)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='*', default=DEFAULT_PAGES)
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--json', action='store_true')
+
+    def handle(self, *args, **options):
+        if not hasattr(staticfiles_storage, 'hashed_files') or not staticfiles_storage.hashed_files:
+            raise CommandError(
+                'STATIC_PIPELINE=1 にして collectstatic を実行してから計測してください')
+        self.originals = {
+            hashed: original for original, hashed in staticfiles_storage.hashed_files.items()}
+
+        client = Client()
+        results = []
+        for page in options['pages']:
+            response = client.get(page, HTTP_HOST=options['host'])
+            if response.status_code != 200:
+                raise CommandError(f'{page}: {response.status_code}')
+            html = response.content.decode()
+            assets = self._assets(html)
+            rows = [self._measure(name) for name in assets]
+            results.append({
+                'page': page,
+                'html_bytes': len(response.content),
+                'assets': rows,
+                'before_bytes': sum(row['before'] for row in rows),
+                'gzip_bytes': sum(row['gzip'] for row in rows),
+                'after_bytes': sum(row['after'] for row in rows),
+                # 元のファイル名はキャッシュの期限がないので、再訪問のたびに再検証が要る
+                'repeat_requests_before': len(rows),
+                'repeat_requests_after': sum(not row['immutable'] for row in rows),
+            })
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+            return
+
+        for result in results:
+            before, after = result['before_bytes'], result['after_bytes']
+            self.stdout.write(
+                f"{result['page']}  HTML {result['html_bytes']:,} B  "
+                f"静的ファイル {len(result['assets'])} 件")
+            for row in result['assets']:
+                self.stdout.write(
+                    f"  {row['name']:<48} {row['before']:>9,} → {row['after']:>8,} B"
+                    f"{'' if row['immutable'] else '  (ハッシュなし)'}")
+            self.stdout.write(
+                f"  初回 {before:,} B → {after:,} B "
+                f"(gzipのみ {result['gzip_bytes']:,} B、"
+                f"{after / before:.0%})" if before else '  静的ファイルなし')
+            self.stdout.write(
+                f"  再訪問のリクエスト {result['repeat_requests_before']} 件 → "
+                f"{result['repeat_requests_after']} 件")
+
+    def _assets(self, html):
+        """ ページが読み込む静的ファイル(CSSから読まれるフォントなどを含む)のハッシュ付きの名前 """
+        names = []
+        pending = [
+            _strip(url)[len(settings.STATIC_URL):] for url in _ASSET.findall(html)
+            if url.startswith(settings.STATIC_URL)]
+        while pending:
+            name = pending.pop(0)
+            if name in names:
+                continue
+            names.append(name)
+            if name.endswith('.css'):
+                pending.extend(self._css_assets(name))
+        return names
+
+    def _css_assets(self, name):
+        with staticfiles_storage.open(name) as f:
+            css = f.read().decode()
+        urls = [
+            _strip(url) for url in _CSS_URL.findall(css)
+            if not url.startswith(('data:', 'http:', 'https:', '//', '#'))]
+        if any(url.endswith('.woff2') for url in urls):
+            urls = [url for url in urls if not url.endswith(_LEGACY_FONTS)]
+        base = posixpath.dirname(name)
+        return [posixpath.normpath(posixpath.join(base, url)) for url in urls]
+
+    def _measure(self, name):
+        original = self.originals.get(name, name)
+        found = finders.find(original)
+        before = os.path.getsize(found) if found else 0
+
+        path = staticfiles_storage.path(name)
+        sizes = {None: os.path.getsize(path)}
+        for suffix, encoding in ENCODINGS:
+            if os.path.exists(path + suffix):
+                sizes[encoding] = os.path.getsize(path + suffix)
+        return {
+            'name': original,
+            'before': before,
+            'gzip': min(sizes[None], sizes.get('gzip', sizes[None])),
+            'after': min(sizes.values()),
+            'immutable': staticfiles_storage.is_hashed(name),
+        }
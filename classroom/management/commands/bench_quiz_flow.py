@@ -0,0 +1,109 @@
+import json
+import logging
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from classroom import synthetic
+from classroom.loadtest import LoadTestError, QuizFlowBenchmark
+
+
+class Command(BaseCommand):
+    help = ('テスト用のデータベースに合成データを作り、生徒の受験の流れ(アカウント作成・クイズ一覧・'
+            '受験・再挑戦・受験済み一覧)のビューごとの p50/p95 とクエリ数、スループットを表示する')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=50)
+        parser.add_argument('--quizzes', type=int, default=10)
+        parser.add_argument('--questions', type=int, default=10,
+                            help='クイズごとの問題数')
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='シナリオごとに実行する回数(生徒の人数まで)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='テスト用のデータベースを作り直さない(データは毎回作り直す)')
+        parser.add_argument('--baseline',
+                            help='前回の --json の出力。p95 かクエリ数が悪化したら失敗にする')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='--baseline と比べて許す p95 の悪化の割合')
+        parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+
+    def handle(self, *args, **options):
+        spec = synthetic.Spec(
+            students=options['students'], quizzes=options['quizzes'],
+            questions=options['questions'], seed=options['seed'])
+
+        # リクエストごとのログは計測の邪魔になるので止める(集計はこのコマンドが出す)
+        profiler_logger = logging.getLogger('classroom.profiling')
+        level = profiler_logger.level
+        profiler_logger.setLevel(logging.ERROR)
+        databases = setup_databases(
+            verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            if options['keepdb']:
+                call_command('flush', interactive=False, verbosity=0)
+            catalogue, students, counts = synthetic.create_dataset(spec)
+            benchmark = QuizFlowBenchmark(
+                catalogue, students, host=options['host'], seed=options['seed'])
+            try:
+                result = benchmark.run(options['iterations'])
+            except LoadTestError as e:
+                raise CommandError(str(e))
+        finally:
+            teardown_databases(databases, verbosity=0, keepdb=options['keepdb'])
+            profiler_logger.setLevel(level)
+
+        result['dataset'] = {
+            'students': spec.students, 'quizzes': spec.quizzes,
+            'questions': spec.questions, 'seed': spec.seed, **counts}
+
+        regressions = []
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)
+            regressions = compare(baseline, result, options['tolerance'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
+        else:
+            self.write_summary(result)
+        for name, count in result['flows'].items():
+            if count < options['iterations']:
+                self.stderr.write(
+                    f"{name} は {count} 回しか実行できませんでした(指定は {options['iterations']} 回)。"
+                    f"生徒かクイズを増やしてください")
+        if regressions:
+            raise CommandError('\n'.join(['基準より悪化しました'] + regressions))
+
+    def write_summary(self, result):
+        dataset = result['dataset']
+        self.stdout.write(
+            f"生徒 {dataset['students']} 人 × クイズ {dataset['quizzes']} 個 × "
+            f"{dataset['questions']} 問  回答 {dataset['StudentAnswer']:,} 件"
+            f"  受験 {dataset['TakenQuiz']:,} 件")
+        self.stdout.write(
+            f"{result['requests']} リクエスト  {result['seconds']}秒"
+            f"  {result['throughput_rps']} req/s")
+        for name, view in result['views'].items():
+            self.stdout.write(
+                f"  {name:<18} n={view['count']:<5} p50={view['p50_ms']}ms"
+                f"  p95={view['p95_ms']}ms  クエリ {view['queries_mean']}"
+                f" (最大 {view['queries_max']})  {view['throughput_rps']} req/s")
+
+
+def compare(baseline, result, tolerance):
+    """ 基準の結果と比べて、悪化したビューの説明のリストを返す """
+    regressions = []
+    for name, before in baseline.get('views', {}).items():
+        after = result['views'].get(name)
+        if after is None or not before.get('p95_ms'):
+            continue
+        if after['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f"  {name}: p95 {before['p95_ms']}ms → {after['p95_ms']}ms")
+        if after['queries_max'] > before['queries_max']:
+            regressions.append(
+                f"  {name}: クエリ {before['queries_max']} → {after['queries_max']}")
+    return regressions
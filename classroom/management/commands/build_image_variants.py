@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from classroom import images
+from classroom.models import Explanation, Post
+
+
+class Command(BaseCommand):
+    help = '解説・投稿の画像の縮小画像(WebP / JPEG)を作る。既にあるものは作り直さない'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='既にある縮小画像も作り直す')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        built = original_bytes = variant_bytes = 0
+        for model in (Explanation, Post):
+            pks = model.objects.exclude(image='').exclude(image__isnull=True) \
+                .values_list('pk', flat=True)
+            for pk in pks.iterator():
+                try:
+                    variants = images.update_variants(model, pk, force=options['force'])
+                    if not variants:
+                        continue
+                    original_bytes += model.objects.get(pk=pk).image.size
+                except (OSError, ValueError) as e:
+                    # 画像として読めないファイルや、消えたファイル
+                    self.stderr.write(f'{model.__name__} {pk}: {e}')
+                    continue
+                built += 1
+                variant_bytes += variants['files']['webp'][-1][2]
+        ratio = f'{variant_bytes / original_bytes:.0%}' if original_bytes else '-'
+        self.stdout.write(self.style.SUCCESS(
+            f'{built} 件の画像を処理しました。一番大きい WebP は元の画像の {ratio} の大きさです'
+            f' ({time.perf_counter() - started:.1f}秒)'))
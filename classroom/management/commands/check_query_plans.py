@@ -0,0 +1,152 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from classroom import results
+from classroom.models import Quiz, Student, User
+from classroom.views import students, teachers
+
+
+# 件数が少なく、全件走査しても問題ないテーブル
+SMALL_TABLES = {'classroom_subject'}
+
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+def _student_user(pk):
+    user = User(pk=pk, is_student=True)
+    user.student = Student(user_id=pk)
+    return user
+
+
+def _view_queryset(view_class, user, **kwargs):
+    request = RequestFactory().get('/')
+    request.user = user
+    view = view_class()
+    view.setup(request, **kwargs)
+    return view.get_queryset()
+
+
+def _cases(pk):
+    """ (ラベル, クエリを発行する処理, 使われるべきインデックス名) の一覧 """
+    student = Student(user_id=pk)
+    teacher = User(pk=pk, is_teacher=True)
+    quiz = Quiz(pk=pk)
+    return [
+        ('students.QuizListView',
+         lambda: list(_view_queryset(students.QuizListView, _student_user(pk))),
+         None),
+        ('students.TakenQuizListView',
+         lambda: list(_view_queryset(students.TakenQuizListView, _student_user(pk))),
+         None),
+        ('students.RetryQuizListView',
+         lambda: list(_view_queryset(students.RetryQuizListView, _student_user(pk))),
+         None),
+        ('students.take_quiz (taken check)',
+         lambda: student.quizzes.filter(pk=pk).exists(),
+         'takenquiz_student_quiz_idx'),
+        ('students.take_quiz (answered questions)',
+         lambda: list(student.quiz_answers.filter(
+             challenge_num=1, answer__question__quiz=pk)
+             .values_list('answer__question_id', 'answer__is_correct')),
+         'studentanswer_student_idx'),
+        ('students.take_quiz (answered check)',
+         lambda: list(student.quiz_answers.filter(
+             challenge_num=1, answer__question_id=pk)
+             .values_list('answer__is_correct', flat=True)[:1]),
+         'studentanswer_student_idx'),
+        ('students.take_quiz (taken time)',
+         lambda: student.taken_time.filter(quiz=quiz).first(),
+         'takentime_student_quiz_idx'),
+        ('students.retry_quiz (wrong answers)',
+         lambda: list(student.get_latest_wrong_answers(quiz, 1)),
+         'studentanswer_student_idx'),
+        ('students.ExplanationListView (latest answers)',
+         lambda: student.get_latest_answer_ids(pk),
+         'studentanswer_student_idx'),
+        ('snapshots.build_quiz_snapshot (questions)',
+         lambda: list(quiz.questions.order_by('text')),
+         'question_quiz_text_idx'),
+        ('teachers.QuizListView',
+         lambda: list(_view_queryset(teachers.QuizListView, teacher)),
+         None),
+        ('teachers.QuizResultsView (taken quizzes)',
+         lambda: list(quiz.taken_quizzes.select_related(
+             'student__user').order_by('-date')),
+         'takenquiz_quiz_date_idx'),
+        ('teachers.QuizResultsView (score distribution)',
+         lambda: results.score_distribution(quiz.taken_quizzes.all()),
+         'takenquiz_quiz_score_idx'),
+    ]
+
+
+def check_plans(connection, pk=1):
+    """
+    各クエリの実行計画を調べ、(ラベル, SQL, 実行計画, 問題の説明または None) を順に返す。
+    問題は、小さいテーブル以外の全件走査と、想定したインデックスを使っていないこと。
+    """
+    for label, run, expected_index in _cases(pk):
+        with CaptureQueriesContext(connection) as ctx:
+            run()
+
+        for query in ctx.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+
+            scans = [
+                detail for detail in plan
+                if (m := SCAN_RE.match(detail)) and m.group(1) not in SMALL_TABLES
+            ]
+            if scans:
+                problem = 'full scan'
+            elif expected_index is not None and not any(
+                    expected_index in detail for detail in plan):
+                problem = f'{expected_index} not used'
+            else:
+                problem = None
+            yield label, sql, plan, problem
+
+
+class Command(BaseCommand):
+    help = (
+        'ビューが発行する主要なクエリを EXPLAIN QUERY PLAN にかけ、'
+        'テーブルの全件走査や想定したインデックスを使っていないものがあれば'
+        '失敗する(SQLite専用)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument(
+            '--pk', type=int, default=1,
+            help='クエリに使う生徒・先生・クイズの主キー')
+        parser.add_argument(
+            '--verbose-plans', action='store_true',
+            help='問題がないクエリの実行計画も表示する')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor != 'sqlite':
+            raise CommandError('このコマンドは SQLite でのみ実行できます')
+
+        failures = []
+        for label, sql, plan, problem in check_plans(connection, options['pk']):
+            if problem:
+                failures.append(label)
+                self.stdout.write(self.style.ERROR(f'FAIL {label} ({problem})'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'ok   {label}'))
+
+            if problem or options['verbose_plans']:
+                self.stdout.write(f'     {sql}')
+                for detail in plan:
+                    self.stdout.write(f'       {detail}')
+
+        if failures:
+            raise CommandError(
+                '実行計画が劣化しているクエリがあります: ' + ', '.join(failures))
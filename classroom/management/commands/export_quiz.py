@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from classroom import quiz_io
+from classroom.models import Quiz
+
+
+class Command(BaseCommand):
+    help = 'クイズの問題をJSON・JSON Lines・CSVで書き出す(import_quiz で読み込める形式)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('quiz', type=int)
+        parser.add_argument('--format', choices=quiz_io.FORMATS, default='json')
+        parser.add_argument('-o', '--output', help='出力先のファイル。省略時は標準出力')
+
+    def handle(self, *args, **options):
+        try:
+            quiz = Quiz.objects.get(pk=options['quiz'])
+        except Quiz.DoesNotExist:
+            raise CommandError(f'クイズ {options["quiz"]} がありません')
+
+        chunks = quiz_io.STREAMS[options['format']](quiz_io.export_questions(quiz))
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,115 @@
+import dataclasses
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from classroom import item_analysis, synthetic
+from classroom.models import StudentAnswer, User
+
+
+# ワーカープロセスが使う設定と目録(タスクごとに送らないよう、起動時に1回だけ受け取る)
+_worker_spec = None
+_worker_catalogue = None
+
+
+def _init_worker(spec, catalogue):
+    global _worker_spec, _worker_catalogue
+    # spawn で起動したプロセスでは Django の設定が読み込まれていない
+    django.setup()
+    _worker_spec = spec
+    _worker_catalogue = catalogue
+
+
+def _generate(students):
+    return [(student[0], synthetic.student_history(_worker_spec, _worker_catalogue, student))
+            for student in students]
+
+
+def _parse_datetime(value):
+    parsed = datetime.fromisoformat(value)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = ('合成データ(先生1人・クイズ・問題・生徒と、その回答・受験・受験時間の履歴)を大量に作る。'
+            '履歴は複数のプロセスで作り、このプロセスがまとめて保存する。'
+            '同じ種と設定なら、プロセス数にかかわらず同じデータになる')
+
+    def add_arguments(self, parser):
+        # 分布などの設定は synthetic.Spec の項目をそのままオプションにする
+        for field in dataclasses.fields(synthetic.Spec):
+            option = '--' + field.name.replace('_', '-')
+            if field.name == 'now':
+                parser.add_argument(option, type=_parse_datetime,
+                                    help='履歴の日時の基準(ISO 8601)。省略時は現在時刻')
+            else:
+                parser.add_argument(option, type=type(field.default), default=field.default,
+                                    help=f'既定値 {field.default}')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='履歴を作るプロセス数。1ならこのプロセスで作る')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='1つのタスクで履歴を作る生徒の人数')
+        parser.add_argument('--batch-size', type=int, default=20000,
+                            help='1つのトランザクションで保存する行数の目安')
+        parser.add_argument('--rebuild-stats', action='store_true',
+                            help='最後に問題ごとの分析用の集計を作り直す')
+
+    def handle(self, *args, **options):
+        spec = synthetic.Spec(**{
+            field.name: options[field.name] for field in dataclasses.fields(synthetic.Spec)})
+        if spec.now is None:
+            spec.now = timezone.now()
+        if User.objects.filter(username__startswith=f'{spec.prefix}-').exists():
+            raise CommandError(
+                f'{spec.prefix}- で始まるユーザーが既にあります。--prefix を変えてください')
+
+        started = time.perf_counter()
+        catalogue = synthetic.create_catalogue(spec)
+        students = []
+        for start in range(0, spec.students, options['chunk_size']):
+            students.extend(synthetic.create_students(
+                spec, start, min(options['chunk_size'], spec.students - start)))
+        self.stdout.write(
+            f'クイズ {spec.quizzes} 個・生徒 {spec.students} 人を作成しました'
+            f' ({time.perf_counter() - started:.1f}秒)')
+
+        chunks = [students[i:i + options['chunk_size']]
+                  for i in range(0, len(students), options['chunk_size'])]
+        with synthetic.HistoryWriter(batch_size=options['batch_size']) as writer:
+            for done, histories in enumerate(self.generate(spec, catalogue, chunks, options), 1):
+                for student_id, history in histories:
+                    writer.add(student_id, history)
+                if done % 10 == 0 or done == len(chunks):
+                    answers = writer.counts['StudentAnswer'] + len(
+                        writer.pending[StudentAnswer])
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(
+                        f'  {done}/{len(chunks)}  回答 {answers:,} 件'
+                        f'  ({answers / elapsed:,.0f} 件/秒)')
+
+        if options['rebuild_stats']:
+            item_analysis.rebuild(batch_size=options['batch_size'])
+
+        counts = ', '.join(f'{name} {count:,}' for name, count in writer.counts.items())
+        self.stdout.write(self.style.SUCCESS(
+            f'{counts} 件を作成しました ({time.perf_counter() - started:.1f}秒)'))
+
+    def generate(self, spec, catalogue, chunks, options):
+        """ 生徒のかたまりごとの履歴を、かたまりの順に返す """
+        if options['workers'] <= 1:
+            for chunk in chunks:
+                yield [(student[0], synthetic.student_history(spec, catalogue, student))
+                       for student in chunk]
+            return
+        with multiprocessing.Pool(
+                options['workers'], initializer=_init_worker,
+                initargs=(spec, catalogue)) as pool:
+            # imap は順番を保つので、保存する順番(=pk)もプロセス数によらない
+            yield from pool.imap(_generate, chunks)
@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from classroom import quiz_io
+from classroom.models import Quiz, Subject, User
+
+
+class Command(BaseCommand):
+    help = 'JSON・JSON Lines・CSVのファイルから問題をまとめてクイズに追加する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='読み込むファイル')
+        parser.add_argument('--quiz', type=int, help='追加先のクイズ')
+        parser.add_argument('--owner', help='新しく作るクイズの作成者(ユーザー名)')
+        parser.add_argument('--name', help='新しく作るクイズの名前')
+        parser.add_argument('--subject', help='新しく作るクイズの教科名')
+        parser.add_argument('--format', choices=quiz_io.FORMATS,
+                            help='省略時は拡張子から判定')
+        parser.add_argument('--replace', action='store_true',
+                            help='既存の問題を削除してから読み込む')
+        parser.add_argument('--batch-size', type=int, default=quiz_io.IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        quiz = self._quiz(options)
+        format = options['format'] or quiz_io.guess_format(options['path'])
+        started = time.perf_counter()
+        with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+            try:
+                counts = quiz_io.import_questions(
+                    quiz, quiz_io.read_questions(stream, format),
+                    replace=options['replace'], batch_size=options['batch_size'])
+            except quiz_io.QuizImportError as e:
+                raise CommandError(f'{e}(何も保存していません)')
+        self.stdout.write(self.style.SUCCESS(
+            f'クイズ {quiz.pk}「{quiz.name}」に 問題 {counts["questions"]} 件、'
+            f'選択肢 {counts["answers"]} 件、解説 {counts["explanations"]} 件を追加しました'
+            f' ({time.perf_counter() - started:.1f}秒)'))
+
+    def _quiz(self, options):
+        if options['quiz'] is not None:
+            try:
+                return Quiz.objects.get(pk=options['quiz'])
+            except Quiz.DoesNotExist:
+                raise CommandError(f'クイズ {options["quiz"]} がありません')
+
+        if not (options['owner'] and options['name'] and options['subject']):
+            raise CommandError('--quiz か、--owner・--name・--subject を指定してください')
+        try:
+            owner = User.objects.get(username=options['owner'], is_teacher=True)
+        except User.DoesNotExist:
+            raise CommandError(f'先生のユーザー {options["owner"]} がありません')
+        subject = Subject.objects.filter(name=options['subject']).first()
+        if subject is None:
+            raise CommandError(f'教科 {options["subject"]} がありません')
+        return Quiz.objects.create(owner=owner, name=options['name'], subject=subject)
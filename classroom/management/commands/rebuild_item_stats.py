@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from classroom import item_analysis
+
+
+class Command(BaseCommand):
+    help = '回答履歴から問題ごとの分析用の集計(QuestionStat / AnswerStat)を作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--quiz', type=int, action='append', dest='quiz_ids',
+            help='対象のクイズ(複数指定可)。省略時はすべて')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        question_count, answer_count = item_analysis.rebuild(
+            quiz_ids=options['quiz_ids'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'問題 {question_count} 件、選択肢 {answer_count} 件の集計を作成しました'
+            f' ({time.perf_counter() - started:.1f}秒)'))
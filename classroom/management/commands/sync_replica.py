@@ -0,0 +1,44 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from classroom import replicas
+
+
+class Command(BaseCommand):
+    help = ('SQLite のレプリカの代わりのファイル(SQLITE_REPLICA_PATH)に default を複製する。'
+            '--interval を指定すると、その秒数ごとに複製を続ける(レプリケーションの遅れの再現)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            help='複製を繰り返す間隔(秒)。省略時は1回だけ')
+
+    def handle(self, *args, **options):
+        aliases = replicas.replicas()
+        if not aliases:
+            raise CommandError('レプリカが設定されていません(SQLITE_REPLICA_PATH)')
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('SQLite 以外のレプリケーションはデータベース側で設定してください')
+
+        while True:
+            started = time.perf_counter()
+            for alias in aliases:
+                self.copy(connections['default'].settings_dict['NAME'],
+                          connections[alias].settings_dict['NAME'])
+            self.stdout.write(self.style.SUCCESS(
+                f'{", ".join(aliases)} に複製しました ({time.perf_counter() - started:.2f}秒)'))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+
+    def copy(self, source, target):
+        # オンラインバックアップなので、default の読み書きを止めずに一貫した状態を写せる
+        src = sqlite3.connect(source)
+        dst = sqlite3.connect(target)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:48
+
+import classroom.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0006_alter_answer_id_alter_explanation_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='explanation',
+            name='image',
+            field=models.ImageField(blank=True, null=True, upload_to='uploads/explain/', verbose_name='添付ファイル'),
+        ),
+        migrations.AddField(
+            model_name='quiz',
+            name='content_version',
+            field=models.CharField(default=classroom.models.new_content_version, editable=False, max_length=32),
+        ),
+        migrations.CreateModel(
+            name='TakenTime',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('take_start', models.DateTimeField(blank=True, null=True)),
+                ('take_end', models.DateTimeField(blank=True, null=True)),
+                ('quiz', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='taken_time', to='classroom.quiz')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='taken_time', to='classroom.student')),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0007_quiz_content_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttemptSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_score', models.FloatField()),
+                ('latest_challenge_num', models.IntegerField(default=1)),
+                ('latest_score', models.FloatField()),
+                ('wrong_count', models.IntegerField(default=0)),
+                ('explanation_count', models.IntegerField(default=0)),
+                ('duration', models.DurationField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('quiz', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attempt_summaries', to='classroom.quiz')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attempt_summaries', to='classroom.student')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='attemptsummary',
+            constraint=models.UniqueConstraint(fields=('student', 'quiz'), name='unique_attempt_summary'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_attempt_summaries(apps, schema_editor):
+    TakenQuiz = apps.get_model('classroom', 'TakenQuiz')
+    TakenTime = apps.get_model('classroom', 'TakenTime')
+    StudentAnswer = apps.get_model('classroom', 'StudentAnswer')
+    Explanation = apps.get_model('classroom', 'Explanation')
+    AttemptSummary = apps.get_model('classroom', 'AttemptSummary')
+
+    explanation_counts = dict(
+        Explanation.objects.values('question__quiz')
+        .annotate(n=Count('id'))
+        .values_list('question__quiz', 'n'))
+
+    durations = {}
+    for taken_time in TakenTime.objects.order_by('-id'):
+        if taken_time.take_start is not None and taken_time.take_end is not None:
+            durations[(taken_time.student_id, taken_time.quiz_id)] = \
+                taken_time.take_end - taken_time.take_start
+
+    # 生徒・クイズごとに最初の結果と最後の挑戦の結果を集める
+    attempts = {}
+    for taken_quiz in TakenQuiz.objects.order_by('id'):
+        key = (taken_quiz.student_id, taken_quiz.quiz_id)
+        first, latest = attempts.get(key, (taken_quiz, taken_quiz))
+        if taken_quiz.challenge_num >= latest.challenge_num:
+            latest = taken_quiz
+        attempts[key] = (first, latest)
+
+    summaries = []
+    for (student_id, quiz_id), (first, latest) in attempts.items():
+        wrong_count = StudentAnswer.objects.filter(
+            student_id=student_id,
+            challenge_num=latest.challenge_num,
+            answer__question__quiz_id=quiz_id,
+            answer__is_correct=False).count()
+        summaries.append(AttemptSummary(
+            student_id=student_id,
+            quiz_id=quiz_id,
+            first_score=first.score,
+            latest_challenge_num=latest.challenge_num,
+            latest_score=latest.score,
+            wrong_count=wrong_count,
+            explanation_count=explanation_counts.get(quiz_id, 0),
+            duration=durations.get((student_id, quiz_id))))
+
+    AttemptSummary.objects.bulk_create(summaries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0008_attemptsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_attempt_summaries, migrations.RunPython.noop),
+    ]
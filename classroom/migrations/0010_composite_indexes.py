@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0009_backfill_attemptsummary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['quiz', 'text'], name='question_quiz_text_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentanswer',
+            index=models.Index(fields=['student', 'challenge_num', 'answer'], name='studentanswer_student_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='takenquiz',
+            index=models.Index(fields=['student', 'quiz', 'challenge_num'], name='takenquiz_student_quiz_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='takenquiz',
+            index=models.Index(fields=['quiz', '-date'], name='takenquiz_quiz_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='takentime',
+            index=models.Index(fields=['student', 'quiz'], name='takentime_student_quiz_idx'),
+        ),
+    ]
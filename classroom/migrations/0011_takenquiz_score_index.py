@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0010_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='takenquiz',
+            index=models.Index(fields=['quiz', 'score'], name='takenquiz_quiz_score_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-18 05:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0011_takenquiz_score_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('challenge_num', models.IntegerField(default=1)),
+                ('responses', models.IntegerField(default=0)),
+                ('correct', models.IntegerField(default=0)),
+                ('scored_responses', models.IntegerField(default=0)),
+                ('scored_correct', models.IntegerField(default=0)),
+                ('score_sum', models.FloatField(default=0)),
+                ('score_sq_sum', models.FloatField(default=0)),
+                ('correct_score_sum', models.FloatField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='classroom.question')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnswerStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('challenge_num', models.IntegerField(default=1)),
+                ('picks', models.IntegerField(default=0)),
+                ('answer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='classroom.answer')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='questionstat',
+            constraint=models.UniqueConstraint(fields=('question', 'challenge_num'), name='unique_question_stat'),
+        ),
+        migrations.AddConstraint(
+            model_name='answerstat',
+            constraint=models.UniqueConstraint(fields=('answer', 'challenge_num'), name='unique_answer_stat'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 06:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0012_item_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DrowsinessEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('blink', 'まばたき'), ('drowsy', '居眠り')], max_length=10)),
+                ('ear', models.FloatField()),
+                ('occurred_at', models.DateTimeField()),
+                ('quiz', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='drowsiness_events', to='classroom.quiz')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='drowsiness_events', to='classroom.student')),
+                ('taken_time', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='drowsiness_events', to='classroom.takentime')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['quiz', 'occurred_at'], name='drowsiness_quiz_idx'), models.Index(fields=['student', 'occurred_at'], name='drowsiness_student_idx')],
+            },
+        ),
+    ]
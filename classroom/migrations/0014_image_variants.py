@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 06:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classroom', '0013_drowsinessevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='explanation',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -1,5 +1,7 @@
 from django.contrib.auth.mixins import UserPassesTestMixin
 
+from . import fragments, replicas
+
 
 
 class StudentRequiredMixin(UserPassesTestMixin):
@@ -10,4 +12,34 @@ class StudentRequiredMixin(UserPassesTestMixin):
 
 class TeacherRequiredMixin(UserPassesTestMixin):
     def test_func(self):
-        return self.request.user.is_authenticated and self.request.user.is_teacher
\ No newline at end of file
+        return self.request.user.is_authenticated and self.request.user.is_teacher
+
+
+class FragmentCacheMixin:
+    """
+    一覧を ``{% cache fragment_timeout 名前 fragment_key %}`` でキャッシュするビュー。
+    ``fragment_scopes()`` で、表示する内容の版の単位(``classroom.fragments``)を返す。
+    断片キャッシュが無効なら期限を0にして、毎回描画する。
+    """
+
+    def fragment_scopes(self):
+        raise NotImplementedError
+
+    def get_context_data(self, **kwargs):
+        kwargs['fragment_key'] = fragments.stamps(*self.fragment_scopes())
+        kwargs['fragment_timeout'] = fragments.FRAGMENT_TIMEOUT if fragments.enabled() else 0
+        return super().get_context_data(**kwargs)
+
+
+class ReplicaReadMixin:
+    """
+    読み込みをレプリカに送るビュー(``classroom.replicas``)。書き込まないビューにだけ使う。
+    テンプレートが一覧を読むのは描画のときなので、描画までをレプリカからの読み込みにする。
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with replicas.reading():
+            response = super().dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        return response
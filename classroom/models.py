@@ -1,3 +1,6 @@
+import uuid
+from functools import lru_cache
+
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.db.models.query import QuerySet
@@ -18,11 +21,19 @@ class Subject(models.Model):
         return self.name
 
     def get_html_badge(self):
-        name = escape(self.name)
-        color = escape(self.color)
-        html = '<span class="badge badge-primary" style="background-color: %s">%s</span>' % (
-            color, name)
-        return mark_safe(html)
+        return _html_badge(self.name, self.color)
+
+
+@lru_cache(maxsize=1024)
+def _html_badge(name, color):
+    """ 教科の名前と色ごとにバッジのHTMLを作っておく(一覧では行ごとに呼ばれる) """
+    html = '<span class="badge badge-primary" style="background-color: %s">%s</span>' % (
+        escape(color), escape(name))
+    return mark_safe(html)
+
+
+def new_content_version():
+    return uuid.uuid4().hex
 
 
 class Quiz(models.Model):
@@ -31,6 +42,9 @@ class Quiz(models.Model):
     name = models.CharField(max_length=255)
     subject = models.ForeignKey(
         Subject, on_delete=models.CASCADE, related_name='quizzes')
+    # 問題・選択肢・解説が変わるたびに更新される版(スナップショットのキーに使う)
+    content_version = models.CharField(
+        max_length=32, default=new_content_version, editable=False)
 
     def __str__(self):
         return self.name
@@ -41,6 +55,12 @@ class Question(models.Model):
         Quiz, on_delete=models.CASCADE, related_name='questions')
     text = models.CharField('Question', max_length=255)
 
+    class Meta:
+        indexes = [
+            # 出題順(text)に並べた問題一覧
+            models.Index(fields=['quiz', 'text'], name='question_quiz_text_idx'),
+        ]
+
     def __str__(self):
         return self.text
 
@@ -69,6 +89,17 @@ class Student(models.Model):
             pk__in=answered_questions).order_by('text')
         return questions
 
+    def get_latest_answer_ids(self, quiz) -> dict:
+        # 問題ごとに最後の挑戦(challenge_numが最大)で選んだ解答のIDを1回のクエリで集める
+        latest = {}
+        answers = self.quiz_answers \
+            .filter(answer__question__quiz=quiz) \
+            .order_by('challenge_num', 'pk') \
+            .values_list('answer__question_id', 'answer_id')
+        for question_id, answer_id in answers:
+            latest[question_id] = answer_id
+        return latest
+
     def get_latest_wrong_answers(self, quiz, challenge_num) -> 'QuerySet[StudentAnswer]':
         # 最後に挑戦した問題のうち間違えた問題のみを抽出する
         return self.quiz_answers.filter(
@@ -80,6 +111,22 @@ class Student(models.Model):
         return self.user.username
 
 
+class TakenQuizQuerySet(models.QuerySet):
+    def with_taken_time(self):
+        """ かかった時間(taken_duration)をサブクエリで付与する """
+        duration = TakenTime.objects.filter(
+            student=models.OuterRef('student'),
+            quiz=models.OuterRef('quiz'),
+            take_start__isnull=False,
+            take_end__isnull=False) \
+            .order_by('pk') \
+            .annotate(duration=models.ExpressionWrapper(
+                models.F('take_end') - models.F('take_start'),
+                output_field=models.DurationField())) \
+            .values('duration')[:1]
+        return self.annotate(taken_duration=models.Subquery(duration))
+
+
 class TakenQuiz(models.Model):
     challenge_num = models.IntegerField(default=1)
     student = models.ForeignKey(
@@ -89,18 +136,35 @@ class TakenQuiz(models.Model):
     score = models.FloatField()
     date = models.DateTimeField(auto_now_add=True)
 
+    objects = TakenQuizQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['student', 'quiz', 'challenge_num'],
+                name='takenquiz_student_quiz_idx'),
+            # 先生の結果一覧(新しい順)
+            models.Index(fields=['quiz', '-date'], name='takenquiz_quiz_date_idx'),
+            # 先生の結果一覧の点数順の並び替えと、点数分布の集計
+            models.Index(fields=['quiz', 'score'], name='takenquiz_quiz_score_idx'),
+        ]
+
     @property
     def taken_time(self):
-        """ 問題を解くのにかかった時間 """
-        try:
-            taken_time = TakenTime.objects.get(
-                student=self.student, quiz=self.quiz)
-            if taken_time.take_end is not None and taken_time.take_start is not None:
-                return taken_time.take_end - taken_time.take_start
-            else:
-                return None
-        except TakenTime.DoesNotExist:
+        """
+        問題を解くのにかかった時間
+        一覧で使う場合は ``with_taken_time()`` で付与しておくと行ごとのクエリが出ない
+        """
+        if 'taken_duration' in self.__dict__:
+            return self.taken_duration
+
+        taken_time = TakenTime.objects.filter(
+            student_id=self.student_id, quiz_id=self.quiz_id).order_by('pk').first()
+        if taken_time is None:
             return None
+        if taken_time.take_end is not None and taken_time.take_start is not None:
+            return taken_time.take_end - taken_time.take_start
+        return None
 
 
 class StudentAnswer(models.Model):
@@ -110,6 +174,14 @@ class StudentAnswer(models.Model):
     answer = models.ForeignKey(
         Answer, on_delete=models.CASCADE, related_name='+')
 
+    class Meta:
+        indexes = [
+            # 挑戦回ごとの回答の絞り込み。answerまで含めて問題・クイズへの結合に使う
+            models.Index(
+                fields=['student', 'challenge_num', 'answer'],
+                name='studentanswer_student_idx'),
+        ]
+
 
 class TakenTime(models.Model):
     take_start = models.DateTimeField(null=True, blank=True)
@@ -119,6 +191,154 @@ class TakenTime(models.Model):
     quiz = models.ForeignKey(
         Quiz, on_delete=models.CASCADE, related_name='taken_time')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['student', 'quiz'], name='takentime_student_quiz_idx'),
+        ]
+
+
+class AttemptSummary(models.Model):
+    """
+    生徒ごと・クイズごとの受験結果の集計。
+    受験済み一覧と再挑戦一覧はこのテーブルだけを読めばよいように、
+    take_quiz / retry_quiz の終了時に同じトランザクションで更新する。
+    """
+    student = models.ForeignKey(
+        Student, on_delete=models.CASCADE, related_name='attempt_summaries')
+    quiz = models.ForeignKey(
+        Quiz, on_delete=models.CASCADE, related_name='attempt_summaries')
+    first_score = models.FloatField()
+    latest_challenge_num = models.IntegerField(default=1)
+    latest_score = models.FloatField()
+    # 最後の挑戦で間違えた問題数
+    wrong_count = models.IntegerField(default=0)
+    explanation_count = models.IntegerField(default=0)
+    duration = models.DurationField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['student', 'quiz'], name='unique_attempt_summary'),
+        ]
+
+    @classmethod
+    def record(cls, taken_quiz, wrong_count, explanation_count, duration=None):
+        """ 受験結果を集計に反映する。呼び出し側のトランザクション内で使うこと """
+        summary, created = cls.objects.select_for_update().get_or_create(
+            student_id=taken_quiz.student_id,
+            quiz_id=taken_quiz.quiz_id,
+            defaults={
+                'first_score': taken_quiz.score,
+                'latest_challenge_num': taken_quiz.challenge_num,
+                'latest_score': taken_quiz.score,
+                'wrong_count': wrong_count,
+                'explanation_count': explanation_count,
+                'duration': duration,
+            })
+        if not created and taken_quiz.challenge_num >= summary.latest_challenge_num:
+            summary.latest_challenge_num = taken_quiz.challenge_num
+            summary.latest_score = taken_quiz.score
+            summary.wrong_count = wrong_count
+            summary.explanation_count = explanation_count
+            if duration is not None:
+                summary.duration = duration
+            summary.save()
+        return summary
+
+
+class QuestionStat(models.Model):
+    """
+    問題ごと・挑戦回ごとの項目分析用の集計(回答のたびに加算していく)
+
+    score_* は受験終了時に、その回の点数で加算する。正答した人と誤答した人の
+    点数の平均の差から識別力(点双列相関)を求めるのに使う。
+    """
+    question = models.ForeignKey(
+        Question, on_delete=models.CASCADE, related_name='stats')
+    challenge_num = models.IntegerField(default=1)
+    responses = models.IntegerField(default=0)
+    correct = models.IntegerField(default=0)
+    scored_responses = models.IntegerField(default=0)
+    scored_correct = models.IntegerField(default=0)
+    score_sum = models.FloatField(default=0)
+    score_sq_sum = models.FloatField(default=0)
+    correct_score_sum = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['question', 'challenge_num'], name='unique_question_stat'),
+        ]
+
+    @property
+    def p_value(self):
+        """ 正答率(難易度) """
+        if self.responses == 0:
+            return None
+        return self.correct / self.responses
+
+    @property
+    def discrimination(self):
+        """ 識別力。設問の正誤と点数の点双列相関 """
+        n = self.scored_responses
+        k = self.scored_correct
+        if n == 0 or k == 0 or k == n:
+            return None
+        mean = self.score_sum / n
+        variance = self.score_sq_sum / n - mean * mean
+        if variance <= 0:
+            return None
+        correct_mean = self.correct_score_sum / k
+        wrong_mean = (self.score_sum - self.correct_score_sum) / (n - k)
+        p = k / n
+        return (correct_mean - wrong_mean) / variance ** 0.5 * (p * (1 - p)) ** 0.5
+
+
+class AnswerStat(models.Model):
+    """ 選択肢ごと・挑戦回ごとに選ばれた回数 """
+    answer = models.ForeignKey(
+        Answer, on_delete=models.CASCADE, related_name='stats')
+    challenge_num = models.IntegerField(default=1)
+    picks = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['answer', 'challenge_num'], name='unique_answer_stat'),
+        ]
+
+
+class DrowsinessEvent(models.Model):
+    """
+    受験中の生徒について検知したまばたき・居眠り。
+    フレームごとに保存せず、``drowsiness.recorder.EventRecorder`` でまとめて追加する。
+    """
+    BLINK = 'blink'
+    DROWSY = 'drowsy'
+    KIND_CHOICES = (
+        (BLINK, 'まばたき'),
+        (DROWSY, '居眠り'),
+    )
+
+    student = models.ForeignKey(
+        Student, on_delete=models.CASCADE, related_name='drowsiness_events')
+    quiz = models.ForeignKey(
+        Quiz, on_delete=models.CASCADE, related_name='drowsiness_events',
+        null=True, blank=True)
+    taken_time = models.ForeignKey(
+        TakenTime, on_delete=models.SET_NULL, related_name='drowsiness_events',
+        null=True, blank=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    ear = models.FloatField()
+    occurred_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['quiz', 'occurred_at'], name='drowsiness_quiz_idx'),
+            models.Index(fields=['student', 'occurred_at'], name='drowsiness_student_idx'),
+        ]
+
 
 class Explanation(models.Model):
     """ 設問の解説 """
@@ -131,6 +351,8 @@ class Explanation(models.Model):
         null=True,
         blank=True
     )
+    # 縮小・再圧縮した画像の情報(classroom.images.build_variants の戻り値)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
 
 
 class Post(models.Model):
@@ -139,6 +361,7 @@ class Post(models.Model):
     title = models.CharField("タイトル", max_length=200)
     image = models.ImageField(
         upload_to='images', verbose_name='イメージ画像', null=True, blank=True)  # 追加
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     content = models.TextField("本文")
 
     def __str__(self):
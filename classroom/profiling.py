@@ -0,0 +1,257 @@
+"""
+リクエストごとのクエリのプロファイラ
+
+``connection.execute_wrapper`` でそのリクエストが発行したクエリを数え、
+SQLの合計時間、同じ形のクエリの繰り返し(N+1の疑い)、テンプレートの描画時間を
+``Server-Timing`` ヘッダーと構造化ログ(1行のJSON)に出す。
+
+ビューごとのクエリ数の上限(予算)は ``@query_budget(n)`` か、クラスベースのビューの
+``query_budget`` 属性で指定する。上限を超えると警告を出し、``QUERY_BUDGET_RAISE`` が
+真なら ``QueryBudgetExceeded`` を送出する。テストでは ``max_queries(n)`` も使える。
+"""
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+# 同じ形のクエリがこの回数以上あれば、N+1 の疑いとして警告する
+DUPLICATE_THRESHOLD = 5
+
+_current = ContextVar('classroom_query_profile', default=None)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|\?')
+_IN_LIST = re.compile(r'\bIN \(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """ 値と IN の要素数を除いたクエリの形。N+1 の検出に使う """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """ ビューのクエリ数が予算を超えた """
+
+
+class QueryProfile:
+    """ 1つのリクエスト(または ``profile_queries`` のブロック)で発行したクエリの記録 """
+
+    def __init__(self):
+        self.count = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.fingerprints = Counter()
+        self.exact = Counter()
+        self.started = time.perf_counter()
+        self.finished = None
+        self._rendering = False
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_seconds += time.perf_counter() - started
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+            self.exact[(sql, repr(params))] += 1
+
+    @property
+    def seconds(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def duplicates(self):
+        """ 2回以上発行された形のクエリ [(形, 回数)]。多い順 """
+        return [(sql, n) for sql, n in self.fingerprints.most_common() if n > 1]
+
+    @property
+    def exact_duplicates(self):
+        """ SQLもパラメータも同じクエリの、余分に発行された数 """
+        return sum(n - 1 for n in self.exact.values())
+
+    def suspected_n_plus_one(self, threshold=None):
+        threshold = threshold or getattr(
+            settings, 'QUERY_PROFILER_DUPLICATE_THRESHOLD', DUPLICATE_THRESHOLD)
+        return [(sql, n) for sql, n in self.duplicates if n >= threshold]
+
+    def server_timing(self):
+        """ ``Server-Timing`` ヘッダーの値 """
+        return ', '.join([
+            f'db;dur={self.sql_seconds * 1000:.1f};desc="{self.count} queries"',
+            f'dup;desc="{sum(n - 1 for _, n in self.duplicates)} repeated"',
+            f'tmpl;dur={self.template_seconds * 1000:.1f}',
+            f'total;dur={self.seconds * 1000:.1f}',
+        ])
+
+    def as_dict(self, top=5):
+        return {
+            'queries': self.count,
+            'sql_ms': round(self.sql_seconds * 1000, 2),
+            'template_ms': round(self.template_seconds * 1000, 2),
+            'total_ms': round(self.seconds * 1000, 2),
+            'exact_duplicates': self.exact_duplicates,
+            'duplicates': [
+                {'sql': sql, 'count': n} for sql, n in self.duplicates[:top]],
+        }
+
+
+_templates_lock = threading.Lock()
+_templates_users = 0
+_original_render = None
+
+
+@contextmanager
+def _instrument_templates():
+    """
+    テンプレートの描画時間を数えるよう、プロファイル中だけテンプレートエンジンの render を包む。
+    最初のプロファイルの開始で包み、最後のプロファイルの終了で元に戻す
+    (その間に描画する別のスレッドのテンプレートは、そのまま呼ぶだけ)。
+    """
+    global _templates_users, _original_render
+    from django.template.backends.django import Template
+
+    with _templates_lock:
+        if _templates_users == 0:
+            _original_render = render = Template.render
+
+            @functools.wraps(render)
+            def profiled_render(self, context=None, request=None):
+                profile = _current.get()
+                # render_to_string を使うタグなどの入れ子の描画は外側の時間に含まれる
+                if profile is None or profile._rendering:
+                    return render(self, context, request)
+                profile._rendering = True
+                started = time.perf_counter()
+                try:
+                    return render(self, context, request)
+                finally:
+                    profile.template_seconds += time.perf_counter() - started
+                    profile._rendering = False
+
+            Template.render = profiled_render
+        _templates_users += 1
+    try:
+        yield
+    finally:
+        with _templates_lock:
+            _templates_users -= 1
+            if _templates_users == 0:
+                Template.render = _original_render
+                _original_render = None
+
+
+@contextmanager
+def profile_queries():
+    """ ブロック内で(このスレッドの)すべてのデータベースに発行したクエリを記録する """
+    profile = QueryProfile()
+    token = _current.set(profile)
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(_instrument_templates())
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile))
+            yield profile
+    finally:
+        profile.finished = time.perf_counter()
+        _current.reset(token)
+
+
+@contextmanager
+def max_queries(budget):
+    """
+    テスト用。ブロック内のクエリが ``budget`` 件を超えたら ``QueryBudgetExceeded``。
+    メッセージには繰り返されたクエリを含める。
+    """
+    with profile_queries() as profile:
+        yield profile
+    if profile.count > budget:
+        raise QueryBudgetExceeded(_budget_message(profile, budget))
+
+
+def _budget_message(profile, budget, view=None):
+    lines = [f'{view or "block"}: {profile.count} queries (budget {budget})']
+    lines += [f'  {n}x {sql}' for sql, n in profile.duplicates[:5]]
+    return '\n'.join(lines)
+
+
+def query_budget(budget):
+    """ 関数ビューのクエリ数の予算を指定するデコレーター """
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def _view_budget(view_func):
+    budget = getattr(view_func, 'query_budget', None)
+    view_class = getattr(view_func, 'view_class', None)
+    if budget is None and view_class is not None:
+        budget = getattr(view_class, 'query_budget', None)
+    return budget
+
+
+class QueryProfilerMiddleware:
+    """
+    リクエストごとにクエリを記録し、``Server-Timing`` ヘッダーとログに出す。
+    予算を超えたリクエストと N+1 の疑いがあるリクエストは WARNING、それ以外は DEBUG で出す。
+
+    ストリーミングのレスポンス(SSE・エクスポート)は、本文を返し始めるまでの分だけを数える。
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.query_budget = getattr(settings, 'QUERY_BUDGET', None)
+        with profile_queries() as profile:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else None
+        response['Server-Timing'] = profile.server_timing()
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            **profile.as_dict(),
+        }
+        budget = request.query_budget
+        over_budget = budget is not None and profile.count > budget
+        suspects = profile.suspected_n_plus_one()
+        if over_budget:
+            record['budget'] = budget
+        if suspects:
+            record['n_plus_one'] = [sql for sql, _ in suspects]
+        level = logging.WARNING if over_budget or suspects else logging.DEBUG
+        if logger.isEnabledFor(level):
+            logger.log(level, json.dumps(record, ensure_ascii=False))
+
+        if over_budget and getattr(settings, 'QUERY_BUDGET_RAISE', False):
+            raise QueryBudgetExceeded(_budget_message(profile, budget, view))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budget = _view_budget(view_func)
+        if budget is not None:
+            request.query_budget = budget
+        return None
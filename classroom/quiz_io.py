@@ -0,0 +1,359 @@
+"""
+クイズの問題の一括インポート・エクスポート
+
+1問は ``{"text": 問題文, "answers": [{"text": 選択肢, "is_correct": 正解か}, ...],
+"explanation": 解説文}`` の形で表す。ファイルの形式は次の3つ。
+
+* json  : 問題の配列
+* jsonl : 1行に1問
+* csv   : 1行に1つの選択肢。列は question, answer, is_correct, explanation で、
+          同じ問題文が続く行を1問にまとめる(解説は最初に書かれたものを使う)
+
+読み込みはファイルを少しずつ読みながら1問ずつ取り出し、``batch_size`` 問ごとに
+``bulk_create`` する。全体を1つのトランザクションで行うので、途中に不正な問題が
+あれば何も保存されない。
+"""
+import csv
+import json
+import re
+from itertools import islice
+
+from django.db import connection, transaction
+
+from . import fragments, images
+from .models import (Answer, AnswerStat, AttemptSummary, DrowsinessEvent, Explanation,
+                     Question, QuestionStat, StudentAnswer, TakenQuiz, TakenTime)
+from .signals import refresh_explanation_count
+from .snapshots import invalidate_quiz
+
+
+FORMATS = ('json', 'jsonl', 'csv')
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+CSV_COLUMNS = ('question', 'answer', 'is_correct', 'explanation')
+
+IMPORT_BATCH_SIZE = 500
+
+EXPORT_CHUNK_SIZE = 500
+
+TEXT_MAX_LENGTH = 255
+
+# 1問の選択肢の数(問題の編集画面の選択肢のフォームセットの min_num / max_num と同じ)
+MIN_ANSWERS = 2
+MAX_ANSWERS = 10
+
+_TRUE_VALUES = {'1', 'true', 'yes', 'y', 't', '○', '正解'}
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+class QuizImportError(Exception):
+    """ 読み込めない、または保存できない問題があった """
+
+    def __init__(self, position, message):
+        self.position = position
+        super().__init__(f'{position}問目: {message}' if position else message)
+
+
+def guess_format(filename, default='json'):
+    """ ファイル名の拡張子から形式を決める """
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if extension == 'ndjson':
+        return 'jsonl'
+    return extension if extension in FORMATS else default
+
+
+# ---- 読み込み ----
+
+def _iter_json_array(stream, chunk_size=64 * 1024):
+    """ 問題の配列を、全体を読み込まずに先頭から1要素ずつ取り出す """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = '', 0, False
+    state = 'start'
+    position = 0
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer) and not eof:
+            chunk = stream.read(chunk_size)
+            buffer, pos = buffer[pos:] + chunk, 0
+            eof = not chunk
+            continue
+        if pos == len(buffer):
+            raise QuizImportError(0, 'JSONの配列が閉じていません')
+
+        char = buffer[pos]
+        if state == 'start':
+            if char != '[':
+                raise QuizImportError(0, 'JSONは問題の配列にしてください')
+            pos += 1
+            state = 'first'
+            continue
+        if char == ']' and state in ('first', 'next'):
+            return
+        if state == 'next':
+            if char != ',':
+                raise QuizImportError(position, 'JSONの要素の区切りが正しくありません')
+            pos += 1
+            state = 'value'
+            continue
+
+        try:
+            value, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise QuizImportError(position + 1, f'JSONを読み込めません({e.msg})')
+            # 要素が読み込んだ範囲の外まで続いている
+            chunk = stream.read(chunk_size)
+            buffer, pos = buffer[pos:] + chunk, 0
+            eof = not chunk
+            continue
+        position += 1
+        yield value
+        state = 'next'
+
+
+def _iter_jsonl(stream):
+    position = 0
+    for line in stream:
+        if not line.strip():
+            continue
+        position += 1
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise QuizImportError(position, f'JSONを読み込めません({e.msg})')
+
+
+def _parse_bool(value):
+    return str(value).strip().lower() in _TRUE_VALUES
+
+
+def _iter_csv(stream):
+    reader = csv.DictReader(stream)
+    missing = {'question', 'answer'} - set(reader.fieldnames or ())
+    if missing:
+        raise QuizImportError(0, f'CSVに {", ".join(sorted(missing))} の列がありません')
+
+    record = None
+    for row in reader:
+        text = (row.get('question') or '').strip()
+        if record is None or text != record['text']:
+            if record is not None:
+                yield record
+            record = {'text': text, 'answers': [], 'explanation': ''}
+        answer = (row.get('answer') or '').strip()
+        if answer:
+            record['answers'].append({
+                'text': answer, 'is_correct': _parse_bool(row.get('is_correct'))})
+        explanation = (row.get('explanation') or '').strip()
+        if explanation and not record['explanation']:
+            record['explanation'] = explanation
+    if record is not None:
+        yield record
+
+
+def _clean(position, data):
+    """ 1問分のデータを検証し、(問題文, [(選択肢, 正解か)], 解説文) にする """
+    if not isinstance(data, dict):
+        raise QuizImportError(position, '問題はオブジェクトで指定してください')
+
+    text = str(data.get('text') or '').strip()
+    if not text:
+        raise QuizImportError(position, '問題文がありません')
+    if len(text) > TEXT_MAX_LENGTH:
+        raise QuizImportError(position, f'問題文は{TEXT_MAX_LENGTH}文字以内にしてください')
+
+    answers = []
+    for answer in data.get('answers') or ():
+        if isinstance(answer, dict):
+            answer_text = str(answer.get('text') or '').strip()
+            is_correct = answer.get('is_correct', False)
+            if not isinstance(is_correct, bool):
+                is_correct = _parse_bool(is_correct)
+        else:
+            answer_text, is_correct = str(answer).strip(), False
+        if not answer_text:
+            raise QuizImportError(position, '選択肢が空です')
+        if len(answer_text) > TEXT_MAX_LENGTH:
+            raise QuizImportError(position, f'選択肢は{TEXT_MAX_LENGTH}文字以内にしてください')
+        answers.append((answer_text, is_correct))
+    if not MIN_ANSWERS <= len(answers) <= MAX_ANSWERS:
+        raise QuizImportError(
+            position, f'選択肢は{MIN_ANSWERS}〜{MAX_ANSWERS}個にしてください')
+    if not any(is_correct for _, is_correct in answers):
+        raise QuizImportError(position, '最低でも答えを1つ選んでください')
+
+    explanation = str(data.get('explanation') or '').strip()
+    return text, answers, explanation
+
+
+def read_questions(stream, format):
+    """ テキストのストリームから、検証済みの問題を1問ずつ取り出す """
+    if format == 'json':
+        records = _iter_json_array(stream)
+    elif format == 'jsonl':
+        records = _iter_jsonl(stream)
+    elif format == 'csv':
+        records = _iter_csv(stream)
+    else:
+        raise QuizImportError(0, f'対応していない形式です: {format}')
+    for position, data in enumerate(records, 1):
+        yield _clean(position, data)
+
+
+def _delete_questions(quiz):
+    """
+    クイズの問題を、参照している行ごとシグナルを飛ばさずに削除する。
+
+    ``QuerySet.delete()`` は削除する行ごとに post_delete を送り、そのたびにクイズの版を
+    更新するので、問題が多いと数千回のクエリになる。参照している表から順に
+    1回ずつ DELETE し、版と解説の数は呼び出し側でまとめて更新する。
+    受験結果(``TakenQuiz`` / ``TakenTime`` / ``AttemptSummary``)は消した回答から
+    求めたものなので、あわせて消す。解説の画像のファイルはコミット後に消す。
+    戻り値は削除した (生徒の回答, 受験結果) の件数。
+    """
+    table = connection.ops.quote_name
+    questions = f'SELECT id FROM {table(Question._meta.db_table)} WHERE quiz_id = %s'
+    answers = f'SELECT id FROM {table(Answer._meta.db_table)} WHERE question_id IN ({questions})'
+    statements = [
+        (StudentAnswer, f'answer_id IN ({answers})'),
+        (AnswerStat, f'answer_id IN ({answers})'),
+        (QuestionStat, f'question_id IN ({questions})'),
+        (Explanation, f'question_id IN ({questions})'),
+        (Answer, f'question_id IN ({questions})'),
+        (Question, 'quiz_id = %s'),
+        (AttemptSummary, 'quiz_id = %s'),
+        (TakenQuiz, 'quiz_id = %s'),
+        (TakenTime, 'quiz_id = %s'),
+    ]
+
+    image_files = list(Explanation.objects.filter(question__quiz=quiz)
+                       .exclude(image='').values_list('image', 'image_variants'))
+    student_ids = list(TakenQuiz.objects.filter(quiz=quiz)
+                       .values_list('student_id', flat=True).distinct())
+
+    deleted = {}
+    with connection.cursor() as cursor:
+        # 居眠りのイベントは残し、消す受験時間への参照だけを外す(on_delete=SET_NULL と同じ)
+        cursor.execute(
+            f'UPDATE {table(DrowsinessEvent._meta.db_table)} SET taken_time_id = NULL '
+            f'WHERE taken_time_id IN '
+            f'(SELECT id FROM {table(TakenTime._meta.db_table)} WHERE quiz_id = %s)',
+            [quiz.pk])
+        for model, where in statements:
+            cursor.execute(
+                f'DELETE FROM {table(model._meta.db_table)} WHERE {where}', [quiz.pk])
+            deleted[model] = cursor.rowcount
+
+    images.schedule_delete(image_files)
+    fragments.bump(fragments.teacher(quiz.owner_id),
+                   *(fragments.student(pk) for pk in student_ids))
+    return deleted[StudentAnswer], deleted[TakenQuiz]
+
+
+def import_questions(quiz, questions, replace=False, batch_size=IMPORT_BATCH_SIZE):
+    """
+    ``read_questions`` の問題をクイズに追加し、(問題, 選択肢, 解説) の件数を返す。
+
+    ``bulk_create`` ではシグナルが飛ばないので、最後にクイズの版と
+    解説の数を1回だけ更新する。``replace=True`` なら既存の問題を先に消す。
+    その場合、問題に答えた生徒の回答と受験結果も消える
+    (件数は ``deleted_student_answers`` と ``deleted_attempts``)。
+    """
+    counts = {'questions': 0, 'answers': 0, 'explanations': 0,
+              'deleted_student_answers': 0, 'deleted_attempts': 0}
+    questions = iter(questions)
+    with transaction.atomic():
+        if replace:
+            counts['deleted_student_answers'], counts['deleted_attempts'] = \
+                _delete_questions(quiz)
+        while True:
+            batch = list(islice(questions, batch_size))
+            if not batch:
+                break
+            created = Question.objects.bulk_create(
+                [Question(quiz=quiz, text=text) for text, _, _ in batch])
+            answers = [
+                Answer(question=question, text=text, is_correct=is_correct)
+                for question, (_, choices, _) in zip(created, batch)
+                for text, is_correct in choices]
+            explanations = [
+                Explanation(question=question, text=explanation)
+                for question, (_, _, explanation) in zip(created, batch)
+                if explanation]
+            Answer.objects.bulk_create(answers)
+            Explanation.objects.bulk_create(explanations)
+            counts['questions'] += len(created)
+            counts['answers'] += len(answers)
+            counts['explanations'] += len(explanations)
+        invalidate_quiz(quiz.pk)
+        if counts['explanations'] or replace:
+            refresh_explanation_count(quiz.pk)
+    return counts
+
+
+# ---- 書き出し ----
+
+def export_questions(quiz):
+    """ クイズの問題を、メモリに溜めずにチャンク単位で読み出す """
+    questions = quiz.questions \
+        .select_related('explanation') \
+        .prefetch_related('answers') \
+        .order_by('pk') \
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for question in questions:
+        try:
+            explanation = question.explanation.text
+        except Explanation.DoesNotExist:
+            explanation = ''
+        yield {
+            'text': question.text,
+            'answers': [
+                {'text': answer.text, 'is_correct': answer.is_correct}
+                for answer in sorted(question.answers.all(), key=lambda a: a.pk)],
+            'explanation': explanation,
+        }
+
+
+class _Echo:
+    """ csv.writer の書き込み先。書いた1行をそのまま返す """
+
+    def write(self, value):
+        return value
+
+
+def stream_json(records):
+    separator = '[\n'
+    for record in records:
+        yield separator + json.dumps(record, ensure_ascii=False)
+        separator = ',\n'
+    yield '[]\n' if separator == '[\n' else '\n]\n'
+
+
+def stream_jsonl(records):
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def stream_csv(records):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for record in records:
+        explanation = record['explanation']
+        for answer in record['answers']:
+            yield writer.writerow((
+                record['text'], answer['text'], int(answer['is_correct']), explanation))
+            # 解説は問題の最初の行にだけ書く
+            explanation = ''
+
+
+STREAMS = {
+    'json': stream_json,
+    'jsonl': stream_jsonl,
+    'csv': stream_csv,
+}
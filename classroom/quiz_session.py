@@ -0,0 +1,135 @@
+from django.utils import timezone
+
+from .models import StudentAnswer, TakenTime
+
+
+class QuizSession:
+    """
+    受験中のクイズの進捗をセッションに保持する。
+
+    開始時に出題順の問題IDを一度だけ読み込み、以降は回答のたびに
+    セッション上の残り問題と正解数を更新するだけなので、
+    1回の回答にかかるクエリ数は回答履歴の量に依存しない。
+    ``quiz`` にはクイズのスナップショット(``QuizSnapshot``)を渡す。
+    """
+    SESSION_KEY = 'quiz_sessions'
+
+    def __init__(self, request, quiz, challenge_num=1):
+        self.request = request
+        self.quiz = quiz
+        self.challenge_num = challenge_num
+        self._key = f'{quiz.pk}:{challenge_num}'
+        self._state = request.session.get(self.SESSION_KEY, {}).get(self._key)
+
+    @property
+    def is_active(self):
+        return self._state is not None
+
+    def start(self, student):
+        """ 問題一覧と回答済みの問題を読み込んでセッションを開始する """
+        question_ids = [question.pk for question in self.quiz.questions]
+
+        # セッションが切れた場合でも途中から再開できるよう、回答済みの分を復元する
+        answered = dict(student.quiz_answers.filter(
+            challenge_num=self.challenge_num,
+            answer__question__quiz=self.quiz.pk)
+            .values_list('answer__question_id', 'answer__is_correct'))
+
+        taken_time = TakenTime.objects.filter(
+            student=student, quiz_id=self.quiz.pk).first()
+        if taken_time is None:
+            taken_time = TakenTime.objects.create(
+                student=student, quiz_id=self.quiz.pk, take_start=timezone.now())
+
+        self._state = {
+            'questions': [pk for pk in question_ids if pk not in answered],
+            'total': len(question_ids),
+            'correct': sum(1 for is_correct in answered.values() if is_correct),
+            'taken_time': taken_time.pk,
+        }
+        self._save()
+
+    @property
+    def total_questions(self):
+        return self._state['total']
+
+    @property
+    def is_finished(self):
+        return not self._state['questions']
+
+    @property
+    def progress(self):
+        total = self.total_questions
+        if total == 0:
+            return 100
+        return 100 - round(((len(self._state['questions']) - 1) / total) * 100)
+
+    @property
+    def wrong_count(self):
+        return self.total_questions - self._state['correct']
+
+    @property
+    def score(self):
+        total = self.total_questions
+        if total == 0:
+            return 0
+        return round((self._state['correct'] / total) * 100.0)
+
+    def current_question(self):
+        """ 次に出題する問題を返す。受験中に削除された問題は読み飛ばす """
+        remaining = self._state['questions']
+        while remaining:
+            question = self.quiz.question(remaining[0])
+            if question is not None:
+                return question
+            remaining.pop(0)
+            self._save()
+        return None
+
+    def record(self, student_answer, answer):
+        """
+        回答(``StudentAnswer``)を保存して次の問題に進める。
+        同じアカウントの別のセッションなどで回答済みの問題なら、保存せずに False を返す。
+        """
+        remaining = self._state['questions']
+        if answer.question_id not in remaining:
+            return False
+        remaining.remove(answer.question_id)
+        # 回答済みなら、その回答の正誤をこのセッションの正解数に数える。
+        # first() は主キー順に並べ替えて複合インデックスを使わなくなるので、スライスで1件取る
+        answered = next(iter(StudentAnswer.objects.filter(
+            student_id=student_answer.student_id, challenge_num=self.challenge_num,
+            answer__question_id=answer.question_id,
+        ).values_list('answer__is_correct', flat=True)[:1]), None)
+        if answered is None:
+            student_answer.challenge_num = self.challenge_num
+            student_answer.save()
+        if answer.is_correct if answered is None else answered:
+            self._state['correct'] += 1
+        self._save()
+        return answered is None
+
+    def finish(self):
+        """ 終了時刻を記録してセッションを破棄する。かかった時間を返す """
+        taken_time = TakenTime.objects.filter(
+            pk=self._state['taken_time']).first()
+        self.clear()
+        if taken_time is None:
+            return None
+        taken_time.take_end = timezone.now()
+        taken_time.save(update_fields=['take_end'])
+        if taken_time.take_start is None:
+            return None
+        return taken_time.take_end - taken_time.take_start
+
+    def clear(self):
+        sessions = self.request.session.get(self.SESSION_KEY, {})
+        sessions.pop(self._key, None)
+        self.request.session[self.SESSION_KEY] = sessions
+        self._state = None
+
+    def _save(self):
+        sessions = self.request.session.get(self.SESSION_KEY, {})
+        sessions[self._key] = self._state
+        self.request.session[self.SESSION_KEY] = sessions
+        self.request.session.modified = True
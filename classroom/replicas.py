@@ -0,0 +1,124 @@
+"""
+読み込み専用のビューのクエリをレプリカに送る
+
+``ReplicaReadMixin``(または ``reading()`` のブロック)の中で読むモデルは、
+``DATABASE_REPLICAS`` のいずれかから読む。それ以外の読み込みとすべての書き込みは ``default``。
+
+レプリカは少し遅れて追いつくので、書き込んだ利用者の画面が古く見えないよう、
+リクエストで書き込みがあったら ``REPLICA_PIN_SECONDS`` 秒のあいだ、その利用者の読み込みを
+``default`` に固定する(クッキーで覚える)。回答を送った直後のクイズ一覧・受験済み一覧に
+結果が出ないといったことを防ぐ。
+
+セッションと利用者(ログイン)はレプリカの遅れで未ログイン扱いにならないよう、常に ``default``。
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+
+PIN_COOKIE = 'replica_pin'
+
+PIN_SECONDS = 5
+
+# レプリカから読まないアプリ(django_cache はデータベースのキャッシュ)
+PRIMARY_APPS = ('sessions', 'contenttypes', 'admin', 'django_cache')
+
+
+class _State:
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.reading = 0
+        self.wrote = False
+
+
+# 書き込みの有無はルーターで記録し、ミドルウェアで読むので、変更できるオブジェクトを持たせる
+_state = ContextVar('classroom_replica_state', default=None)
+
+
+def replicas():
+    return [alias for alias in getattr(settings, 'DATABASE_REPLICAS', ())
+            if alias in settings.DATABASES]
+
+
+@contextmanager
+def reading():
+    """ ブロック内の読み込みをレプリカに送る(書き込み後の固定中でなければ) """
+    state = _state.get()
+    token = None
+    if state is None:
+        state = _State()
+        token = _state.set(state)
+    state.reading += 1
+    try:
+        yield
+    finally:
+        state.reading -= 1
+        if token is not None:
+            _state.reset(token)
+
+
+def _replicable(model):
+    return (model._meta.app_label not in PRIMARY_APPS
+            and model._meta.label != get_user_model()._meta.label)
+
+
+class ReplicaRouter:
+    """ ``DATABASE_ROUTERS`` に指定する """
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.reading or state.pinned or state.wrote:
+            return None
+        aliases = replicas()
+        if not aliases or not _replicable(model):
+            return None
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        # セッションやログイン日時の保存では固定しない(どちらも常に default から読むので)
+        state = _state.get()
+        if state is not None and _replicable(model):
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {'default', *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカのスキーマは複製(sync_replica)で作る
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicaPinMiddleware:
+    """
+    リクエストごとに状態を作り、書き込みがあったリクエストの応答で、
+    しばらく ``default`` から読むためのクッキーを付ける。
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned_until = request.COOKIES.get(PIN_COOKIE, '')
+        state = _State(pinned=pinned_until.isdigit() and int(pinned_until) > time.time())
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+
+        if state.wrote and replicas():
+            seconds = getattr(settings, 'REPLICA_PIN_SECONDS', PIN_SECONDS)
+            response.set_cookie(
+                PIN_COOKIE, str(int(time.time() + seconds)), max_age=seconds,
+                httponly=True, samesite='Lax')
+        return response
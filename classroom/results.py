@@ -0,0 +1,202 @@
+import base64
+import csv
+import json
+import math
+from datetime import datetime
+
+from django.db.models import Count, Q
+from django.utils import timezone
+
+
+# 並び替えに使える項目(URLの sort パラメータ → フィールド)
+SORT_FIELDS = {
+    'date': 'date',
+    'score': 'score',
+    'student': 'student__user__username',
+}
+
+DEFAULT_SORT = '-date'
+
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_COLUMNS = ('student', 'challenge_num', 'score', 'date', 'seconds')
+
+
+def parse_sort(value):
+    """ ``-score`` のような指定を (フィールド, 降順か) にする。不正な値は既定の並び """
+    descending = value.startswith('-')
+    key = value.lstrip('-')
+    if key not in SORT_FIELDS:
+        return parse_sort(DEFAULT_SORT)
+    return key, descending
+
+
+def _encode_cursor(value, pk):
+    if isinstance(value, datetime):
+        value = {'dt': value.isoformat()}
+    raw = json.dumps([value, pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def _cursor_datetime(value):
+    parsed = datetime.fromisoformat(value['dt'])
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _cursor_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(value)
+    if not math.isfinite(value):
+        raise ValueError(value)
+    return float(value)
+
+
+def _cursor_text(value):
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+
+# カーソルの値を並び替え項目の型に戻す(別の並びのカーソルや改ざんされた値は例外になる)
+CURSOR_TYPES = {
+    'date': _cursor_datetime,
+    'score': _cursor_number,
+    'student': _cursor_text,
+}
+
+
+def _decode_cursor(cursor, key):
+    """ カーソルを (並び替え項目の値, pk) に戻す。読めないカーソルは None(最初のページ) """
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(pk, bool) or not isinstance(pk, int):
+            raise TypeError(pk)
+        return CURSOR_TYPES[key](value), pk
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+def keyset_page(queryset, sort, cursor=None, size=50):
+    """
+    キーセット方式で1ページ分を返す。
+
+    OFFSETを使わず「前のページの最後の行より後ろ」を条件にするので、
+    何ページ目でも(並び替え項目の)インデックスの範囲走査で済む。
+    戻り値は (行のリスト, 次のページのカーソル or None)。
+    """
+    key, descending = parse_sort(sort)
+    field = SORT_FIELDS[key]
+    prefix = '-' if descending else ''
+    queryset = queryset.order_by(prefix + field, prefix + 'pk')
+
+    position = _decode_cursor(cursor, key) if cursor else None
+    if position is not None:
+        value, pk = position
+        op = 'lt' if descending else 'gt'
+        queryset = queryset.filter(
+            Q(**{f'{field}__{op}': value}) |
+            Q(**{field: value, f'pk__{op}': pk}))
+
+    rows = list(queryset[:size + 1])
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        last = rows[-1]
+        value = last
+        for part in field.split('__'):
+            value = getattr(value, part)
+        next_cursor = _encode_cursor(value, last.pk)
+    return rows, next_cursor
+
+
+def _percentile(counts, total, p):
+    """ (点数, 人数) の昇順リストから線形補間でパーセンタイルを求める """
+    position = (total - 1) * p / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    lower_value = upper_value = None
+    seen = 0
+    for score, n in counts:
+        if lower_value is None and lower < seen + n:
+            lower_value = score
+        if upper < seen + n:
+            upper_value = score
+            break
+        seen += n
+    return lower_value + (upper_value - lower_value) * (position - lower)
+
+
+def score_distribution(taken_quizzes, bins=10):
+    """
+    点数の分布を1回の集計クエリで求める。
+
+    点数は0〜100に丸められているので、点数ごとの人数を集計すれば
+    高々101行で平均・中央値・パーセンタイル・ヒストグラムまで計算できる。
+    """
+    counts = list(taken_quizzes.order_by()
+                  .values('score')
+                  .annotate(n=Count('pk'))
+                  .order_by('score')
+                  .values_list('score', 'n'))
+    total = sum(n for _, n in counts)
+
+    width = 100 / bins
+    histogram = [
+        {'low': round(i * width), 'high': round((i + 1) * width), 'count': 0}
+        for i in range(bins)]
+    for score, n in counts:
+        index = min(int(score // width), bins - 1)
+        histogram[max(index, 0)]['count'] += n
+    peak = max((b['count'] for b in histogram), default=0)
+    for b in histogram:
+        b['ratio'] = round(b['count'] / peak * 100) if peak else 0
+
+    if total == 0:
+        return {'total': 0, 'histogram': histogram}
+
+    return {
+        'total': total,
+        'average': round(sum(score * n for score, n in counts) / total, 1),
+        'minimum': counts[0][0],
+        'maximum': counts[-1][0],
+        'median': _percentile(counts, total, 50),
+        'p25': _percentile(counts, total, 25),
+        'p75': _percentile(counts, total, 75),
+        'p90': _percentile(counts, total, 90),
+        'histogram': histogram,
+    }
+
+
+def export_rows(taken_quizzes, sort=DEFAULT_SORT):
+    """ 出力用の行を、メモリに溜めずにチャンク単位で読み出す """
+    key, descending = parse_sort(sort)
+    prefix = '-' if descending else ''
+    rows = taken_quizzes.with_taken_time() \
+        .order_by(prefix + SORT_FIELDS[key], prefix + 'pk') \
+        .values_list(
+            'student__user__username', 'challenge_num', 'score', 'date',
+            'taken_duration') \
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for username, challenge_num, score, date, duration in rows:
+        seconds = duration.total_seconds() if duration is not None else None
+        yield (username, challenge_num, score, date.isoformat(), seconds)
+
+
+class _Echo:
+    """ csv.writer の書き込み先。書いた1行をそのまま返す """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n'
@@ -0,0 +1,117 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import fragments, images, item_analysis
+from .models import (Answer, AttemptSummary, Explanation, Post, Question, Quiz,
+                     Student, StudentAnswer, Subject, TakenQuiz,
+                     new_content_version)
+
+
+def _bump_quiz_of_question(question_id):
+    Quiz.objects.filter(questions=question_id).update(
+        content_version=new_content_version())
+
+
+@receiver(pre_save, sender=Quiz)
+def quiz_pre_save(sender, instance, **kwargs):
+    # 保存のたびに新しい版を書き込むので、読み込み時点の古い版に戻ることはない
+    instance.content_version = new_content_version()
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def question_changed(sender, instance, **kwargs):
+    Quiz.objects.filter(pk=instance.quiz_id).update(
+        content_version=new_content_version())
+
+
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+@receiver(post_save, sender=Explanation)
+@receiver(post_delete, sender=Explanation)
+def question_content_changed(sender, instance, **kwargs):
+    _bump_quiz_of_question(instance.question_id)
+
+
+def refresh_explanation_count(quiz_id):
+    explanation_count = Explanation.objects.filter(
+        question__quiz_id=quiz_id).count()
+    AttemptSummary.objects.filter(quiz_id=quiz_id) \
+        .exclude(explanation_count=explanation_count) \
+        .update(explanation_count=explanation_count)
+
+
+@receiver(post_save, sender=Explanation)
+@receiver(post_delete, sender=Explanation)
+def explanation_changed(sender, instance, **kwargs):
+    quiz_id = Question.objects.filter(pk=instance.question_id) \
+        .values_list('quiz_id', flat=True).first()
+    if quiz_id is not None:
+        refresh_explanation_count(quiz_id)
+
+
+@receiver(post_save, sender=Explanation)
+@receiver(post_save, sender=Post)
+def image_saved(sender, instance, **kwargs):
+    if instance.image and images.current_variants(instance) is None:
+        images.schedule_variants(instance)
+
+
+@receiver(post_delete, sender=Question)
+def question_deleted(sender, instance, **kwargs):
+    refresh_explanation_count(instance.quiz_id)
+
+
+@receiver(post_save, sender=TakenQuiz)
+def taken_quiz_saved(sender, instance, created, **kwargs):
+    if created:
+        item_analysis.record_attempt(instance)
+
+
+# ---- 一覧の断片キャッシュの版 ----
+
+@receiver(post_save, sender=Quiz)
+@receiver(post_delete, sender=Quiz)
+def quiz_listed(sender, instance, **kwargs):
+    fragments.bump(fragments.CATALOGUE, fragments.teacher(instance.owner_id))
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+@receiver(post_save, sender=Explanation)
+@receiver(post_delete, sender=Explanation)
+@receiver(post_save, sender=Subject)
+@receiver(post_delete, sender=Subject)
+def catalogue_changed(sender, **kwargs):
+    fragments.bump(fragments.CATALOGUE)
+
+
+@receiver(post_save, sender=TakenQuiz)
+@receiver(post_delete, sender=TakenQuiz)
+def taken_quiz_listed(sender, instance, **kwargs):
+    # 先生の一覧の受験者数も変わる
+    owner_id = Quiz.objects.filter(pk=instance.quiz_id) \
+        .values_list('owner_id', flat=True).first()
+    fragments.bump(fragments.student(instance.student_id),
+                   fragments.teacher(owner_id) if owner_id else None)
+
+
+@receiver(post_save, sender=StudentAnswer)
+@receiver(post_save, sender=AttemptSummary)
+@receiver(post_delete, sender=AttemptSummary)
+def student_results_changed(sender, instance, **kwargs):
+    fragments.bump(fragments.student(instance.student_id))
+
+
+@receiver(m2m_changed, sender=Student.lebel.through)
+def student_lebel_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # 教科の側から生徒を付け外しした場合
+        pks = pk_set if pk_set is not None else ()
+        fragments.bump(*(fragments.student(pk) for pk in pks))
+        if action == 'post_clear':
+            fragments.bump(fragments.CATALOGUE)
+    else:
+        fragments.bump(fragments.student(instance.pk))
@@ -0,0 +1,199 @@
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import fragments, images
+from .models import Question, Quiz, new_content_version
+
+
+SNAPSHOT_KEY = 'classroom:quiz:{pk}:snapshot:{version}'
+
+# スナップショットは版ごとに別キーなので、期限切れは容量の回収のためだけに使う
+SNAPSHOT_TIMEOUT = 60 * 60 * 24
+
+
+@dataclass(frozen=True)
+class ImageSnapshot:
+    name: str
+    url: str
+    # 縮小画像ができていれば、その srcset と幅・高さ
+    width: Optional[int] = None
+    height: Optional[int] = None
+    webp_srcset: str = ''
+    jpeg_srcset: str = ''
+    fallback_url: str = ''
+    sizes: str = images.VARIANT_SIZES
+
+    @property
+    def src(self):
+        return self.fallback_url or self.url
+
+
+@dataclass(frozen=True)
+class AnswerSnapshot:
+    pk: int
+    question_id: int
+    text: str
+    is_correct: bool
+
+    def __str__(self):
+        return self.text
+
+
+@dataclass(frozen=True)
+class ExplanationSnapshot:
+    pk: int
+    question_id: int
+    text: str
+    image: Optional[ImageSnapshot]
+
+
+@dataclass(frozen=True)
+class QuestionSnapshot:
+    pk: int
+    quiz_id: int
+    text: str
+    answers: Tuple[AnswerSnapshot, ...]
+    explanation: Optional[ExplanationSnapshot]
+
+    def __str__(self):
+        return self.text
+
+
+@dataclass(frozen=True)
+class QuizSnapshot:
+    """
+    クイズの問題・選択肢・解説をまとめた読み取り専用のスナップショット。
+
+    ``version`` は ``Quiz.content_version`` と一致し、内容が変わるたびに
+    新しい版が作られるので、キャッシュ上の古い版を読むことはない。
+    """
+    pk: int
+    version: str
+    name: str
+    subject_id: int
+    questions: Tuple[QuestionSnapshot, ...]
+    _questions: dict = field(init=False, repr=False, compare=False)
+    _answers: dict = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(
+            self, '_questions', {q.pk: q for q in self.questions})
+        object.__setattr__(self, '_answers', {
+            a.pk: a for q in self.questions for a in q.answers})
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def explanation_count(self):
+        return sum(1 for q in self.questions if q.explanation is not None)
+
+    def question(self, pk):
+        return self._questions.get(pk)
+
+    def answer(self, pk):
+        return self._answers.get(pk)
+
+
+def _caches():
+    """ ローカルメモリと、設定されていれば共有キャッシュを返す """
+    local = caches[getattr(settings, 'QUIZ_SNAPSHOT_CACHE', 'default')]
+    shared_alias = getattr(settings, 'QUIZ_SNAPSHOT_SHARED_CACHE', None)
+    if shared_alias and shared_alias in settings.CACHES:
+        return local, caches[shared_alias]
+    return local, None
+
+
+def _image_snapshot(instance):
+    variants = images.current_variants(instance)
+    if variants is None:
+        return ImageSnapshot(name=instance.image.name, url=instance.image.url)
+    return ImageSnapshot(
+        name=instance.image.name,
+        url=instance.image.url,
+        width=variants['width'],
+        height=variants['height'],
+        webp_srcset=images.srcset(variants, 'webp'),
+        jpeg_srcset=images.srcset(variants, 'jpeg'),
+        fallback_url=images.fallback_url(variants))
+
+
+def build_quiz_snapshot(quiz):
+    questions = Question.objects.filter(quiz_id=quiz.pk) \
+        .select_related('explanation') \
+        .prefetch_related('answers') \
+        .order_by('text')
+
+    question_snapshots = []
+    for question in questions:
+        explanation = getattr(question, 'explanation', None)
+        explanation_snapshot = None
+        if explanation is not None:
+            image = None
+            if explanation.image:
+                image = _image_snapshot(explanation)
+            explanation_snapshot = ExplanationSnapshot(
+                pk=explanation.pk,
+                question_id=question.pk,
+                text=explanation.text,
+                image=image)
+
+        answers = sorted(question.answers.all(), key=lambda a: a.pk)
+        question_snapshots.append(QuestionSnapshot(
+            pk=question.pk,
+            quiz_id=quiz.pk,
+            text=question.text,
+            answers=tuple(AnswerSnapshot(
+                pk=answer.pk,
+                question_id=question.pk,
+                text=answer.text,
+                is_correct=answer.is_correct) for answer in answers),
+            explanation=explanation_snapshot))
+
+    return QuizSnapshot(
+        pk=quiz.pk,
+        version=quiz.content_version,
+        name=quiz.name,
+        subject_id=quiz.subject_id,
+        questions=tuple(question_snapshots))
+
+
+def get_quiz_snapshot(quiz):
+    """
+    クイズのスナップショットを返す。``quiz`` には ``Quiz`` か主キーを渡す。
+    キャッシュに現在の版があれば、内容のクエリは発行しない。
+    """
+    if not isinstance(quiz, Quiz):
+        quiz = Quiz.objects.get(pk=quiz)
+
+    key = SNAPSHOT_KEY.format(pk=quiz.pk, version=quiz.content_version)
+    local, shared = _caches()
+
+    snapshot = local.get(key)
+    if snapshot is not None:
+        return snapshot
+
+    if shared is not None:
+        snapshot = shared.get(key)
+        if snapshot is not None:
+            local.set(key, snapshot, SNAPSHOT_TIMEOUT)
+            return snapshot
+
+    snapshot = build_quiz_snapshot(quiz)
+    local.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    if shared is not None:
+        shared.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def invalidate_quiz(quiz_pk):
+    """
+    クイズの内容の版を進める。
+    シグナルが飛ばない一括更新(``bulk_create`` や ``update``)の後に呼び出すこと。
+    """
+    Quiz.objects.filter(pk=quiz_pk).update(
+        content_version=new_content_version())
+    fragments.bump(fragments.CATALOGUE)
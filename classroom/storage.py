@@ -0,0 +1,77 @@
+"""
+静的ファイルのストレージ
+
+``collectstatic`` で内容のハッシュ付きの名前(``app.3f2a9c1b04d7.css``)を作り、
+さらに圧縮したファイル(``.gz``、brotli があれば ``.br``)を隣に書き出す。
+配信(``classroom.views.media.serve_static``)ではブラウザが対応する圧縮版を返し、
+ハッシュ付きの名前は内容が変わらないので1年間キャッシュさせる。
+"""
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+from django.utils.functional import cached_property
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# 圧縮する拡張子(画像やwoff/woff2は圧縮済みなので対象外)
+COMPRESSIBLE_EXTENSIONS = {
+    '.css', '.js', '.json', '.svg', '.txt', '.xml', '.html', '.map',
+    '.ttf', '.eot', '.ico',
+}
+
+# これより小さいファイルや、ほとんど縮まないファイルは圧縮版を作らない
+MIN_COMPRESS_SIZE = 256
+MIN_COMPRESS_RATIO = 0.95
+
+# 圧縮版の拡張子 → Content-Encoding(優先する順)
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+
+
+def _compressors():
+    yield '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+    if brotli is not None:
+        yield '.br', lambda data: brotli.compress(data, quality=11)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ ハッシュ付きの名前のファイルに、圧縮版を書き添える """
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in sorted(set(self.hashed_files.values())):
+            self.compress(name)
+
+    def compress(self, name):
+        """ 圧縮版を書き出し、その名前のリストを返す """
+        if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+            return []
+        with self.open(name) as f:
+            data = f.read()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return []
+
+        names = []
+        for suffix, compress in _compressors():
+            compressed = compress(data)
+            if len(compressed) > len(data) * MIN_COMPRESS_RATIO:
+                continue
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            names.append(self._save(name + suffix, ContentFile(compressed)))
+        return names
+
+    def is_hashed(self, name):
+        """ 名前が内容のハッシュ付きか(=ずっとキャッシュしてよいか) """
+        return name in self._hashed_names
+
+    @cached_property
+    def _hashed_names(self):
+        return set(self.hashed_files.values())
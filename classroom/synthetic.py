@@ -0,0 +1,303 @@
+"""
+ベンチマーク・負荷試験用の合成データ
+
+``db.sqlite3`` の中身に頼らず、生徒 N 人 × クイズ M 個 × 問題 K 問と、
+それらしい受験履歴を乱数の種から毎回同じに作る。
+
+* 生徒の能力と問題の難しさは正規分布で決め、正答の確率はその差のロジスティック関数
+  (項目反応理論の1パラメータモデル)にする。誤答はよく選ばれる選択肢に偏らせる。
+* 生徒は選んだレベル(教科)のクイズだけを受験し、間違えた問題があれば何回か再挑戦する。
+  再挑戦では解説を読んだ分だけ正答しやすくなる。
+
+履歴は生徒ごとに ``student_history`` で作る。引数も戻り値もただの値なので、
+別のプロセスで作って ``HistoryWriter`` でまとめて保存することもできる。
+"""
+import math
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from . import fragments
+from .models import (
+    Answer, AttemptSummary, Explanation, Question, Quiz, Student, StudentAnswer,
+    Subject, TakenQuiz, TakenTime, User,
+)
+
+
+PASSWORD = 'synthetic-password'
+
+BATCH_SIZE = 2000
+
+DEFAULT_SUBJECTS = (
+    ('初級-1', '#355a40'), ('初級-2', '#007bff'), ('中級-1', '#28a745'),
+    ('中級-2', '#17a2b8'), ('上級', '#ffc107'),
+)
+
+
+@dataclass
+class Spec:
+    students: int = 50
+    quizzes: int = 10
+    questions: int = 10
+    # 問題ごとの選択肢の数と、解説がある問題の割合
+    choices: int = 4
+    explanation_rate: float = 0.5
+    # 生徒が選ぶレベルの数(1〜この数)
+    max_levels: int = 2
+    # 選んだレベルのクイズを受験済みの割合
+    taken_rate: float = 0.6
+    # 間違えた問題が残っているときに、もう一度挑戦する確率
+    retry_rate: float = 0.4
+    # 生徒の能力・問題の難しさ(正規分布)と、再挑戦1回で上がる能力
+    ability_mean: float = 0.5
+    ability_sd: float = 1.0
+    difficulty_sd: float = 1.0
+    retry_gain: float = 0.7
+    # 1問あたりの回答時間(秒)の中央値と、履歴を散らばらせる日数
+    seconds_per_question: float = 20.0
+    history_days: int = 90
+    # 履歴の日時の基準。省略時は生成した時刻(指定すると日時まで毎回同じになる)
+    now: datetime = None
+    seed: int = 0
+    prefix: str = 'synthetic'
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+def _rng(spec, *keys):
+    # 文字列の種は hash() を使わないので、プロセスが違っても同じ乱数列になる
+    return random.Random(':'.join(str(key) for key in (spec.seed, spec.prefix) + keys))
+
+
+def subjects():
+    """ 教科の一覧。マイグレーションで作られた教科がなければ作る """
+    found = list(Subject.objects.order_by('pk'))
+    if found:
+        return found
+    return Subject.objects.bulk_create(
+        [Subject(name=name, color=color) for name, color in DEFAULT_SUBJECTS])
+
+
+@transaction.atomic
+def create_catalogue(spec, owner=None):
+    """
+    クイズ・問題・選択肢・解説を作り、履歴の生成に使う目録を返す。
+    目録は [(クイズのpk, 教科のpk, 解説の数, [(問題のpk, 難しさ, 正答のpk, 誤答のpkのタプル)])]。
+    """
+    rng = _rng(spec, 'catalogue')
+    if owner is None:
+        owner = User.objects.create(
+            username=f'{spec.prefix}-teacher', password=make_password(PASSWORD),
+            is_teacher=True)
+    subject_list = subjects()
+    quizzes = Quiz.objects.bulk_create([
+        Quiz(owner=owner, name=f'{spec.prefix} quiz {i + 1:04d}',
+             subject=subject_list[i % len(subject_list)])
+        for i in range(spec.quizzes)], batch_size=BATCH_SIZE)
+
+    questions = Question.objects.bulk_create([
+        Question(quiz=quiz, text=f'{quiz.name} question {j + 1:03d}')
+        for quiz in quizzes for j in range(spec.questions)], batch_size=BATCH_SIZE)
+
+    answers = []
+    explanations = []
+    correct_positions = []
+    for question in questions:
+        correct = rng.randrange(spec.choices)
+        correct_positions.append(correct)
+        answers.extend(
+            Answer(question=question, text=f'choice {k + 1}', is_correct=k == correct)
+            for k in range(spec.choices))
+        if rng.random() < spec.explanation_rate:
+            explanations.append(Explanation(
+                question=question, text=f'{question.text} explanation'))
+    Answer.objects.bulk_create(answers, batch_size=BATCH_SIZE)
+    Explanation.objects.bulk_create(explanations, batch_size=BATCH_SIZE)
+    explained = {explanation.question_id for explanation in explanations}
+
+    catalogue = []
+    for i, quiz in enumerate(quizzes):
+        items = []
+        for j in range(i * spec.questions, (i + 1) * spec.questions):
+            question = questions[j]
+            choices = answers[j * spec.choices:(j + 1) * spec.choices]
+            correct = choices[correct_positions[j]].pk
+            wrong = tuple(answer.pk for answer in choices if answer.pk != correct)
+            items.append((question.pk, rng.gauss(0, spec.difficulty_sd), correct, wrong))
+        catalogue.append((
+            quiz.pk, quiz.subject_id,
+            sum(pk in explained for pk, *_ in items), items))
+    fragments.bump(fragments.CATALOGUE, fragments.teacher(owner.pk))
+    return catalogue
+
+
+def create_students(spec, start=0, count=None, password=None):
+    """
+    生徒とそのレベルを作り、[(生徒のpk, 何人目か, レベルの教科のpkのタプル)] を返す。
+    パスワードのハッシュは1回だけ計算して全員に使う。
+    """
+    count = spec.students - start if count is None else count
+    password = password or make_password(PASSWORD)
+    subject_ids = [subject.pk for subject in subjects()]
+    users = User.objects.bulk_create([
+        User(username=f'{spec.prefix}-student-{start + i:07d}', password=password,
+             is_student=True)
+        for i in range(count)], batch_size=BATCH_SIZE)
+    Student.objects.bulk_create(
+        [Student(user=user) for user in users], batch_size=BATCH_SIZE)
+
+    students = []
+    levels = []
+    for i, user in enumerate(users):
+        rng = _rng(spec, 'student', start + i)
+        chosen = tuple(sorted(rng.sample(
+            subject_ids, rng.randint(1, min(spec.max_levels, len(subject_ids))))))
+        students.append((user.pk, start + i, chosen))
+        levels.extend(
+            Student.lebel.through(student_id=user.pk, subject_id=subject_id)
+            for subject_id in chosen)
+    Student.lebel.through.objects.bulk_create(levels, batch_size=BATCH_SIZE)
+    return students
+
+
+def _pick(rng, correct, wrong, p_correct):
+    if rng.random() < p_correct:
+        return correct, True
+    # 誤答は前の選択肢ほど選ばれやすい(紛らわしい選択肢がある問題らしくする)
+    weights = [len(wrong) - k for k in range(len(wrong))]
+    return rng.choices(wrong, weights)[0], False
+
+
+def student_history(spec, catalogue, student):
+    """
+    生徒1人の受験履歴を作る。戻り値は値だけの辞書で、
+    answers [(挑戦回, 選択肢のpk)]、taken [(クイズのpk, 挑戦回, 点数, 受験日時)]、
+    times [(クイズのpk, 開始, 終了)]、summaries [(クイズのpk, 最初の点数, 最後の挑戦回,
+    最後の点数, 最後に間違えた数, 解説の数, かかった時間)]。
+    """
+    student_id, index, levels = student
+    rng = _rng(spec, 'history', index)
+    ability = rng.gauss(spec.ability_mean, spec.ability_sd)
+    now = spec.now or timezone.now()
+    history = {'answers': [], 'taken': [], 'times': [], 'summaries': []}
+
+    for quiz_id, subject_id, explanation_count, items in catalogue:
+        if subject_id not in levels or not items or rng.random() >= spec.taken_rate:
+            continue
+
+        take_start = now - timedelta(days=rng.uniform(0, spec.history_days))
+        seconds = sum(
+            rng.lognormvariate(math.log(spec.seconds_per_question), 0.5) for _ in items)
+        take_end = take_start + timedelta(seconds=seconds)
+
+        remaining = items
+        challenge_num = 0
+        date = take_end
+        first_score = None
+        while remaining:
+            challenge_num += 1
+            theta = ability + spec.retry_gain * (challenge_num - 1)
+            wrong_items = []
+            for item in remaining:
+                _, difficulty, correct, wrong = item
+                answer_id, is_correct = _pick(
+                    rng, correct, wrong, _sigmoid(theta - difficulty))
+                history['answers'].append((challenge_num, answer_id))
+                if not is_correct:
+                    wrong_items.append(item)
+            score = round((len(remaining) - len(wrong_items)) / len(remaining) * 100.0)
+            history['taken'].append((quiz_id, challenge_num, score, date))
+            if first_score is None:
+                first_score = score
+            if not wrong_items or rng.random() >= spec.retry_rate:
+                break
+            remaining = wrong_items
+            # 再挑戦は平均1日後
+            date += timedelta(hours=rng.expovariate(1 / 24))
+
+        history['times'].append((quiz_id, take_start, take_end))
+        history['summaries'].append((
+            quiz_id, first_score, challenge_num, score, len(wrong_items),
+            explanation_count, take_end - take_start))
+    return history
+
+
+class HistoryWriter:
+    """
+    履歴を溜めて、``batch_size`` 行ごとに1つのトランザクションで ``bulk_create`` する。
+    ``with`` を抜けるときに残りを保存し、生徒の一覧の版を消す。
+
+    ``TakenQuiz.date`` は ``auto_now_add`` で保存時の時刻になるので、
+    作成した後に生成した日時へ書き換える(作成した行の pk が返るデータベースのみ)。
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = {model: [] for model in (
+            StudentAnswer, TakenQuiz, TakenTime, AttemptSummary)}
+        self.students = []
+        self.counts = {model.__name__: 0 for model in self.pending}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, student_id, history):
+        self.students.append(student_id)
+        self.pending[StudentAnswer].extend(
+            StudentAnswer(student_id=student_id, challenge_num=challenge_num,
+                          answer_id=answer_id)
+            for challenge_num, answer_id in history['answers'])
+        self.pending[TakenQuiz].extend(
+            TakenQuiz(student_id=student_id, quiz_id=quiz_id,
+                      challenge_num=challenge_num, score=score, date=date)
+            for quiz_id, challenge_num, score, date in history['taken'])
+        self.pending[TakenTime].extend(
+            TakenTime(student_id=student_id, quiz_id=quiz_id,
+                      take_start=take_start, take_end=take_end)
+            for quiz_id, take_start, take_end in history['times'])
+        self.pending[AttemptSummary].extend(
+            AttemptSummary(
+                student_id=student_id, quiz_id=quiz_id, first_score=first_score,
+                latest_challenge_num=latest_challenge_num, latest_score=latest_score,
+                wrong_count=wrong_count, explanation_count=explanation_count,
+                duration=duration)
+            for (quiz_id, first_score, latest_challenge_num, latest_score,
+                 wrong_count, explanation_count, duration) in history['summaries'])
+        if sum(len(objs) for objs in self.pending.values()) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with transaction.atomic():
+            for model, objs in self.pending.items():
+                if not objs:
+                    continue
+                dates = [obj.date for obj in objs] if model is TakenQuiz else None
+                model.objects.bulk_create(objs, batch_size=self.batch_size)
+                if dates and objs[0].pk is not None:
+                    for obj, date in zip(objs, dates):
+                        obj.date = date
+                    model.objects.bulk_update(objs, ['date'], batch_size=self.batch_size)
+                self.counts[model.__name__] += len(objs)
+                objs.clear()
+            fragments.bump(*[fragments.student(pk) for pk in self.students])
+        self.students = []
+
+
+def create_dataset(spec):
+    """ 目録・生徒・履歴をすべて作り、(目録, 生徒, 作った履歴の件数) を返す """
+    catalogue = create_catalogue(spec)
+    students = create_students(spec)
+    with HistoryWriter() as writer:
+        for student in students:
+            writer.add(student[0], student_history(spec, catalogue, student))
+    return catalogue, students, writer.counts
@@ -11,6 +11,12 @@ def get_latest_answer(student: Student, question: Question):
     return student.quiz_answers.filter(answer__question=question).order_by('-challenge_num').first()
 
 
+@register.filter
+def lookup(mapping: dict, key):
+    """ ビューで事前に集計した辞書から値を取り出す """
+    return mapping.get(key)
+
+
 @register.simple_tag
 def timedelta_diplay(td: timedelta):
     total_sec = td.total_seconds()
@@ -0,0 +1,655 @@
+import base64
+import io
+import json
+import os
+import tempfile
+from importlib.util import find_spec
+from unittest import skipUnless
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.http import HttpResponse
+from django.template.backends.django import Template
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import events, fragments, item_analysis, profiling, quiz_io, results, synthetic
+from .backends.sqlite3.base import DatabaseWrapper
+from .drowsiness.ingest import FrameAnalyzer
+from .drowsiness.recorder import EventRecorder
+from .drowsiness.scoring import BLINK, DROWSY, DrowsinessScorer
+from .drowsiness.worker import analyze_jpeg
+from .loadtest import QuizFlowBenchmark
+from .management.commands.check_query_plans import check_plans
+from .models import (
+    Answer, AnswerStat, AttemptSummary, DrowsinessEvent, Explanation, Question, QuestionStat,
+    Quiz, Student, StudentAnswer, Subject, TakenQuiz, TakenTime, User,
+)
+from .quiz_session import QuizSession
+from .snapshots import get_quiz_snapshot, invalidate_quiz
+
+
+def create_quiz(question_count=3, name='quiz'):
+    """ 正解1つ・不正解1つの問題を持つクイズを作る """
+    teacher, _ = User.objects.get_or_create(username='teacher', is_teacher=True)
+    subject, _ = Subject.objects.get_or_create(name='subject')
+    quiz = Quiz.objects.create(owner=teacher, name=name, subject=subject)
+    for i in range(question_count):
+        question = Question.objects.create(quiz=quiz, text=f'question {i}')
+        Answer.objects.create(question=question, text='right', is_correct=True)
+        Answer.objects.create(question=question, text='wrong', is_correct=False)
+    return Quiz.objects.get(pk=quiz.pk)
+
+
+def create_student(username='student', subject=None):
+    user = User.objects.create(username=username, is_student=True)
+    student = Student.objects.create(user=user)
+    if subject is not None:
+        student.lebel.add(subject)
+    return student
+
+
+def session_request(user):
+    request = RequestFactory().get('/')
+    request.user = user
+    request.session = SessionStore()
+    return request
+
+
+class QuizSessionTests(TestCase):
+    """ 受験の進捗はセッションに持ち、切れても回答履歴から再開できる """
+
+    def setUp(self):
+        self.quiz = create_quiz()
+        self.student = create_student()
+
+    def session(self, request=None):
+        return QuizSession(
+            request or session_request(self.student.user), get_quiz_snapshot(self.quiz))
+
+    def answer(self, quiz_session, correct=True):
+        question = quiz_session.current_question()
+        answer = next(a for a in question.answers if a.is_correct == correct)
+        return quiz_session.record(StudentAnswer(student=self.student, answer_id=answer.pk), answer)
+
+    def test_resumes_after_session_expires(self):
+        quiz_session = self.session()
+        quiz_session.start(self.student)
+        self.assertTrue(self.answer(quiz_session, correct=True))
+
+        # 新しいセッションでは、回答済みの問題を除いて正解数を引き継ぐ
+        resumed = self.session()
+        self.assertFalse(resumed.is_active)
+        resumed.start(self.student)
+        self.assertEqual(resumed.total_questions, 3)
+        self.assertEqual(len(resumed._state['questions']), 2)
+        self.assertTrue(self.answer(resumed, correct=False))
+        self.assertTrue(self.answer(resumed, correct=False))
+        self.assertTrue(resumed.is_finished)
+        self.assertEqual(resumed.score, 33)
+        self.assertEqual(resumed.wrong_count, 2)
+        self.assertEqual(TakenTime.objects.filter(student=self.student).count(), 1)
+
+    def test_skips_deleted_questions(self):
+        request = session_request(self.student.user)
+        self.session(request).start(self.student)
+        first = self.session(request).current_question()
+        Question.objects.filter(pk=first.pk).get().delete()
+
+        # 削除後の版のスナップショットでは、削除された問題を読み飛ばす
+        self.quiz.refresh_from_db()
+        quiz_session = self.session(request)
+        self.assertNotEqual(quiz_session.current_question().pk, first.pk)
+        self.assertEqual(len(quiz_session._state['questions']), 2)
+
+    def test_answer_from_another_session_counts_once(self):
+        first, second = self.session(), self.session()
+        first.start(self.student)
+        second.start(self.student)
+        question = first.current_question()
+        self.assertEqual(second.current_question(), question)
+
+        self.assertTrue(self.answer(first, correct=True))
+        # 別のセッションからの同じ問題への回答は保存せず、先の回答の正誤を数える
+        self.assertFalse(self.answer(second, correct=False))
+        self.assertEqual(StudentAnswer.objects.filter(student=self.student).count(), 1)
+        self.assertEqual(second._state['correct'], 1)
+        self.assertNotEqual(second.current_question(), question)
+
+    def test_progress_and_score(self):
+        quiz_session = self.session()
+        quiz_session.start(self.student)
+        self.assertEqual(quiz_session.progress, 33)
+        for _ in range(3):
+            progress = quiz_session.progress
+            self.answer(quiz_session, correct=True)
+        self.assertEqual(progress, 100)
+        self.assertEqual(quiz_session.score, 100)
+        self.assertEqual(quiz_session.wrong_count, 0)
+
+        other = create_student('other')
+        quiz_session = QuizSession(session_request(other.user), get_quiz_snapshot(self.quiz))
+        quiz_session.start(other)
+        for _ in range(3):
+            question = quiz_session.current_question()
+            answer = next(a for a in question.answers if not a.is_correct)
+            quiz_session.record(StudentAnswer(student=other, answer_id=answer.pk), answer)
+        self.assertEqual(quiz_session.score, 0)
+        self.assertEqual(quiz_session.wrong_count, 3)
+
+    def test_empty_quiz(self):
+        self.quiz = create_quiz(question_count=0, name='empty')
+        quiz_session = self.session()
+        quiz_session.start(self.student)
+        self.assertTrue(quiz_session.is_finished)
+        self.assertIsNone(quiz_session.current_question())
+        self.assertEqual(quiz_session.progress, 100)
+        self.assertEqual(quiz_session.score, 0)
+
+
+class QuizSnapshotTests(TestCase):
+    """ スナップショットは内容が変わるたびに新しい版になる """
+
+    def test_cached_until_content_changes(self):
+        quiz = create_quiz()
+        snapshot = get_quiz_snapshot(quiz)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_quiz_snapshot(quiz), snapshot)
+
+        answer = Answer.objects.filter(question__quiz=quiz, is_correct=False).first()
+        answer.text = 'changed'
+        answer.save()
+        quiz.refresh_from_db()
+        self.assertEqual(get_quiz_snapshot(quiz).answer(answer.pk).text, 'changed')
+        self.assertEqual(snapshot.answer(answer.pk).text, 'wrong')
+
+    def test_invalidate_after_bulk_update(self):
+        quiz = create_quiz()
+        snapshot = get_quiz_snapshot(quiz)
+        # シグナルの飛ばない一括更新は invalidate_quiz で版を進める
+        Question.objects.filter(quiz=quiz).update(text='renamed')
+        quiz.refresh_from_db()
+        self.assertEqual(get_quiz_snapshot(quiz), snapshot)
+        invalidate_quiz(quiz.pk)
+        quiz.refresh_from_db()
+        self.assertEqual({q.text for q in get_quiz_snapshot(quiz).questions}, {'renamed'})
+
+
+class AttemptSummaryTests(TestCase):
+    """ 受験と再挑戦の結果が、受験結果(TakenQuiz)と同じ内容で集計に入ること """
+
+    def setUp(self):
+        self.quiz = create_quiz()
+        self.student = create_student(subject=self.quiz.subject)
+        self.client.force_login(self.student.user)
+
+    def take(self, url, correct):
+        """ 表示された問題に、正解か不正解の選択肢で答えていく """
+        while True:
+            response = self.client.get(url)
+            if response.status_code != 200:
+                return response
+            question = response.context['question']
+            answer = next(a for a in question.answers if a.is_correct == correct(question))
+            self.client.post(url, {'answer': answer.pk})
+
+    def test_take_and_retry(self):
+        questions = sorted(q.pk for q in get_quiz_snapshot(self.quiz).questions)
+        self.take(reverse('students:take_quiz', args=[self.quiz.pk]),
+                  lambda question: question.pk == questions[0])
+
+        summary = AttemptSummary.objects.get(student=self.student, quiz=self.quiz)
+        taken = TakenQuiz.objects.get(student=self.student, quiz=self.quiz)
+        self.assertEqual((summary.first_score, summary.latest_score), (taken.score, taken.score))
+        self.assertEqual((summary.latest_challenge_num, summary.wrong_count), (1, 2))
+        self.assertEqual(summary.explanation_count, 0)
+        self.assertIsNotNone(summary.duration)
+        response = self.client.get(reverse('students:retry_quiz_list'))
+        self.assertEqual([s.pk for s in response.context['retry_quizzes']], [summary.pk])
+
+        # 再挑戦で間違えた2問に正解すると、再挑戦一覧から消える
+        self.take(reverse('students:retry_quiz', args=[self.quiz.pk, 1]), lambda question: True)
+        summary.refresh_from_db()
+        retaken = TakenQuiz.objects.get(student=self.student, quiz=self.quiz, challenge_num=2)
+        self.assertEqual(summary.first_score, taken.score)
+        self.assertEqual((summary.latest_challenge_num, summary.latest_score), (2, retaken.score))
+        self.assertEqual((retaken.score, summary.wrong_count), (100, 0))
+        response = self.client.get(reverse('students:retry_quiz_list'))
+        self.assertEqual(list(response.context['retry_quizzes']), [])
+
+    def test_explanation_count_follows_explanations(self):
+        self.take(reverse('students:take_quiz', args=[self.quiz.pk]), lambda question: False)
+        question = self.quiz.questions.first()
+        explanation = Explanation.objects.create(question=question, text='explanation')
+        summary = AttemptSummary.objects.get(student=self.student, quiz=self.quiz)
+        self.assertEqual(summary.explanation_count, 1)
+        explanation.delete()
+        summary.refresh_from_db()
+        self.assertEqual(summary.explanation_count, 0)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN の形式は SQLite のもの')
+class QueryPlanTests(TestCase):
+    """ ビューの主要なクエリが全件走査にならず、想定したインデックスを使うこと """
+
+    def test_query_plans(self):
+        checked = 0
+        for label, sql, plan, problem in check_plans(connection):
+            checked += 1
+            with self.subTest(label):
+                self.assertIsNone(problem, '\n'.join([sql, *plan]))
+        self.assertGreater(checked, 0)
+
+
+class CursorTests(SimpleTestCase):
+    """ 結果一覧のカーソルは、読めない値なら最初のページに戻る """
+
+    def encode(self, value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+    def test_round_trip(self):
+        now = timezone.now()
+        self.assertEqual(results._decode_cursor(results._encode_cursor(now, 3), 'date'), (now, 3))
+        self.assertEqual(results._decode_cursor(results._encode_cursor(80.0, 4), 'score'), (80.0, 4))
+        self.assertEqual(
+            results._decode_cursor(results._encode_cursor('alice', 5), 'student'), ('alice', 5))
+
+    def test_invalid_cursor(self):
+        for cursor in ('!!', self.encode({'x': 1}), self.encode([{'dt': 'junk'}, 1]),
+                       self.encode([{'x': 1}, 1]), self.encode([80.0, 'x'])):
+            with self.subTest(cursor):
+                self.assertIsNone(results._decode_cursor(cursor, 'date'))
+
+    def test_cursor_from_another_sort(self):
+        self.assertIsNone(results._decode_cursor(results._encode_cursor('alice', 5), 'score'))
+        self.assertIsNone(results._decode_cursor(results._encode_cursor(80.0, 4), 'student'))
+        self.assertIsNone(
+            results._decode_cursor(results._encode_cursor(timezone.now(), 3), 'score'))
+
+
+class ItemAnalysisTests(TestCase):
+    """ 受験終了時にまとめて加算した集計が、回答履歴から作り直した集計と一致すること """
+
+    def stats(self):
+        return (
+            sorted(QuestionStat.objects.values_list(
+                'question_id', 'challenge_num', 'responses', 'correct', 'scored_responses',
+                'scored_correct', 'score_sum', 'score_sq_sum', 'correct_score_sum')),
+            sorted(AnswerStat.objects.values_list('answer_id', 'challenge_num', 'picks')))
+
+    def test_incremental_stats_match_rebuild(self):
+        teacher = User.objects.create(username='teacher', is_teacher=True)
+        subject = Subject.objects.create(name='subject')
+        quiz = Quiz.objects.create(owner=teacher, name='quiz', subject=subject)
+        choices = []
+        for i in range(3):
+            question = Question.objects.create(quiz=quiz, text=f'question {i}')
+            choices.append((
+                Answer.objects.create(question=question, text='right', is_correct=True),
+                Answer.objects.create(question=question, text='wrong', is_correct=False)))
+
+        for i in range(4):
+            student = Student.objects.create(
+                user=User.objects.create(username=f'student {i}', is_student=True))
+            picked = [right if (i + k) % 2 else wrong for k, (right, wrong) in enumerate(choices)]
+            for answer in picked:
+                StudentAnswer.objects.create(student=student, answer=answer)
+            TakenQuiz.objects.create(
+                student=student, quiz=quiz,
+                score=round(sum(answer.is_correct for answer in picked) / 3 * 100))
+
+        # 終わっていない受験の回答は、どちらの集計でも数えない
+        unfinished = Student.objects.create(
+            user=User.objects.create(username='unfinished', is_student=True))
+        StudentAnswer.objects.create(student=unfinished, answer=choices[0][0])
+
+        incremental = self.stats()
+        self.assertEqual(sum(picks for _, _, picks in incremental[1]), 12)
+        item_analysis.rebuild()
+        self.assertEqual(self.stats(), incremental)
+
+
+class EventStreamTests(SimpleTestCase):
+    """ SSEのストリームは上限の時間で終わり、購読を解除する """
+
+    async def test_stream_ends_after_lifetime(self):
+        broadcaster = events.InProcessBroadcaster()
+        events._broadcaster = broadcaster
+        try:
+            chunks = [chunk async for chunk in events.stream(
+                'channel', heartbeat=0.05, lifetime=0.2)]
+        finally:
+            events._broadcaster = None
+        self.assertTrue(chunks[0].startswith('retry:'))
+        self.assertEqual(broadcaster._subscribers, {})
+
+    def test_sync_stream_ends_after_lifetime(self):
+        broadcaster = events.InProcessBroadcaster()
+        events._broadcaster = broadcaster
+        try:
+            chunks = list(events.stream_sync('channel', heartbeat=0.05, lifetime=0.2))
+        finally:
+            events._broadcaster = None
+        self.assertTrue(chunks[0].startswith('retry:'))
+        self.assertEqual(broadcaster._subscribers, {})
+
+
+class DrowsinessScorerTests(SimpleTestCase):
+    """ 居眠りは状態に入ったときだけ返し、まばたきか一定時間の経過で再び返す """
+
+    def feed(self, scorer, ears, start=0.0, step=0.25):
+        return [scorer.update(ear, start + i * step) for i, ear in enumerate(ears)]
+
+    def blinks(self, scorer, count, start=0.0):
+        # 0.75秒目を閉じてから開ける(閉じている間に1回まばたきと数える)
+        return self.feed(scorer, ([0.1] * 4 + [0.3]) * count, start)
+
+    def test_drowsy_is_edge_triggered(self):
+        scorer = DrowsinessScorer(drowsy_cooldown=60.0)
+        self.assertEqual(self.blinks(scorer, 5).count(BLINK), 5)
+        events = self.feed(scorer, [0.3] * 40, start=10.0)
+        self.assertEqual(events.count(DROWSY), 1)
+
+        # まばたきで状態を抜けると、再び知らせる
+        self.assertEqual(self.blinks(scorer, 1, start=30.0), [None, None, None, BLINK, None])
+        events = self.feed(scorer, [0.3] * 40, start=40.0)
+        self.assertEqual(events.count(DROWSY), 1)
+
+    def test_drowsy_repeats_after_cooldown(self):
+        scorer = DrowsinessScorer(drowsy_cooldown=5.0)
+        self.blinks(scorer, 5)
+        events = self.feed(scorer, [0.3] * 41, start=10.0)
+        self.assertEqual(events.count(DROWSY), 2)
+
+
+class DrowsinessRecorderTests(TestCase):
+    """ 居眠りの通知は、クイズの持ち主だけが購読できるクイズのチャンネルにだけ送る """
+
+    def test_publishes_only_to_quiz_channels(self):
+        quiz = create_quiz(question_count=0)
+        student = create_student()
+        batch = [
+            DrowsinessEvent(student_id=student.pk, quiz_id=quiz.pk, kind=DrowsinessEvent.DROWSY,
+                            ear=0.1, occurred_at=timezone.now()),
+            DrowsinessEvent(student_id=student.pk, kind=DrowsinessEvent.DROWSY,
+                            ear=0.1, occurred_at=timezone.now()),
+        ]
+        broadcaster = events.InProcessBroadcaster()
+        events._broadcaster = broadcaster
+        try:
+            EventRecorder()._publish(batch)
+        finally:
+            events._broadcaster = None
+        self.assertEqual(list(broadcaster._history), [events.quiz_channel(quiz.pk)])
+        event, = broadcaster._history[events.quiz_channel(quiz.pk)]
+        self.assertEqual(json.loads(event.data)['alerts'][0]['student'], 'student')
+
+
+class DrowsinessFramesTests(TestCase):
+    """ カメラのフレームは受験中のクイズにだけ送れる """
+
+    def test_rejects_quiz_not_being_taken(self):
+        teacher = User.objects.create(username='teacher', is_teacher=True)
+        quiz = Quiz.objects.create(
+            owner=teacher, name='quiz', subject=Subject.objects.create(name='subject'))
+        user = User.objects.create(username='student', is_student=True)
+        Student.objects.create(user=user)
+        self.client.force_login(user)
+
+        response = self.client.post(
+            reverse('students:drowsiness_frames', args=[quiz.pk]),
+            data=b'\xff\xd8', content_type='image/jpeg')
+        self.assertEqual(response.status_code, 403)
+
+
+@skipUnless(find_spec('cv2') and find_spec('dlib')
+            and os.path.exists(settings.DROWSINESS_PREDICTOR_PATH),
+            'OpenCV・dlib とランドマークのモデルが必要')
+class FrameAnalyzerPoolTests(SimpleTestCase):
+    """ spawn で起動したワーカーが、Django を初期化せずにフレームを解析できること """
+
+    def test_analyzes_frame_in_worker_process(self):
+        import cv2
+        import numpy as np
+
+        _, jpeg = cv2.imencode('.jpg', np.full((120, 160), 128, dtype=np.uint8))
+        analyzer = FrameAnalyzer(workers=1)
+        try:
+            future = analyzer._get_pool().submit(
+                analyze_jpeg, jpeg.tobytes(), analyzer.predictor_path)
+            # 顔は写っていないので、EARは1つもない
+            self.assertEqual(future.result(timeout=60), [])
+        finally:
+            analyzer.shutdown()
+
+
+class QuizImportTests(TestCase):
+
+    def read(self, questions):
+        return quiz_io.read_questions(io.StringIO(json.dumps(questions)), 'json')
+
+    def test_answer_count_limits(self):
+        for count in (1, 11):
+            answers = [{'text': f'choice {i}', 'is_correct': i == 0} for i in range(count)]
+            with self.subTest(count=count), self.assertRaises(quiz_io.QuizImportError):
+                list(self.read([{'text': 'question', 'answers': answers}]))
+
+    def test_replace_deletes_questions_without_signals(self):
+        teacher = User.objects.create(username='teacher', is_teacher=True)
+        quiz = Quiz.objects.create(
+            owner=teacher, name='quiz', subject=Subject.objects.create(name='subject'))
+        questions = [{
+            'text': f'question {i}',
+            'answers': [{'text': 'right', 'is_correct': True}, {'text': 'wrong'}],
+            'explanation': 'explanation',
+        } for i in range(50)]
+        quiz_io.import_questions(quiz, self.read(questions))
+        student = Student.objects.create(
+            user=User.objects.create(username='student', is_student=True))
+        StudentAnswer.objects.create(
+            student=student, answer=Answer.objects.filter(question__quiz=quiz).first())
+
+        # 問題の数によらず、削除は表ごとに1回の DELETE
+        with self.assertNumQueries(20):
+            counts = quiz_io.import_questions(quiz, self.read(questions[:1]), replace=True)
+        self.assertEqual(counts['deleted_student_answers'], 1)
+        self.assertEqual(quiz.questions.count(), 1)
+        self.assertFalse(StudentAnswer.objects.exists())
+
+    def test_replace_resets_attempts(self):
+        quiz = create_quiz()
+        student = create_student(subject=quiz.subject)
+        self.client.force_login(student.user)
+        url = reverse('students:take_quiz', args=[quiz.pk])
+        while (response := self.client.get(url)).status_code == 200:
+            question = response.context['question']
+            self.client.post(url, {'answer': next(a.pk for a in question.answers
+                                                  if not a.is_correct)})
+        response = self.client.get(reverse('students:retry_quiz_list'))
+        self.assertEqual(len(response.context['retry_quizzes']), 1)
+
+        questions = [{'text': 'new question',
+                      'answers': [{'text': 'right', 'is_correct': True}, {'text': 'wrong'}]}]
+        counts = quiz_io.import_questions(quiz, self.read(questions), replace=True)
+        self.assertEqual((counts['deleted_student_answers'], counts['deleted_attempts']), (3, 1))
+
+        # 消えた問題の再挑戦は出さず、クイズはまだ受けていないものとして一覧に戻る
+        response = self.client.get(reverse('students:retry_quiz_list'))
+        self.assertEqual(list(response.context['retry_quizzes']), [])
+        response = self.client.get(reverse('students:taken_quiz_list'))
+        self.assertEqual(list(response.context['taken_quizzes']), [])
+        response = self.client.get(reverse('students:quiz_list'))
+        self.assertEqual([q.pk for q in response.context['quizzes']], [quiz.pk])
+        self.assertFalse(TakenTime.objects.filter(quiz=quiz).exists())
+
+    @override_settings(IMAGE_VARIANTS_ASYNC=False)
+    def test_replace_deletes_image_files_after_commit(self):
+        quiz = create_quiz(question_count=2)
+        first, second = quiz.questions.order_by('pk')
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root):
+            names = [default_storage.save(name, ContentFile(b'image'))
+                     for name in ('explanations/a.jpg', 'variants/aa/shared.webp')]
+            variants = {'source': names[0], 'files': {'webp': [[480, names[1], 5]]}}
+            Explanation.objects.create(
+                question=first, text='a', image=names[0], image_variants=variants)
+            # 内容が同じ縮小画像は、ほかのクイズの解説と共有していることがある
+            Explanation.objects.create(
+                question=create_quiz(question_count=1, name='other').questions.get(),
+                text='b', image_variants={'files': {'webp': [[480, names[1], 5]]}})
+
+            with self.captureOnCommitCallbacks(execute=True):
+                quiz_io.import_questions(quiz, self.read([]), replace=True)
+            self.assertFalse(default_storage.exists(names[0]))
+            self.assertTrue(default_storage.exists(names[1]))
+
+
+class FragmentStampTests(TestCase):
+    """ 断片の版は、共有キャッシュ(template_fragments)があるときだけ使う """
+
+    @override_settings(FRAGMENT_CACHE_ENABLED=False)
+    def test_disabled_without_shared_cache(self):
+        self.assertEqual(fragments.stamps(fragments.CATALOGUE), '')
+
+    @override_settings(
+        FRAGMENT_CACHE_ENABLED=True,
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'template_fragments': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'fragment-stamp-tests',
+            },
+        })
+    def test_bump_changes_stamp(self):
+        stamp = fragments.stamps(fragments.CATALOGUE, fragments.student(1))
+        self.assertEqual(fragments.stamps(fragments.CATALOGUE, fragments.student(1)), stamp)
+        with self.captureOnCommitCallbacks(execute=True):
+            fragments.bump(fragments.student(1))
+        self.assertNotEqual(fragments.stamps(fragments.CATALOGUE, fragments.student(1)), stamp)
+
+    @override_settings(
+        FRAGMENT_CACHE_ENABLED=True,
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'template_fragments': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': 'fragment-render-tests',
+            },
+        })
+    def test_second_render_reads_cached_fragment(self):
+        quiz = create_quiz()
+        student = create_student(subject=quiz.subject)
+        self.client.force_login(student.user)
+        url = reverse('students:quiz_list')
+
+        with CaptureQueriesContext(connection) as first:
+            response = self.client.get(url)
+        self.assertContains(response, quiz.name)
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(url)
+        self.assertContains(response, quiz.name)
+        # 2回目は一覧のクエリを発行せず、キャッシュした断片を使う
+        self.assertLess(len(second), len(first))
+
+        # クイズを変えると版が変わり、次の表示で描画し直す
+        with self.captureOnCommitCallbacks(execute=True):
+            quiz.name = 'renamed'
+            quiz.save()
+        self.assertContains(self.client.get(url), 'renamed')
+
+
+class QueryProfilerTests(TestCase):
+
+    def test_max_queries_raises_over_budget(self):
+        with profiling.max_queries(2):
+            User.objects.count()
+            User.objects.count()
+        with self.assertRaises(profiling.QueryBudgetExceeded):
+            with profiling.max_queries(2):
+                for _ in range(3):
+                    User.objects.count()
+
+    @override_settings(QUERY_BUDGET_RAISE=True)
+    def test_middleware_raises_over_view_budget(self):
+        @profiling.query_budget(1)
+        def view(request):
+            User.objects.count()
+            User.objects.exists()
+            return HttpResponse()
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            return view(request)
+
+        middleware = profiling.QueryProfilerMiddleware(get_response)
+        with self.assertLogs('classroom.profiling', 'WARNING'):
+            with self.assertRaises(profiling.QueryBudgetExceeded):
+                middleware(RequestFactory().get('/'))
+
+    def test_repeated_queries_are_reported(self):
+        users = [User.objects.create(username=f'user {i}') for i in range(6)]
+
+        def view(request):
+            for user in users:
+                User.objects.filter(pk=user.pk).exists()
+            return HttpResponse()
+
+        middleware = profiling.QueryProfilerMiddleware(view)
+        with self.assertLogs('classroom.profiling', 'WARNING') as logs:
+            response = middleware(RequestFactory().get('/'))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(len(record['n_plus_one']), 1)
+        self.assertIn('"classroom_user"', record['n_plus_one'][0])
+        self.assertIn('5 repeated', response['Server-Timing'])
+
+    def test_requests_within_budget_log_at_debug(self):
+        def view(request):
+            User.objects.count()
+            return HttpResponse()
+
+        middleware = profiling.QueryProfilerMiddleware(view)
+        with self.assertLogs('classroom.profiling', 'DEBUG') as logs:
+            middleware(RequestFactory().get('/'))
+        self.assertEqual([record.levelname for record in logs.records], ['DEBUG'])
+
+    def test_template_render_is_restored(self):
+        render = Template.render
+        with profiling.profile_queries():
+            self.assertIsNot(Template.render, render)
+            with profiling.profile_queries():
+                pass
+            self.assertIsNot(Template.render, render)
+        self.assertIs(Template.render, render)
+
+
+class QuizFlowBenchmarkTests(TestCase):
+    """ 負荷試験は、どのシナリオも指定した回数まで実行する """
+
+    def test_every_flow_runs(self):
+        # 合成データの生徒だけでは受けられるクイズが足りない大きさ
+        spec = synthetic.Spec(students=6, quizzes=3, questions=3, seed=1)
+        catalogue, students, _ = synthetic.create_dataset(spec)
+        result = QuizFlowBenchmark(catalogue, students, host='testserver', seed=1).run(2)
+        self.assertEqual(result['flows'], {
+            'signup': 2, 'take_quiz:flow': 2, 'retry_quiz:flow': 2})
+
+
+class SQLitePragmaTests(SimpleTestCase):
+    """ データベースファイルに残る WAL は、OPTIONS の wal で有効にしたときだけ設定する """
+
+    def pragmas(self, **options):
+        wrapper = DatabaseWrapper({
+            **connection.settings_dict, 'NAME': 'unused.sqlite3', 'OPTIONS': options})
+        wrapper.get_connection_params()
+        return wrapper.pragmas
+
+    def test_wal_is_opt_in(self):
+        self.assertNotIn('journal_mode', self.pragmas())
+        self.assertNotIn('synchronous', self.pragmas())
+        self.assertEqual(self.pragmas(wal=True)['journal_mode'], 'WAL')
+        self.assertEqual(self.pragmas(pragmas={}), {})
@@ -23,6 +23,8 @@ urlpatterns = [
 
         path('retry_quiz/<int:pk>/<int:challenge_num>',
              students.retry_quiz, name='retry_quiz'),
+        path('quiz/<int:pk>/drowsiness/frames/',
+             students.drowsiness_frames, name='drowsiness_frames'),
     ], 'classroom'), namespace='students')),
 
     path('teachers/', include(([
@@ -33,6 +35,16 @@ urlpatterns = [
              teachers.QuizDeleteView.as_view(), name='quiz_delete'),
         path('quiz/<int:pk>/results/',
              teachers.QuizResultsView.as_view(), name='quiz_results'),
+        path('quiz/<int:pk>/results/stream/',
+             teachers.quiz_results_stream, name='quiz_results_stream'),
+        path('quiz/<int:pk>/results/export/',
+             teachers.quiz_results_export, name='quiz_results_export'),
+        path('quiz/<int:pk>/import/',
+             teachers.quiz_import, name='quiz_import'),
+        path('quiz/<int:pk>/export/',
+             teachers.quiz_export, name='quiz_export'),
+        path('quiz/<int:pk>/analysis/',
+             teachers.QuizItemAnalysisView.as_view(), name='quiz_item_analysis'),
         path('quiz/<int:pk>/question/add/',
              teachers.question_add, name='question_add'),
         path('quiz/<int:quiz_pk>/question/<int:question_pk>/',
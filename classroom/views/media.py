@@ -0,0 +1,184 @@
+"""
+アップロードされたファイルと静的ファイルの配信
+
+``django.views.static.serve`` と違い、ETag・Last-Modified による再検証と
+Range リクエスト(動画や大きい画像の途中からの読み込み)に対応する。
+内容のハッシュが名前になっているファイル(``classroom.images`` の縮小画像と
+``classroom.storage`` で集めた静的ファイル)は変わることがないので、1年間キャッシュさせる。
+静的ファイルは、ブラウザが対応していれば事前に圧縮した版(.br / .gz)を返す。
+"""
+import mimetypes
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from ..images import VARIANT_DIR
+from ..storage import ENCODINGS
+
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+RANGE_CHUNK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _parse_range(header, size):
+    """
+    ``Range: bytes=start-end`` を (start, end) にする(end を含む)。
+    複数の範囲や解釈できない値は None(全体を返す)、範囲外は ``False``。
+    """
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        # bytes=-500 は末尾の500バイト
+        length = int(end)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _if_range_matches(request, etag, last_modified):
+    value = request.headers.get('If-Range')
+    if value is None:
+        return True
+    if value.startswith(('"', 'W/')):
+        return value == etag
+    since = parse_http_date_safe(value)
+    return since is not None and int(last_modified) <= since
+
+
+def _resolve(root, path):
+    try:
+        fullpath = Path(safe_join(root, path))
+    except SuspiciousFileOperation:
+        raise Http404
+    if not fullpath.is_file():
+        raise Http404
+    return fullpath
+
+
+def _serve_file(request, fullpath, cache_control, content_type=None, encoding=None,
+                filename=None):
+    stat = fullpath.stat()
+    size = stat.st_size
+    # 圧縮版は元のファイルと別の表現なので、ETag も分ける
+    etag = f'"{size:x}-{stat.st_mtime_ns:x}{"-" + encoding if encoding else ""}"'
+    last_modified = int(stat.st_mtime)
+
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+    if encoding:
+        headers['Content-Encoding'] = encoding
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    if content_type is None:
+        content_type, _ = mimetypes.guess_type(str(fullpath))
+    content_type = content_type or 'application/octet-stream'
+
+    byte_range = None
+    if 'Range' in request.headers and _if_range_matches(request, etag, last_modified):
+        byte_range = _parse_range(request.headers['Range'], size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _read_range(fullpath, start, end - start + 1),
+            status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        response = FileResponse(
+            fullpath.open('rb'), content_type=content_type, filename=filename or '')
+
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+@require_safe
+def serve(request, path):
+    fullpath = _resolve(settings.MEDIA_ROOT, path)
+    if path.startswith(VARIANT_DIR + '/'):
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = f'public, max-age={getattr(settings, "MEDIA_CACHE_MAX_AGE", 0)}'
+    return _serve_file(request, fullpath, cache_control)
+
+
+def _accepted_encodings(request):
+    accepted = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+@require_safe
+def serve_static(request, path):
+    """ ``collectstatic`` で集めた STATIC_ROOT のファイルを配信する """
+    fullpath = _resolve(settings.STATIC_ROOT, path)
+    if path.endswith(tuple(suffix for suffix, _ in ENCODINGS)):
+        # 圧縮版を直接取りに来た場合はそのまま返す(Content-Encoding は付けない)
+        return _serve_file(request, fullpath, IMMUTABLE_CACHE_CONTROL,
+                           content_type='application/octet-stream')
+
+    if getattr(staticfiles_storage, 'is_hashed', lambda name: False)(path):
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = 'public, max-age=0, must-revalidate'
+
+    content_type, _ = mimetypes.guess_type(path)
+    accepted = _accepted_encodings(request)
+    for suffix, encoding in ENCODINGS:
+        compressed = fullpath.with_name(fullpath.name + suffix)
+        if encoding in accepted and compressed.is_file():
+            response = _serve_file(request, compressed, cache_control,
+                                   content_type=content_type, encoding=encoding,
+                                   filename=fullpath.name)
+            break
+    else:
+        response = _serve_file(request, fullpath, cache_control, content_type=content_type)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
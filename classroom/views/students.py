@@ -1,20 +1,29 @@
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.db.models import Count, F, Subquery, OuterRef, Max, Min
+from django.db.models import Count
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_POST
 from django.views.generic import CreateView, ListView, UpdateView, DetailView
 
 from ..decorators import student_required
+from ..events import publish_quiz_event
 from ..forms import StudentlebelForm, StudentSignUpForm, TakeQuizForm
-from ..models import Quiz, Student, TakenQuiz, User, Question, TakenTime
-from ..mixins import StudentRequiredMixin
+from ..models import (AttemptSummary, Quiz, Student, TakenQuiz, User,
+                      Question, TakenTime)
+from .. import fragments
+from ..mixins import FragmentCacheMixin, ReplicaReadMixin, StudentRequiredMixin
+from ..quiz_session import QuizSession
+from ..snapshots import get_quiz_snapshot
 
 import random
 import math
+import time
 
 from django.utils import timezone
 from django.utils.timezone import localtime
@@ -49,134 +58,129 @@ class StudentlebelView(StudentRequiredMixin, UpdateView):
         return super().form_valid(form)
 
 
-class QuizListView(StudentRequiredMixin, ListView):
+class QuizListView(ReplicaReadMixin, StudentRequiredMixin, FragmentCacheMixin, ListView):
     model = Quiz
     ordering = ('name', )
     context_object_name = 'quizzes'
     template_name = 'classroom/students/quiz_list.html'
+    query_budget = 6
 
     def get_queryset(self):
         student = self.request.user.student
         student_lebel = student.lebel.values_list('pk', flat=True)
         taken_quizzes = student.quizzes.values_list('pk', flat=True)
         queryset = Quiz.objects.filter(subject__in=student_lebel) \
+            .select_related('subject') \
             .exclude(pk__in=taken_quizzes) \
             .annotate(questions_count=Count('questions')) \
             .filter(questions_count__gt=0)
         return queryset
 
+    def fragment_scopes(self):
+        return fragments.student(self.request.user.pk), fragments.CATALOGUE
 
-class TakenQuizListView(StudentRequiredMixin, ListView):
-    model = TakenQuiz
+
+class TakenQuizListView(ReplicaReadMixin, StudentRequiredMixin, FragmentCacheMixin, ListView):
+    model = AttemptSummary
     context_object_name = 'taken_quizzes'
     template_name = 'classroom/students/taken_quiz_list.html'
+    query_budget = 6
 
     def get_queryset(self):
-        # 本当はDistinctでQuizの単位で集約したかったが、
-        # SQliteはDistinct未対応のため、仕方なくannotateで対応
-        ids = self.request.user.student.taken_quizzes \
-            .select_related('quiz', 'quiz__subject') \
-            .values('student', 'quiz',) \
-            .annotate(latest_id=Min('id')) \
-            .order_by('quiz__name') \
-            .values('latest_id')
-
-        explanation_subquery = self.request.user \
-            .student.taken_quizzes \
-            .values('quiz') \
-            .filter(quiz=OuterRef('quiz_id')) \
-            .annotate(explanation_count=Count('quiz__questions__explanation'))
-
-        queryset = self.request.user.student.taken_quizzes \
+        queryset = self.request.user.student.attempt_summaries \
             .select_related('quiz', 'quiz__subject') \
-            .filter(id__in=ids) \
-            .annotate(explanation_count=Subquery(
-                explanation_subquery.values('explanation_count'))) \
             .order_by('quiz__name')
         return queryset
 
+    def fragment_scopes(self):
+        return fragments.student(self.request.user.pk), fragments.CATALOGUE
+
 
-class RetryQuizListView(StudentRequiredMixin, ListView):
-    model = TakenQuiz
+class RetryQuizListView(ReplicaReadMixin, StudentRequiredMixin, FragmentCacheMixin, ListView):
+    model = AttemptSummary
     context_object_name = 'retry_quizzes'
     template_name = 'classroom/students/retry_quiz_list.html'
+    query_budget = 6
 
     def get_queryset(self):
-        student: Student = self.request.user.student
-
-        subquery = self.request.user.student.taken_quizzes \
-            .select_related('quiz') \
-            .filter(quiz_id=OuterRef('quiz_id')) \
-            .values('quiz') \
-            .annotate(retry_num=Max('challenge_num')) \
-            .order_by('quiz_id')
-
-        # クイズごとに集約を行う
-        queryset = student.quiz_answers.\
-            filter(answer__is_correct=False)\
-            .values(
-                'answer__question__quiz',
-                'answer__question__quiz__name',
-                'answer__question__quiz__subject__color',
-                'answer__question__quiz__subject__name') \
-            .annotate(  # 集約したときは親のテーブルのオブジェクトを取得できないので、各項目を出力していく
-                not_corrected_count=Count('answer'),
-                name=F('answer__question__quiz__name'),
-                quiz_id=F('answer__question__quiz'),
-                subject_color=F('answer__question__quiz__subject__color'),
-                subject_name=F('answer__question__quiz__subject__name'),
-                try_num=Subquery(subquery.values('retry_num'))
-            ) \
-            .filter(challenge_num=F('try_num')).order_by('name')
-
+        # 最後の挑戦で間違えた問題が残っているクイズだけを出す
+        queryset = self.request.user.student.attempt_summaries \
+            .filter(wrong_count__gt=0) \
+            .select_related('quiz', 'quiz__subject') \
+            .order_by('quiz__name')
         return queryset
 
+    def fragment_scopes(self):
+        return fragments.student(self.request.user.pk), fragments.CATALOGUE
+
 
-class ExplanationListView(StudentRequiredMixin, ListView):
+class ExplanationListView(ReplicaReadMixin, StudentRequiredMixin, ListView):
     model = Quiz
     context_object_name = 'questions'
     template_name = 'classroom/students/explanations_list.html'
 
     def get_queryset(self):
-        queryset = Quiz.objects.get(pk=self.kwargs['pk']).questions.all()
-        return queryset
+        quiz = get_object_or_404(Quiz, pk=self.kwargs['pk'])
+        self.quiz = get_quiz_snapshot(quiz)
+        return self.quiz.questions
+
+    def get_context_data(self, **kwargs):
+        student = self.request.user.student
+        kwargs['quiz'] = self.quiz
+        kwargs['latest_answers'] = {
+            question_id: self.quiz.answer(answer_id)
+            for question_id, answer_id
+            in student.get_latest_answer_ids(self.quiz.pk).items()}
+        return super().get_context_data(**kwargs)
 
 
-class ExplanationDetailView(StudentRequiredMixin, DetailView):
+class ExplanationDetailView(ReplicaReadMixin, StudentRequiredMixin, DetailView):
     model = Question
     context_object_name = 'explanation'
     template_name = 'classroom/students/explanations_detail.html'
 
     def get_object(self, queryset=None):
-        question = Question.objects.get(
-            pk=self.kwargs['question_pk'])
+        quiz = get_object_or_404(Quiz, pk=self.kwargs['pk'])
+        self.quiz = get_quiz_snapshot(quiz)
+        self.question = self.quiz.question(self.kwargs['question_pk'])
+        if self.question is None:
+            raise Http404
 
-        if hasattr(question, 'explanation'):
-            return question.explanation
+        return self.question.explanation
 
-        return None
+    def get_context_data(self, **kwargs):
+        kwargs['quiz'] = self.quiz
+        kwargs['question'] = self.question
+        return super().get_context_data(**kwargs)
 
 
 @login_required
 @student_required
 def take_quiz(request, pk):
     quiz = get_object_or_404(Quiz, pk=pk)
+    snapshot = get_quiz_snapshot(quiz)
     student = request.user.student
 
+    # 別のブラウザなどで受験を終えていることがあるので、セッションがあっても毎回確かめる
+    quiz_session = QuizSession(request, snapshot)
     if student.quizzes.filter(pk=pk).exists():
+        if quiz_session.is_active:
+            quiz_session.clear()
         return redirect('students:quiz_list')
         # return render(request, 'students/taken_quiz_list.html')
-    taken_time = TakenTime.objects.filter(student=student, quiz=quiz).first()
-    if taken_time is None:
-        TakenTime.objects.create(
-            student=student, quiz=quiz, take_start=timezone.now())
+    if not quiz_session.is_active:
+        quiz_session.start(student)
+
+    question = quiz_session.current_question()
+    if question is None:
+        # 全問回答済みのまま終了していない場合はここで採点する
+        with transaction.atomic():
+            score = _finish_take_quiz(
+                request, student, quiz, snapshot, quiz_session)
+        messages.success(request, f'点数は {score}')
+        return redirect('students:quiz_list')
 
-    total_questions = quiz.questions.count()
-    unanswered_questions = student.get_unanswered_questions(quiz)
-    total_unanswered_questions = unanswered_questions.count()
-    progress = 100 - \
-        round(((total_unanswered_questions - 1) / total_questions) * 100)
-    question = unanswered_questions.first()
+    progress = quiz_session.progress
     random_message = ''
     if request.method == 'POST':
         form = TakeQuizForm(question=question, data=request.POST)
@@ -184,17 +188,18 @@ def take_quiz(request, pk):
             with transaction.atomic():
                 student_answer = form.save(commit=False)
                 student_answer.student = student
-                student_answer.save()
-                if student.get_unanswered_questions(quiz).exists():
+                if not quiz_session.record(student_answer, form.cleaned_data['answer']):
+                    # 回答済みの問題なので、保存せずに次の問題を出す
+                    return redirect('students:take_quiz', pk)
+                publish_quiz_event(quiz.pk, 'answer-submitted', {
+                    'student': request.user.username,
+                    'challenge_num': student_answer.challenge_num,
+                })
+                if not quiz_session.is_finished:
                     return redirect('students:take_quiz', pk)
                 else:
-                    correct_answers = student.quiz_answers.filter(
-                        answer__question__quiz=quiz, answer__is_correct=True).count()
-                    score = round((correct_answers / total_questions) * 100.0)
-                    TakenQuiz.objects.update_or_create(
-                        student=student, quiz=quiz, score=score)
-                    taken_time.take_end = timezone.now()
-                    taken_time.save()
+                    score = _finish_take_quiz(
+                        request, student, quiz, snapshot, quiz_session)
 
                     if score < 50.0:
                         random_messages = [
@@ -230,7 +235,33 @@ def take_quiz(request, pk):
         'quiz': quiz,
         'question': question,
         'form': form,
-        'progress': progress
+        'progress': progress,
+        'drowsiness_capture': settings.DROWSINESS_CAPTURE_ENABLED,
+        'drowsiness_fps': settings.DROWSINESS_INGEST_FPS,
+    })
+
+
+def _finish_take_quiz(request, student, quiz, snapshot, quiz_session):
+    """ 採点して受験結果と集計を保存し、点数を返す """
+    score = quiz_session.score
+    wrong_count = quiz_session.wrong_count
+    taken_quiz, _ = TakenQuiz.objects.update_or_create(
+        student=student, quiz=quiz, score=score)
+    duration = quiz_session.finish()
+    AttemptSummary.record(
+        taken_quiz,
+        wrong_count=wrong_count,
+        explanation_count=snapshot.explanation_count,
+        duration=duration)
+    _publish_attempt_finished(request, taken_quiz)
+    return score
+
+
+def _publish_attempt_finished(request, taken_quiz):
+    publish_quiz_event(taken_quiz.quiz_id, 'attempt-finished', {
+        'student': request.user.username,
+        'challenge_num': taken_quiz.challenge_num,
+        'score': taken_quiz.score,
     })
 
 
@@ -238,6 +269,7 @@ def take_quiz(request, pk):
 @student_required
 def retry_quiz(request, pk, challenge_num):
     quiz = get_object_or_404(Quiz, pk=pk)
+    snapshot = get_quiz_snapshot(quiz)
     student: Student = request.user.student
 
     wrong_answers = student.get_latest_wrong_answers(quiz, challenge_num)
@@ -261,15 +293,24 @@ def retry_quiz(request, pk, challenge_num):
 
     if request.method == 'POST':
         # 回答がある問題を抽出
-        question = Question.objects.filter(
-            answers=request.POST.get('answer')).first()
-        form = TakeQuizForm(question=question, data=request.POST)
-        if form.is_valid():
+        try:
+            answer = snapshot.answer(int(request.POST.get('answer')))
+        except (TypeError, ValueError):
+            answer = None
+        form = None
+        if answer is not None:
+            question = snapshot.question(answer.question_id)
+            form = TakeQuizForm(question=question, data=request.POST)
+        if form is not None and form.is_valid():
             with transaction.atomic():
                 student_answer = form.save(commit=False)
                 student_answer.student = student
                 student_answer.challenge_num = challenge_num + 1
                 student_answer.save()
+                publish_quiz_event(quiz.pk, 'answer-submitted', {
+                    'student': request.user.username,
+                    'challenge_num': student_answer.challenge_num,
+                })
                 if wrong_answers.exclude(
                         answer__question__in=answered_question).exists():
                     return redirect('students:retry_quiz', pk, challenge_num)
@@ -279,11 +320,16 @@ def retry_quiz(request, pk, challenge_num):
                         answer__question__quiz=quiz,
                         answer__is_correct=True).count()
                     score = round((correct_answers / total_questions) * 100.0)
-                    TakenQuiz.objects.create(
+                    taken_quiz = TakenQuiz.objects.create(
                         challenge_num=challenge_num+1,
                         student=student,
                         quiz=quiz,
                         score=score)
+                    AttemptSummary.record(
+                        taken_quiz,
+                        wrong_count=total_questions - correct_answers,
+                        explanation_count=snapshot.explanation_count)
+                    _publish_attempt_finished(request, taken_quiz)
 
                     if score < 50.0:
                         random_messages = [
@@ -308,12 +354,73 @@ def retry_quiz(request, pk, challenge_num):
 
         return redirect('students:retry_quiz_list')
     else:
-        question = unanswered_questions.first().answer.question
+        question = snapshot.question(unanswered_questions.values_list(
+            'answer__question', flat=True).first())
         form = TakeQuizForm(question=question, order='?')
 
     return render(request, 'classroom/students/take_quiz_form.html', {
         'quiz': quiz,
         'question': question,
         'form': form,
-        'progress': progress
+        'progress': progress,
+        'drowsiness_capture': settings.DROWSINESS_CAPTURE_ENABLED,
+        'drowsiness_fps': settings.DROWSINESS_INGEST_FPS,
     })
+
+
+def _frame_timestamp(value):
+    """ ブラウザの撮影時刻(エポックからのミリ秒)を秒にする。なければ受け取った時刻 """
+    try:
+        return float(value) / 1000
+    except (TypeError, ValueError):
+        return time.time()
+
+
+def _read_frames(request):
+    """
+    リクエストから (JPEGのバイト列, 撮影時刻) のリストを取り出す。
+    本文がそのままJPEGの場合と、multipartで frame / timestamp を複数送る場合がある。
+    """
+    max_bytes = settings.DROWSINESS_INGEST_MAX_BYTES
+    if request.content_type == 'image/jpeg':
+        if len(request.body) > max_bytes:
+            return None
+        return [(request.body,
+                 _frame_timestamp(request.headers.get('X-Frame-Timestamp')))]
+
+    files = request.FILES.getlist('frame')
+    timestamps = request.POST.getlist('timestamp')
+    if any(f.size > max_bytes for f in files):
+        return None
+    return [(f.read(), _frame_timestamp(timestamps[i] if i < len(timestamps) else None))
+            for i, f in enumerate(files)]
+
+
+@login_required
+@student_required
+@require_POST
+def drowsiness_frames(request, pk):
+    # 受験中のカメラのフレームを受け取り、解析を予約してすぐに返す
+    quiz = get_object_or_404(Quiz, pk=pk)
+    student = request.user.student
+    # 受験中(このセッションで受験を始めた)か、間違えた問題の再挑戦ができるクイズに限る
+    if not (QuizSession(request, quiz).is_active
+            or AttemptSummary.objects.filter(
+                student=student, quiz=quiz, wrong_count__gt=0).exists()):
+        return JsonResponse({'error': '受験中のクイズではありません'}, status=403)
+    frames = _read_frames(request)
+    if frames is None:
+        return JsonResponse({'error': 'フレームが大きすぎます'}, status=413)
+    if not frames:
+        return JsonResponse({'error': 'フレームがありません'}, status=400)
+
+    # 解析の部品は最初のフレームが届いたときに読み込む
+    from ..drowsiness.ingest import get_analyzer
+
+    accepted, dropped = get_analyzer().submit(student, quiz, frames)
+    response = JsonResponse(
+        {'accepted': accepted, 'dropped': dropped},
+        status=202 if accepted else 429)
+    if not accepted:
+        response['Retry-After'] = '1'
+    return response
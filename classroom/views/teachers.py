@@ -1,21 +1,27 @@
+import io
 from typing import Any
+
 from django.contrib import messages
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.db.models import Avg, Count
+from django.db.models import Count
 from django.forms import inlineformset_factory
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views.generic import (CreateView, DeleteView, DetailView, ListView,
                                   UpdateView, FormView)
 
+from .. import fragments, item_analysis, quiz_io, results
 from ..decorators import teacher_required
+from ..events import quiz_channel, sse_response
 from ..forms import (BaseAnswerInlineFormSet, QuestionForm, TeacherSignUpForm,
-                     ExplanationForm)
-from ..models import Answer, Question, Quiz, User, Explanation
-from ..mixins import TeacherRequiredMixin
+                     ExplanationForm, QuizImportForm)
+from ..models import Answer, Question, QuestionStat, Quiz, User, Explanation
+from ..mixins import FragmentCacheMixin, ReplicaReadMixin, TeacherRequiredMixin
+from ..snapshots import get_quiz_snapshot
 
 
 class TeacherSignUpView(CreateView):
@@ -33,11 +39,12 @@ class TeacherSignUpView(CreateView):
         return redirect('teachers:quiz_change_list')
 
 
-class QuizListView(TeacherRequiredMixin, ListView):
+class QuizListView(TeacherRequiredMixin, FragmentCacheMixin, ListView):
     model = Quiz
     ordering = ('name', )
     context_object_name = 'quizzes'
     template_name = 'classroom/teachers/quiz_change_list.html'
+    query_budget = 6
 
     def get_queryset(self):
         queryset = self.request.user.quizzes \
@@ -46,6 +53,9 @@ class QuizListView(TeacherRequiredMixin, ListView):
             .annotate(taken_count=Count('taken_quizzes', distinct=True))
         return queryset
 
+    def fragment_scopes(self):
+        return fragments.teacher(self.request.user.pk), fragments.CATALOGUE
+
 
 class QuizCreateView(TeacherRequiredMixin, CreateView):
     model = Quiz
@@ -66,10 +76,12 @@ class QuizUpdateView(TeacherRequiredMixin, UpdateView):
     fields = ('name', 'subject', )
     context_object_name = 'quiz'
     template_name = 'classroom/teachers/quiz_change_form.html'
+    query_budget = 8
 
     def get_context_data(self, **kwargs):
-        kwargs['questions'] = self.get_object().questions.annotate(
-            answers_count=Count('answers'))
+        kwargs['questions'] = self.object.questions \
+            .select_related('explanation') \
+            .annotate(answers_count=Count('answers'))
         return super().get_context_data(**kwargs)
 
     def get_queryset(self):
@@ -100,21 +112,34 @@ class QuizDeleteView(TeacherRequiredMixin, DeleteView):
         return self.request.user.quizzes.all()
 
 
-class QuizResultsView(TeacherRequiredMixin, DetailView):
+class QuizResultsView(ReplicaReadMixin, TeacherRequiredMixin, DetailView):
     model = Quiz
     context_object_name = 'quiz'
     template_name = 'classroom/teachers/quiz_results.html'
 
+    page_size = 50
+
     def get_context_data(self, **kwargs):
-        quiz = self.get_object()
-        taken_quizzes = quiz.taken_quizzes.select_related(
-            'student__user').order_by('-date')
-        total_taken_quizzes = taken_quizzes.count()
-        quiz_score = quiz.taken_quizzes.aggregate(average_score=Avg('score'))
+        quiz = self.object
+        sort = self.request.GET.get('sort', results.DEFAULT_SORT)
+        sort_key, descending = results.parse_sort(sort)
+        taken_quizzes, next_cursor = results.keyset_page(
+            quiz.taken_quizzes.select_related(
+                'student__user').with_taken_time(),
+            sort,
+            cursor=self.request.GET.get('after'),
+            size=self.page_size)
+        distribution = results.score_distribution(quiz.taken_quizzes.all())
         extra_context = {
             'taken_quizzes': taken_quizzes,
-            'total_taken_quizzes': total_taken_quizzes,
-            'quiz_score': quiz_score
+            'total_taken_quizzes': distribution['total'],
+            'quiz_score': {'average_score': distribution.get('average')},
+            'distribution': distribution,
+            'sort': ('-' if descending else '') + sort_key,
+            'sort_key': sort_key,
+            'descending': descending,
+            'next_cursor': next_cursor,
+            'is_first_page': not self.request.GET.get('after'),
         }
         kwargs.update(extra_context)
         return super().get_context_data(**kwargs)
@@ -123,6 +148,108 @@ class QuizResultsView(TeacherRequiredMixin, DetailView):
         return self.request.user.quizzes.all()
 
 
+class QuizItemAnalysisView(TeacherRequiredMixin, DetailView):
+    model = Quiz
+    context_object_name = 'quiz'
+    template_name = 'classroom/teachers/quiz_item_analysis.html'
+
+    def get_context_data(self, **kwargs):
+        quiz = self.object
+        try:
+            challenge_num = int(self.request.GET.get('challenge_num', 1))
+        except ValueError:
+            challenge_num = 1
+        kwargs['challenge_num'] = challenge_num
+        kwargs['challenge_nums'] = QuestionStat.objects \
+            .filter(question__quiz=quiz) \
+            .order_by('challenge_num') \
+            .values_list('challenge_num', flat=True) \
+            .distinct()
+        kwargs['rows'] = item_analysis.analyse_quiz(
+            get_quiz_snapshot(quiz), challenge_num)
+        return super().get_context_data(**kwargs)
+
+    def get_queryset(self):
+        return self.request.user.quizzes.all()
+
+
+@login_required
+@teacher_required
+def quiz_results_stream(request, pk):
+    # 接続時に一度だけ権限を確認し、以降はクイズのチャンネルを購読するだけ
+    quiz = get_object_or_404(Quiz, pk=pk, owner=request.user)
+    return sse_response(request, quiz_channel(quiz.pk))
+
+
+@login_required
+@teacher_required
+def quiz_results_export(request, pk):
+    quiz = get_object_or_404(Quiz, pk=pk, owner=request.user)
+    sort = request.GET.get('sort', results.DEFAULT_SORT)
+    rows = results.export_rows(quiz.taken_quizzes.all(), sort)
+
+    if request.GET.get('format') == 'ndjson':
+        response = StreamingHttpResponse(
+            results.stream_ndjson(rows), content_type='application/x-ndjson')
+        filename = f'quiz-{quiz.pk}-results.ndjson'
+    else:
+        response = StreamingHttpResponse(
+            results.stream_csv(rows), content_type='text/csv; charset=utf-8')
+        filename = f'quiz-{quiz.pk}-results.csv'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@login_required
+@teacher_required
+def quiz_import(request, pk):
+    quiz = get_object_or_404(Quiz, pk=pk, owner=request.user)
+
+    if request.method == 'POST':
+        form = QuizImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            format = form.cleaned_data['format'] or quiz_io.guess_format(upload.name)
+            # アップロードされたファイルは一時ファイルのまま少しずつ読む
+            stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+            try:
+                counts = quiz_io.import_questions(
+                    quiz, quiz_io.read_questions(stream, format),
+                    replace=form.cleaned_data['replace'])
+            except (quiz_io.QuizImportError, UnicodeDecodeError) as e:
+                form.add_error('file', str(e))
+            else:
+                messages.success(
+                    request,
+                    f'{counts["questions"]}問(選択肢{counts["answers"]}件、'
+                    f'解説{counts["explanations"]}件)を読み込みました')
+                if counts['deleted_student_answers'] or counts['deleted_attempts']:
+                    messages.warning(
+                        request,
+                        f'削除した問題への生徒の回答{counts["deleted_student_answers"]}件と'
+                        f'受験結果{counts["deleted_attempts"]}件を削除しました')
+                return redirect('teachers:quiz_change', quiz.pk)
+    else:
+        form = QuizImportForm()
+
+    return render(request, 'classroom/teachers/quiz_import_form.html', {'quiz': quiz, 'form': form})
+
+
+@login_required
+@teacher_required
+def quiz_export(request, pk):
+    quiz = get_object_or_404(Quiz, pk=pk, owner=request.user)
+    format = request.GET.get('format', 'json')
+    if format not in quiz_io.FORMATS:
+        format = 'json'
+
+    records = quiz_io.export_questions(quiz)
+    response = StreamingHttpResponse(
+        quiz_io.STREAMS[format](records), content_type=quiz_io.CONTENT_TYPES[format])
+    response['Content-Disposition'] = f'attachment; filename="quiz-{quiz.pk}.{format}"'
+    return response
+
+
 @login_required
 @teacher_required
 def question_add(request, pk):
@@ -0,0 +1,20 @@
+"""
+ASGI config for django_school project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Server-sent event streams (``classroom.events``) only wait on coroutines when
+the project is served through this entry point, e.g.::
+
+    uvicorn django_school.asgi:application
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_school.settings")
+
+application = get_asgi_application()
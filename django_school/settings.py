@@ -1,5 +1,6 @@
 import os
 
+import django
 from django.contrib.messages import constants as messages
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -44,6 +45,39 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# リクエストごとのクエリ数・SQL時間・描画時間を Server-Timing とログに出す
+# (classroom.profiling)。DEBUG のときは既定で有効
+QUERY_PROFILER = os.environ.get('QUERY_PROFILER', '1' if DEBUG else '0') == '1'
+
+if QUERY_PROFILER:
+    MIDDLEWARE.insert(0, 'classroom.profiling.QueryProfilerMiddleware')
+
+# ビューのクエリ数の予算の既定値(None なら制限なし)。超えたら警告し、
+# QUERY_BUDGET_RAISE が真なら例外にする(テスト用)
+QUERY_BUDGET = int(os.environ['QUERY_BUDGET']) if os.environ.get('QUERY_BUDGET') else None
+QUERY_BUDGET_RAISE = False
+
+# 同じ形のクエリがこの回数以上あれば N+1 の疑いとしてログに出す
+QUERY_PROFILER_DUPLICATE_THRESHOLD = 5
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # 予算の超過と N+1 の疑いは WARNING で出る。すべてのリクエストを出すには DEBUG にする
+        'classroom.profiling': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_PROFILER_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 ROOT_URLCONF = 'django_school.urls'
 
 TEMPLATES = [
@@ -64,18 +98,195 @@ TEMPLATES = [
     },
 ]
 
+# 本番ではテンプレートをパースした結果をプロセス内で使い回す(ファイルの変更は読み直さない)
+if not DEBUG:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'django_school.wsgi.application'
 
+ASGI_APPLICATION = 'django_school.asgi.application'
+
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
+# DATABASE_PROFILE で切り替える。
+#   sqlite      (既定)接続ごとにキャッシュなどの PRAGMA を設定し、書き込むトランザクションを
+#               BEGIN IMMEDIATE で始める(classroom.backends.sqlite3)。
+#               SQLITE_WAL=1 で WAL と synchronous=NORMAL も設定する。WAL はデータベース
+#               ファイルに記録されるので、運用するデータベース(SQLITE_PATH)でだけ有効にする。
+#               SQLITE_PRAGMAS=0 で Django の既定のまま(比較用)
+#   postgresql  POSTGRES_DB / USER / PASSWORD / HOST / PORT で接続する。
+#               Django 5.1 以降は接続プールを使い、それより前はスレッドごとの接続を使い回す。
+#               PgBouncer(transaction モード)を挟む場合は POSTGRES_POOLER=pgbouncer
+
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+
+# 接続を使い回す秒数(0 ならリクエストごとに接続し直す)
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+if DATABASE_PROFILE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'django_school'),
+            'USER': os.environ.get('POSTGRES_USER', 'django_school'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            # PgBouncer の transaction モードではサーバー側カーソル(iterator())が使えない
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_POOLER') == 'pgbouncer',
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
+    }
+    if django.VERSION >= (5, 1) and os.environ.get('POSTGRES_POOLER') != 'pgbouncer':
+        # プールを使う場合、接続の使い回しはプールに任せる
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10)),
+            'timeout': 10,
+        }
+elif DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'classroom.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'OPTIONS': {
+                # 書き込みのロックを待つ秒数
+                'timeout': float(os.environ.get('SQLITE_BUSY_TIMEOUT', 20)),
+            },
+        }
+    }
+    if os.environ.get('SQLITE_PRAGMAS', '1') == '0':
+        DATABASES['default']['OPTIONS']['pragmas'] = {}
+    else:
+        DATABASES['default']['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+        DATABASES['default']['OPTIONS']['wal'] = os.environ.get('SQLITE_WAL') == '1'
+else:
+    raise ValueError(f'DATABASE_PROFILE は sqlite か postgresql: {DATABASE_PROFILE}')
+
+# Read replicas
+# 読み込み専用のビュー(classroom.mixins.ReplicaReadMixin)の読み込みを送るデータベース。
+# SQLite では SQLITE_REPLICA_PATH に別のファイルを指定すると、その複製をレプリカの代わりに
+# 使える(`manage.py sync_replica` で default から複製する)。
+# PostgreSQL では POSTGRES_REPLICA_HOSTS にレプリカのホストをカンマ区切りで指定する。
+# 書き込んだ利用者は REPLICA_PIN_SECONDS 秒のあいだ default から読む
+
+if DATABASE_PROFILE == 'sqlite':
+    _replicas = {
+        'replica': {'NAME': os.environ['SQLITE_REPLICA_PATH']},
+    } if os.environ.get('SQLITE_REPLICA_PATH') else {}
+else:
+    _replicas = {
+        f'replica_{i}': {'HOST': host.strip()}
+        for i, host in enumerate(os.environ.get('POSTGRES_REPLICA_HOSTS', '').split(','), 1)
+        if host.strip()
+    }
+
+for _alias, _overrides in _replicas.items():
+    # テストではレプリカも default のテスト用データベースを使う
+    DATABASES[_alias] = {**DATABASES['default'], **_overrides, 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_REPLICAS = list(_replicas)
+
+DATABASE_ROUTERS = ['classroom.replicas.ReplicaRouter']
 
-DATABASES = {
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 5))
+
+if DATABASE_REPLICAS:
+    MIDDLEWARE.append('classroom.replicas.ReplicaPinMiddleware')
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
 }
 
+# クイズ内容のスナップショットをプロセス間で共有する場合は、
+# QUIZ_SNAPSHOT_CACHE_DIR(ファイル)か QUIZ_SNAPSHOT_CACHE_TABLE(DB)を指定する。
+# DBを使う場合は `manage.py createcachetable` を先に実行すること。
+if os.environ.get('QUIZ_SNAPSHOT_CACHE_DIR'):
+    CACHES['quiz_snapshots'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ['QUIZ_SNAPSHOT_CACHE_DIR'],
+    }
+elif os.environ.get('QUIZ_SNAPSHOT_CACHE_TABLE'):
+    CACHES['quiz_snapshots'] = {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': os.environ['QUIZ_SNAPSHOT_CACHE_TABLE'],
+    }
+
+# 一覧ページの断片キャッシュとその版(classroom.fragments)。版が古いままの
+# プロセスが出ないよう、スナップショットの共有キャッシュがあればそれを使う。
+# 共有キャッシュがなければ断片はキャッシュしない(プロセスごとの LocMem では、
+# 別のプロセスで消した版が見えず、一覧が最大で期限まで古いままになる)
+if 'quiz_snapshots' in CACHES:
+    CACHES['template_fragments'] = CACHES['quiz_snapshots']
+
+# 断片キャッシュを使うには、上の QUIZ_SNAPSHOT_CACHE_DIR か QUIZ_SNAPSHOT_CACHE_TABLE を
+# 指定するか、すべてのプロセスで共有するキャッシュを直接 template_fragments に設定する。例:
+#     CACHES['template_fragments'] = {
+#         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#         'LOCATION': 'redis://127.0.0.1:6379',
+#     }
+# プロセスが1つだけ(runserver など)なら LocMemCache でもよい。
+FRAGMENT_CACHE_ENABLED = 'template_fragments' in CACHES
+
+QUIZ_SNAPSHOT_CACHE = 'default'
+
+QUIZ_SNAPSHOT_SHARED_CACHE = 'quiz_snapshots'
+
+# Server-sent events
+# 複数プロセスでイベントを共有する場合は、InProcessBroadcaster と同じ
+# publish / subscribe / subscribe_sync を持つバックエンドを指定する
+
+CLASSROOM_EVENT_BACKEND = 'classroom.events.InProcessBroadcaster'
+
+# 回答・受験終了のイベントをまとめて先生に送る間隔(秒)
+CLASSROOM_EVENT_COALESCE_SECONDS = 1.0
+
+# 1つの接続でイベントを送り続ける上限(秒)。上限で接続を閉じ、ブラウザの再接続
+# (Last-Event-ID で続きから)に任せる。Django 4.2 の ASGI ではタブを閉じても
+# ストリームが止まらないので、閉じた接続の購読が残り続けないようにする
+CLASSROOM_EVENT_STREAM_SECONDS = 300
+
+# 居眠り検知
+# dlibの68点ランドマークのモデル(shape_predictor_68_face_landmarks.dat)の場所
+
+DROWSINESS_PREDICTOR_PATH = os.path.join(BASE_DIR, 'shape_predictor_68_face_landmarks.dat')
+
+# 起動時にモデルを読み込むかどうか。居眠り検知を担当するプロセスだけで有効にする
+DROWSINESS_PRELOAD = os.environ.get('DROWSINESS_PRELOAD') == '1'
+
+# 検知したイベントは、この件数か秒数のどちらかに達するたびにまとめて保存する
+DROWSINESS_EVENT_BATCH_SIZE = 200
+DROWSINESS_EVENT_FLUSH_SECONDS = 1.0
+
+# ブラウザのカメラから受け取ったフレームの解析
+# 受験画面でカメラを使うかどうか。使う場合は生徒にカメラの許可を求める
+DROWSINESS_CAPTURE_ENABLED = os.environ.get('DROWSINESS_CAPTURE_ENABLED') == '1'
+# 解析に使うワーカープロセス数(サーバー全体で共有する)
+DROWSINESS_INGEST_WORKERS = int(os.environ.get('DROWSINESS_INGEST_WORKERS', 2))
+# 同時に解析待ちにできるフレーム数。超えたフレームは捨てる
+DROWSINESS_INGEST_MAX_PENDING = 32
+# 生徒1人あたり1秒に受け付けるフレーム数
+DROWSINESS_INGEST_FPS = 2
+# 1フレームの上限(バイト)
+DROWSINESS_INGEST_MAX_BYTES = 256 * 1024
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.0/topics/i18n/
 
@@ -98,6 +309,22 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+
+# collectstatic で内容のハッシュ付きの名前と圧縮版(.gz / .br)を作り、それを配信する。
+# DEBUG=False では既定で有効。開発中は runserver が static/ をそのまま返す
+STATIC_PIPELINE = os.environ.get('STATIC_PIPELINE', '0' if DEBUG else '1') == '1'
+
+if STATIC_PIPELINE:
+    STORAGES = {
+        'default': {
+            'BACKEND': 'django.core.files.storage.FileSystemStorage',
+        },
+        'staticfiles': {
+            'BACKEND': 'classroom.storage.CompressedManifestStaticFilesStorage',
+        },
+    }
+
 # Custom Django auth settings
 
 AUTH_USER_MODEL = 'classroom.User'
@@ -128,3 +355,15 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')  # Fixed the typo
 MEDIA_URL = '/media/'
+
+# アップロードされた元の画像をブラウザがキャッシュする秒数。
+# 縮小画像は名前が内容のハッシュなので、この設定によらず1年間キャッシュさせる
+MEDIA_CACHE_MAX_AGE = 60 * 60 * 24
+
+# アップロードされたファイルを Django から配信するか。既定では開発中(DEBUG)だけで、
+# 本番ではウェブサーバーから MEDIA_ROOT を配信する
+SERVE_MEDIA = os.environ.get('SERVE_MEDIA', '1' if DEBUG else '0') == '1'
+
+# 縮小画像を作るスレッドの数と、別スレッドで作るか(0 なら保存のコミット直後にその場で作る)
+IMAGE_VARIANT_WORKERS = int(os.environ.get('IMAGE_VARIANT_WORKERS', 1))
+IMAGE_VARIANTS_ASYNC = os.environ.get('IMAGE_VARIANTS_ASYNC', '1') == '1'
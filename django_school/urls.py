@@ -1,9 +1,7 @@
+from django.conf import settings
 from django.urls import include, path
 
-from classroom.views import classroom, students, teachers
-
-from . import settings
-from django.conf.urls.static import static
+from classroom.views import classroom, media, students, teachers
 
 urlpatterns = [
     path('', include('classroom.urls')),
@@ -13,7 +11,12 @@ urlpatterns = [
          students.StudentSignUpView.as_view(), name='student_signup'),
     path('accounts/signup/teacher/',
          teachers.TeacherSignUpView.as_view(), name='teacher_signup'),
-
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+if settings.SERVE_MEDIA:
+    urlpatterns.append(path(
+        settings.MEDIA_URL.lstrip('/') + '<path:path>', media.serve, name='media'))
+
+if settings.STATIC_PIPELINE:
+    urlpatterns.append(path(
+        settings.STATIC_URL.lstrip('/') + '<path:path>', media.serve_static, name='static'))